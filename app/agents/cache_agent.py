@@ -1,40 +1,100 @@
 import asyncio
 import contextlib
+import heapq
+import logging
+import sys
 import time
+from collections import OrderedDict
 from collections.abc import Awaitable, Callable
 from typing import Any, Generic, Optional, TypeVar
 
+from pydantic import BaseModel
+
 from app.agents import Agent
-from app.metrics import CACHE_HITS, CACHE_MISSES, CACHE_SIZE
+from app.metrics import (
+    CACHE_BYTES,
+    CACHE_COALESCED,
+    CACHE_EVICTIONS,
+    CACHE_HITS,
+    CACHE_MISSES,
+    CACHE_NEGATIVE_HITS,
+    CACHE_SIZE,
+    CACHE_STALE_HITS,
+)
 
 T = TypeVar('T')
 
+# Маркер закешированного отсутствия значения: None в кеше означает промах
+NOT_FOUND = object()
+
+
+def estimate_size(key: str, value: Any) -> int:
+    """Приблизительный размер записи кеша в байтах."""
+    size = sys.getsizeof(key) + sys.getsizeof(value)
+    if isinstance(value, BaseModel):
+        size += sum(sys.getsizeof(field) for field in value.__dict__.values())
+    return size
+
 
 class CacheEntry(Generic[T]):
     """Класс для хранения кешированных значений с временем жизни."""
 
-    def __init__(self, value: T, ttl: int):
+    __slots__ = ('value', 'expires_at', 'stale_until', 'size')
+
+    def __init__(self, value: T, ttl: int, size: int = 0, stale_ttl: int = 0):
         self.value = value
         self.expires_at = time.time() + ttl
+        # После истечения запись еще stale_ttl секунд может отдаваться, пока идет обновление
+        self.stale_until = self.expires_at + stale_ttl
+        self.size = size
 
     def is_expired(self) -> bool:
         return time.time() > self.expires_at
 
+    def is_stale_usable(self) -> bool:
+        return time.time() <= self.stale_until
+
 
 class CacheAgent(Agent):
-    """Агент для кеширования данных в памяти."""
+    """
+    Агент для кеширования данных в памяти.
+
+    Кеш ограничен по числу записей и по объему: при переполнении вытесняются давно
+    не использованные записи (LRU). Истекшие записи удаляются порциями по куче
+    времен истечения, без полного прохода по кешу.
+
+    get_or_set объединяет одновременные промахи по одному ключу в один вызов getter,
+    а при заданном cache_stale_ttl отдает истекшее значение, обновляя его в фоне.
+    Результат None кешируется как NOT_FOUND только при переданном negative_ttl.
+    """
 
     def __init__(self):
-        self.cache: dict[str, CacheEntry] = {}
+        self.cache: OrderedDict[str, CacheEntry] = OrderedDict()
         self.default_ttl = 300
+        self.cleanup_interval = 60
+        self.cleanup_batch_size = 1000
+        self.max_entries = 100_000
+        self.max_bytes = 256 * 1024 * 1024
+        self.stale_ttl = 0
+        self.negative_ttl = 5
+        self.total_bytes = 0
+        self.expiry_heap: list[tuple[float, str]] = []
+        self.inflight: dict[str, asyncio.Task] = {}
         self.cleanup_task = None
+        self.logger = logging.getLogger(__name__)
 
     async def initialize(self, config: dict[str, Any]) -> None:
         self.default_ttl = config.get('cache_ttl', 300)
         self.cleanup_interval = config.get('cache_cleanup_interval', 60)
+        self.cleanup_batch_size = config.get('cache_cleanup_batch_size', 1000)
+        self.max_entries = config.get('cache_max_entries', 100_000)
+        self.max_bytes = config.get('cache_max_bytes', 256 * 1024 * 1024)
+        self.stale_ttl = config.get('cache_stale_ttl', 0)
+        self.negative_ttl = config.get('cache_negative_ttl', 5)
         self.cleanup_task = asyncio.create_task(self._cleanup_loop())
 
         CACHE_SIZE.set(0)
+        CACHE_BYTES.set(0)
 
     async def shutdown(self) -> None:
         if self.cleanup_task:
@@ -46,50 +106,277 @@ class CacheAgent(Agent):
         while True:
             try:
                 await asyncio.sleep(self.cleanup_interval)
-                self._cleanup_expired()
-                CACHE_SIZE.set(len(self.cache))
+                # Удаляем истекшие записи порциями, отдавая управление между ними
+                while self._cleanup_expired():
+                    await asyncio.sleep(0)
             except asyncio.CancelledError:
                 break
             except Exception as e:
                 print(f'Error in cache cleanup: {e}')
 
-    def _cleanup_expired(self) -> None:
-        expired_keys = [k for k, v in self.cache.items() if v.is_expired()]
-        for key in expired_keys:
-            del self.cache[key]
+    def _cleanup_expired(self) -> bool:
+        """
+        Удаляет не более cleanup_batch_size истекших записей.
+        Возвращает True, если в куче еще остались истекшие записи.
+        """
+        now = time.time()
+        processed = 0
+
+        while self.expiry_heap and self.expiry_heap[0][0] < now:
+            if processed >= self.cleanup_batch_size:
+                return True
+
+            expires_at, key = heapq.heappop(self.expiry_heap)
+            processed += 1
+
+            # Запись могла быть перезаписана с новым сроком или уже удалена
+            entry = self.cache.get(key)
+            if entry is not None and entry.stale_until == expires_at:
+                self._remove(key)
+                CACHE_EVICTIONS.labels(reason='expired').inc()
+
+        # Перестраиваем кучу, если в ней накопилось много устаревших ссылок
+        if len(self.expiry_heap) > 2 * len(self.cache) + self.cleanup_batch_size:
+            self.expiry_heap = [(entry.stale_until, key) for key, entry in self.cache.items()]
+            heapq.heapify(self.expiry_heap)
 
+        self._update_size_metrics()
+        return False
+
+    def _remove(self, key: str) -> None:
+        entry = self.cache.pop(key)
+        self.total_bytes -= entry.size
+
+    def _evict(self) -> None:
+        while self.cache and len(self.cache) > self.max_entries:
+            self._remove(next(iter(self.cache)))
+            CACHE_EVICTIONS.labels(reason='capacity').inc()
+
+        while self.cache and self.total_bytes > self.max_bytes:
+            self._remove(next(iter(self.cache)))
+            CACHE_EVICTIONS.labels(reason='memory').inc()
+
+    def _update_size_metrics(self) -> None:
         CACHE_SIZE.set(len(self.cache))
+        CACHE_BYTES.set(self.total_bytes)
 
     def get(self, key: str) -> Optional[Any]:
         entry = self.cache.get(key)
         if entry is None or entry.is_expired():
-            if entry is not None:
-                del self.cache[key]
-                CACHE_SIZE.set(len(self.cache))
+            # Устаревшая запись остается для get_or_set, пока не вышел stale_ttl
+            if entry is not None and not entry.is_stale_usable():
+                self._remove(key)
+                CACHE_EVICTIONS.labels(reason='expired').inc()
+                self._update_size_metrics()
             CACHE_MISSES.inc()
             return None
 
+        self.cache.move_to_end(key)
+        return self._hit(entry)
+
+    def _hit(self, entry: CacheEntry) -> Optional[Any]:
+        if entry.value is NOT_FOUND:
+            CACHE_NEGATIVE_HITS.inc()
+            return None
+
         CACHE_HITS.inc()
         return entry.value
 
-    def set(self, key: str, value: Any, ttl: Optional[int] = None) -> None:
+    def set(
+        self,
+        key: str,
+        value: Any,
+        ttl: Optional[int] = None,
+        stale_ttl: Optional[int] = None,
+    ) -> None:
+        # Явно записанное значение свежее любой загрузки, начатой до него
+        self.inflight.pop(key, None)
+        self._store(key, value, ttl, stale_ttl)
+
+    def set_if_newer(self, key: str, value: Any) -> bool:
+        """
+        Записывает значение с атрибутом version, если в кеше нет значения той же или
+        более новой версии: изменения от других реплик могут приходить не по порядку.
+        Возвращает False, если значение устарело и не записано.
+        """
+        entry = self.cache.get(key)
+        current = getattr(entry.value, 'version', None) if entry is not None else None
+        if current is not None and current >= value.version:
+            return False
+
+        self.set(key, value)
+        return True
+
+    def _store(
+        self, key: str, value: Any, ttl: Optional[int], stale_ttl: Optional[int] = None
+    ) -> None:
         if ttl is None:
             ttl = self.default_ttl
-        self.cache[key] = CacheEntry(value, ttl)
+        if stale_ttl is None:
+            stale_ttl = self.stale_ttl
 
-        CACHE_SIZE.set(len(self.cache))
+        if key in self.cache:
+            self._remove(key)
+
+        entry = CacheEntry(value, ttl, estimate_size(key, value), stale_ttl)
+        self.cache[key] = entry
+        self.total_bytes += entry.size
+        heapq.heappush(self.expiry_heap, (entry.stale_until, key))
+
+        self._evict()
+        self._update_size_metrics()
 
     def delete(self, key: str) -> None:
+        # Загрузка, начатая до инвалидации, не должна записать в кеш старое значение
+        self.inflight.pop(key, None)
+
         if key in self.cache:
-            del self.cache[key]
+            self._remove(key)
+
+            self._update_size_metrics()
 
-            CACHE_SIZE.set(len(self.cache))
+    def clear(self) -> None:
+        """Сбрасывает все записи и отменяет запись результатов начатых загрузок."""
+        self.inflight.clear()
+        self.cache.clear()
+        self.expiry_heap.clear()
+        self.total_bytes = 0
+        self._update_size_metrics()
 
     async def get_or_set(
-        self, key: str, getter: Callable[[], Awaitable[T]], ttl: Optional[int] = None
-    ) -> T:
-        value = self.get(key)
-        if value is None:
-            value = await getter()
-            self.set(key, value, ttl)
+        self,
+        key: str,
+        getter: Callable[[], Awaitable[T]],
+        ttl: Optional[int] = None,
+        negative_ttl: Optional[int] = None,
+    ) -> Optional[T]:
+        entry = self.cache.get(key)
+        if entry is not None and not entry.is_expired():
+            self.cache.move_to_end(key)
+            return self._hit(entry)
+
+        if entry is not None and entry.is_stale_usable():
+            CACHE_STALE_HITS.inc()
+            self._load(key, getter, ttl, negative_ttl)
+            return None if entry.value is NOT_FOUND else entry.value
+
+        CACHE_MISSES.inc()
+        # shield: отмена одного из ожидающих запросов не отменяет общую загрузку
+        return await asyncio.shield(self._load(key, getter, ttl, negative_ttl))
+
+    def _load(
+        self,
+        key: str,
+        getter: Callable[[], Awaitable[T]],
+        ttl: Optional[int],
+        negative_ttl: Optional[int],
+    ) -> asyncio.Task:
+        """Возвращает уже идущую загрузку ключа или запускает новую."""
+        task = self.inflight.get(key)
+        if task is not None:
+            CACHE_COALESCED.inc()
+            return task
+
+        task = asyncio.create_task(self._fetch(key, getter, ttl, negative_ttl))
+        self.inflight[key] = task
+        task.add_done_callback(lambda done: self._on_fetch_done(key, done))
+        return task
+
+    async def _fetch(
+        self,
+        key: str,
+        getter: Callable[[], Awaitable[T]],
+        ttl: Optional[int],
+        negative_ttl: Optional[int],
+    ) -> Optional[T]:
+        value = await getter()
+        if self.inflight.get(key) is not asyncio.current_task():
+            return value
+
+        if value is not None:
+            self._store(key, value, ttl)
+        elif negative_ttl:
+            # Отсутствие кешируется коротко и без окна устаревания
+            self._store(key, NOT_FOUND, negative_ttl, stale_ttl=0)
         return value
+
+    async def get_many_or_set(
+        self,
+        keys: list[str],
+        getter: Callable[[list[str]], Awaitable[dict[str, T]]],
+        ttl: Optional[int] = None,
+    ) -> dict[str, Optional[T]]:
+        """
+        Возвращает значения по списку ключей: попадания берутся из кеша, все промахи
+        загружаются одним вызовом getter, который получает список ключей и возвращает
+        словарь ключ -> значение.
+        """
+        results: dict[str, Optional[T]] = {}
+        missing = []
+        for key in dict.fromkeys(keys):
+            entry = self.cache.get(key)
+            if entry is not None and not entry.is_expired():
+                self.cache.move_to_end(key)
+                results[key] = self._hit(entry)
+            else:
+                CACHE_MISSES.inc()
+                missing.append(key)
+
+        if missing:
+            task = asyncio.create_task(self._fetch_many(missing, getter))
+            task.add_done_callback(lambda done: self._on_fetch_many_done(missing, done))
+            # Ключи, которые уже загружаются поштучно, не перехватываем: их значение
+            # все равно придет из этого же запроса, но записывать в кеш его будет та загрузка.
+            # Для остальных в inflight кладется загрузка одного ключа поверх общей, чтобы
+            # одновременный get_or_set получил значение ключа, а не весь словарь
+            key_tasks = []
+            for key in missing:
+                if key not in self.inflight:
+                    key_task = asyncio.create_task(self._fetch_from_many(key, task, ttl))
+                    self.inflight[key] = key_task
+                    key_task.add_done_callback(
+                        lambda done, key=key: self._on_fetch_from_many_done(key, done)
+                    )
+                    key_tasks.append(key_task)
+            results.update(await asyncio.shield(task))
+            # Значения попадают в кеш к возврату из метода
+            if key_tasks:
+                await asyncio.wait(key_tasks)
+
+        return results
+
+    async def _fetch_many(
+        self,
+        keys: list[str],
+        getter: Callable[[list[str]], Awaitable[dict[str, T]]],
+    ) -> dict[str, Optional[T]]:
+        values = await getter(keys)
+        return {key: values.get(key) for key in keys}
+
+    async def _fetch_from_many(
+        self, key: str, batch: asyncio.Task, ttl: Optional[int]
+    ) -> Optional[T]:
+        value = (await asyncio.shield(batch)).get(key)
+        if value is not None and self.inflight.get(key) is asyncio.current_task():
+            self._store(key, value, ttl)
+        return value
+
+    def _on_fetch_many_done(self, keys: list[str], task: asyncio.Task) -> None:
+        if not task.cancelled() and task.exception() is not None:
+            self.logger.warning(f'Cache load for {len(keys)} keys failed: {task.exception()}')
+
+    def _on_fetch_from_many_done(self, key: str, task: asyncio.Task) -> None:
+        if self.inflight.get(key) is task:
+            del self.inflight[key]
+
+        # Ошибка общей загрузки уже записана в лог ее обработчиком
+        if not task.cancelled():
+            task.exception()
+
+    def _on_fetch_done(self, key: str, task: asyncio.Task) -> None:
+        if self.inflight.get(key) is task:
+            del self.inflight[key]
+
+        # Ошибку фоновой загрузки некому получить - забираем ее здесь
+        if not task.cancelled() and task.exception() is not None:
+            self.logger.warning(f'Cache load for {key} failed: {task.exception()}')
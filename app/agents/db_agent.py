@@ -1,25 +1,166 @@
-from datetime import datetime
-from typing import Any, Optional
+import asyncio
+import contextlib
+import logging
+import os
+import re
+import time
+import uuid
+from collections import OrderedDict
+from collections.abc import AsyncIterator, Iterable
+from datetime import UTC, date, datetime
+from typing import Any, NamedTuple, Optional
 
 import asyncpg
 
+from app import migrations
 from app.agents import Agent
+from app.agents import movement_partitions as partitions
+from app.agents.db_queries import MOVEMENT_COLUMNS, build_queries
 from app.metrics import (
     DB_CONNECTIONS,
-    KAFKA_PROCESSING_TIME,
+    DB_KNOWN_ENTITIES,
+    DB_POOL_WAIT_TIME,
+    DB_QUERY_TIME,
+    KAFKA_MESSAGES_DUPLICATE,
     WAREHOUSE_PRODUCT_QUANTITY,
     Timer,
 )
+from app.migrations import MOVEMENT_TIME
 from app.models import MovementInfo, WarehouseProductInfo
 
 
+class MovementEvent(NamedTuple):
+    """Событие перемещения для пакетной записи в БД."""
+
+    movement_id: str
+    warehouse_id: str
+    event_type: str
+    timestamp: datetime
+    product_id: str
+    quantity: int
+    event_id: Optional[str] = None
+
+
+class SavedMovements(NamedTuple):
+    """Состояние перемещений и остатков после записи событий."""
+
+    movements: list[MovementInfo]
+    stock: list[WarehouseProductInfo]
+    # Идентификаторы событий, впервые записанных в журнал этим вызовом
+    event_ids: frozenset[str] = frozenset()
+
+
+# Ошибки, которые повторятся для события при любой попытке: некорректные данные и
+# нарушения ограничений. Остальные ошибки (обрыв соединения, таймаут, перезапуск БД)
+# не связаны с самим событием, и его обработку нужно повторить, а не пропускать
+EVENT_DATA_ERRORS = (ValueError, asyncpg.DataError, asyncpg.IntegrityConstraintViolationError)
+
+# Записи UUID, которые принимает PostgreSQL: 32 шестнадцатеричные цифры с необязательным
+# дефисом после каждой группы из четырех, целиком в фигурных скобках или без них
+UUID_FORMAT = re.compile(
+    r'(?P<brace>\{)?(?:[0-9a-f]{4}-?){7}[0-9a-f]{4}(?(brace)\})', re.IGNORECASE
+)
+
+
+def normalize_id(value: str, id_type: str) -> str:
+    """
+    Идентификатор в том виде, в котором его возвращает БД: в режиме uuid - каноническая
+    запись UUID. ValueError, если в БД такого идентификатора быть не может.
+    """
+    if id_type != 'uuid':
+        return value
+    if UUID_FORMAT.fullmatch(value) is None:
+        raise ValueError(f'Invalid UUID identifier: {value!r}')
+    return str(uuid.UUID(value))
+
+
+class KnownIdRegistry:
+    """
+    Ограниченный LRU-набор идентификаторов, которые уже точно есть в БД.
+    Позволяет не выполнять INSERT ... ON CONFLICT DO NOTHING для известных сущностей.
+    """
+
+    def __init__(self, entity: str, max_size: int):
+        self.entity = entity
+        self.max_size = max_size
+        self.ids: OrderedDict[str, None] = OrderedDict()
+
+    def __contains__(self, entity_id: str) -> bool:
+        if entity_id in self.ids:
+            self.ids.move_to_end(entity_id)
+            DB_KNOWN_ENTITIES.labels(entity=self.entity, result='hit').inc()
+            return True
+
+        DB_KNOWN_ENTITIES.labels(entity=self.entity, result='miss').inc()
+        return False
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def add(self, entity_id: str) -> None:
+        if self.max_size <= 0:
+            return
+
+        self.ids[entity_id] = None
+        self.ids.move_to_end(entity_id)
+        while len(self.ids) > self.max_size:
+            self.ids.popitem(last=False)
+
+    def update(self, entity_ids: Iterable[str]) -> None:
+        for entity_id in entity_ids:
+            self.add(entity_id)
+
+    def missing(self, entity_ids: Iterable[str]) -> list[str]:
+        """Отсортированный список идентификаторов, которых нет в реестре."""
+        return sorted(entity_id for entity_id in set(entity_ids) if entity_id not in self)
+
+
 class DBAgent(Agent):
     """Агент для работы с базой данных PostgreSQL."""
 
     def __init__(self):
         self.pool = None
+        self.known_warehouses = KnownIdRegistry('warehouse', 10_000)
+        self.known_products = KnownIdRegistry('product', 1_000_000)
+        self.logger = logging.getLogger(__name__)
+        self.processed_events_retention_days = 7
+        self.maintenance_interval = 3600
+        self.maintenance_task = None
+        self.export_prefetch = 1000
+        self.movements_partitioned = False
+        self.movements_partitions_ahead = 3
+        self.movements_retention_months = 0
+        self.movements_archive_dir = 'archive'
+        self.movements_detach_lock_timeout_ms = 1000
+        self.id_type = 'text'
+        self.queries = build_queries(self.id_type, self.movements_partitioned)
+        # Запросы, подготавливаемые на новых соединениях; пусто, пока схема не определена
+        self.prepared_queries: list[str] = []
+        self.prepare_statements = True
 
     async def initialize(self, config: dict[str, Any]) -> None:
+        self.processed_events_retention_days = config.get('processed_events_retention_days', 7)
+        self.maintenance_interval = config.get('db_maintenance_interval', 3600)
+        self.export_prefetch = config.get('db_export_prefetch', 1000)
+        self.movements_partitioned = config.get('db_movements_partitioned', False)
+        self.movements_partitions_ahead = config.get('db_movements_partitions_ahead', 3)
+        self.movements_retention_months = config.get('db_movements_retention_months', 0)
+        self.movements_archive_dir = config.get('db_movements_archive_dir', 'archive')
+        self.movements_detach_lock_timeout_ms = config.get(
+            'db_movements_detach_lock_timeout_ms', 1000
+        )
+        # PgBouncer в режиме transaction отдает каждую транзакцию любому серверному
+        # соединению, поэтому подготовленные выражения на нем использовать нельзя
+        pgbouncer = config.get('db_pgbouncer', False)
+        statement_cache_size = 0 if pgbouncer else config.get('db_statement_cache_size', 100)
+        self.prepare_statements = statement_cache_size > 0
+        self.known_warehouses = KnownIdRegistry(
+            'warehouse', config.get('db_known_warehouses_limit', 10_000)
+        )
+        self.known_products = KnownIdRegistry(
+            'product', config.get('db_known_products_limit', 1_000_000)
+        )
+
         self.pool = await asyncpg.create_pool(
             user=config.get('db_user', 'postgres'),
             password=config.get('db_password', 'postgres'),
@@ -28,140 +169,680 @@ class DBAgent(Agent):
             port=config.get('db_port', 5432),
             min_size=config.get('db_min_connections', 5),
             max_size=config.get('db_max_connections', 20),
+            init=self._init_connection,
+            statement_cache_size=statement_cache_size,
+            max_cached_statement_lifetime=config.get('db_statement_cache_lifetime', 300),
         )
+        DB_CONNECTIONS.set_pool(self.pool)
 
-        DB_CONNECTIONS.set(self.pool._queue.qsize())
-
-        # Создаем таблицы, если их еще нет
         async with self.pool.acquire() as conn:
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS warehouses (
-                    id VARCHAR(255) PRIMARY KEY
-                )
-            """)
+            # Построение индексов CONCURRENTLY на больших таблицах задержит старт,
+            # поэтому по умолчанию миграции выполняет отдельная задача
+            if config.get('db_migrate_on_startup', False):
+                await migrations.migrate(conn, config)
 
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS products (
-                    id VARCHAR(255) PRIMARY KEY
-                )
-            """)
-
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS warehouse_products (
-                    warehouse_id VARCHAR(255) REFERENCES warehouses(id),
-                    product_id VARCHAR(255) REFERENCES products(id),
-                    quantity INTEGER NOT NULL DEFAULT 0,
-                    PRIMARY KEY (warehouse_id, product_id)
+            version = await migrations.current_version(conn)
+            if version < migrations.LATEST_VERSION:
+                raise RuntimeError(
+                    f'Database schema version {version} is behind '
+                    f'{migrations.LATEST_VERSION}, run python -m app.migrations'
                 )
-            """)
-
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS movements (
-                    id VARCHAR(255) PRIMARY KEY,
-                    source_warehouse_id VARCHAR(255) NULL REFERENCES warehouses(id),
-                    destination_warehouse_id VARCHAR(255) NULL REFERENCES warehouses(id),
-                    departure_time TIMESTAMPTZ NULL,
-                    arrival_time TIMESTAMPTZ NULL,
-                    product_id VARCHAR(255) NOT NULL REFERENCES products(id),
-                    departure_quantity INTEGER NULL,
-                    arrival_quantity INTEGER NULL
-                )
-            """)
+
+            await self._detect_schema(conn)
+
+        self.queries = build_queries(self.id_type, self.movements_partitioned)
+        if self.prepare_statements:
+            self.prepared_queries = [name for name, query in self.queries.items() if query.prepare]
+            # Соединения, открытые до определения схемы, пересоздаются с подготовкой запросов
+            await self.pool.expire_connections()
+
+        if self.movements_partitioned:
+            await self.ensure_movement_partitions()
+
+        await self.warm_known_entities()
+
+        self.maintenance_task = asyncio.create_task(self._maintenance_loop())
 
         # Возвращаем пул для использования в health check
         return self.pool
 
+    async def _init_connection(self, conn: asyncpg.Connection) -> None:
+        # uuid передается и читается строкой: модели и ключи кеша работают с str
+        # одинаково в обоих режимах db_id_type
+        await conn.set_type_codec(
+            'uuid', encoder=str, decoder=str, schema='pg_catalog', format='text'
+        )
+
+        if not self.prepared_queries:
+            return
+
+        # Подготовленное выражение попадает в кеш соединения при первом выполнении
+        # запроса, поэтому горячие запросы выполняются один раз с NULL вместо всех
+        # параметров: такие запросы не находят и не меняют ни одной строки. Для
+        # надежности все выполняется в откатываемой транзакции
+        transaction = conn.transaction()
+        await transaction.start()
+        try:
+            for name in self.prepared_queries:
+                query = self.queries[name]
+                try:
+                    async with conn.transaction():
+                        await conn.fetch(query.sql, *[None] * query.parameters)
+                except asyncpg.PostgresError:
+                    # Например, NOT NULL для вставки одной строки: ошибка возникает при
+                    # выполнении, выражение к этому моменту уже в кеше
+                    pass
+        finally:
+            await transaction.rollback()
+
+    async def _query(
+        self, conn: asyncpg.Connection, method: str, name: str, *args: Any, sql: str = ''
+    ) -> Any:
+        """
+        Выполняет запрос реестра методом соединения method (fetch, fetchrow, fetchval,
+        execute) и замеряет его время. Динамически собираемые запросы передаются в sql
+        и учитываются в метриках под именем name.
+        """
+        with Timer(DB_QUERY_TIME, {'query': name}):
+            return await getattr(conn, method)(sql or self.queries[name].sql, *args)
+
+    async def _detect_schema(self, conn: asyncpg.Connection) -> None:
+        """Определяет тип идентификаторов и секционирование по фактической схеме."""
+        id_type = await conn.fetchval("""
+            SELECT data_type FROM information_schema.columns
+            WHERE table_schema = current_schema() AND table_name = 'warehouses'
+              AND column_name = 'id'
+        """)
+        self.id_type = 'uuid' if id_type == 'uuid' else 'text'
+
+        relkind = await conn.fetchval(
+            "SELECT relkind::text FROM pg_class WHERE oid = to_regclass('movements')"
+        )
+        partitioned = relkind == 'p'
+        if self.movements_partitioned and not partitioned:
+            # Существующую обычную таблицу на лету не переделать - нужен перенос данных
+            self.logger.warning(
+                'Table movements already exists and is not partitioned, partitioning is disabled'
+            )
+        self.movements_partitioned = partitioned
+
+    def _valid_ids(self, *ids: Optional[str]) -> bool:
+        """
+        Проверяет, что идентификаторы можно передать в запрос. В режиме uuid не-UUID
+        заведомо не найдется, а PostgreSQL отклонил бы его с ошибкой.
+        """
+        try:
+            for value in ids:
+                if value is not None:
+                    normalize_id(value, self.id_type)
+        except ValueError:
+            return False
+        return True
+
     async def shutdown(self) -> None:
+        if self.maintenance_task:
+            self.maintenance_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self.maintenance_task
         if self.pool:
+            DB_CONNECTIONS.set_pool(None)
             await self.pool.close()
 
-    async def ensure_warehouse_exists(self, warehouse_id: str) -> None:
-        async with self.pool.acquire() as conn:
-            await conn.execute(
-                'INSERT INTO warehouses (id) VALUES ($1) ON CONFLICT DO NOTHING',
-                warehouse_id,
+    async def _maintenance_loop(self) -> None:
+        while True:
+            try:
+                await asyncio.sleep(self.maintenance_interval)
+                await self.prune_processed_events()
+                if self.movements_partitioned:
+                    await self.ensure_movement_partitions()
+                    await self.archive_movement_partitions()
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                self.logger.error(f'Error in DB maintenance: {e}')
+
+    async def prune_processed_events(self) -> None:
+        """Удаляет из журнала события старше срока, в течение которого возможны повторы."""
+        async with self._connection() as conn:
+            await self._query(
+                conn, 'execute', 'prune_processed_events', self.processed_events_retention_days
             )
 
-            DB_CONNECTIONS.set(self.pool._queue.qsize())
+    async def ensure_movement_partitions(self) -> None:
+        """
+        Создает секции movements на текущий и movements_partitions_ahead следующих месяцев.
+        Строки этих месяцев, попавшие в секцию по умолчанию (события с временем далеко
+        в будущем), переносятся в новую секцию: иначе PostgreSQL не дает ее создать.
+        """
+        current = partitions.month_start(datetime.now(UTC).date())
+        async with self._connection() as conn:
+            # Блокировка не дает репликам создавать одни и те же секции одновременно
+            await conn.execute('SELECT pg_advisory_lock($1)', partitions.PARTITION_MAINTENANCE_LOCK)
+            try:
+                has_default = await conn.fetchval(
+                    "SELECT to_regclass('movements_default') IS NOT NULL"
+                )
+                for offset in range(self.movements_partitions_ahead + 1):
+                    month = partitions.add_months(current, offset)
+                    if has_default and await conn.fetchval(
+                        partitions.DEFAULT_HAS_ROWS_SQL,
+                        partitions.month_bound(month),
+                        partitions.month_bound(partitions.add_months(month, 1)),
+                    ):
+                        await self._create_partition_from_default(conn, month)
+                    else:
+                        await conn.execute(partitions.create_partition_sql(month))
+            finally:
+                await conn.execute(
+                    'SELECT pg_advisory_unlock($1)', partitions.PARTITION_MAINTENANCE_LOCK
+                )
 
-    async def ensure_product_exists(self, product_id: str) -> None:
-        async with self.pool.acquire() as conn:
+    async def _create_partition_from_default(self, conn: asyncpg.Connection, month: date) -> None:
+        """
+        Создает секцию отдельной таблицей, переносит в нее строки месяца из секции по
+        умолчанию и подключает. Секция по умолчанию на это время закрыта для записи,
+        чтобы в нее не попали новые строки месяца до подключения.
+        """
+        name = partitions.partition_name(month)
+        lower = partitions.month_bound(month)
+        upper = partitions.month_bound(partitions.add_months(month, 1))
+        async with conn.transaction():
+            await conn.execute('LOCK TABLE movements_default IN EXCLUSIVE MODE')
             await conn.execute(
-                'INSERT INTO products (id) VALUES ($1) ON CONFLICT DO NOTHING',
-                product_id,
+                f'CREATE TABLE {name} (LIKE movements INCLUDING DEFAULTS INCLUDING CONSTRAINTS)'
             )
+            moved = await conn.execute(
+                f'WITH moved AS ('
+                f'DELETE FROM movements_default WHERE moved_at >= $1 AND moved_at < $2 '
+                f'RETURNING *) INSERT INTO {name} SELECT * FROM moved',
+                lower,
+                upper,
+            )
+            await conn.execute(partitions.attach_partition_sql(month))
+        self.logger.warning(f'Moved {moved.split()[-1]} rows from movements_default to {name}')
 
-            DB_CONNECTIONS.set(self.pool._queue.qsize())
+    async def archive_movement_partitions(self) -> None:
+        """
+        Отсоединяет секции старше movements_retention_months месяцев, выгружает их
+        в movements_archive_dir в виде CSV, сжатого gzip, и удаляет вместе с маршрутами.
+        Секция, отсоединенная при прерванном прошлом запуске, дорабатывается. Так же
+        выгружаются и удаляются устаревшие строки секции по умолчанию.
 
-    async def get_warehouse_product_quantity(self, warehouse_id: str, product_id: str) -> int:
-        async with self.pool.acquire() as conn:
-            row = await conn.fetchrow(
-                'SELECT quantity FROM warehouse_products WHERE warehouse_id = $1 AND product_id = $2',  # noqa: E501
-                warehouse_id,
-                product_id,
-            )
+        Где возможно, секция отсоединяется с CONCURRENTLY. Иначе (PostgreSQL до 14 или
+        есть секция по умолчанию) DETACH берет ACCESS EXCLUSIVE на movements: блокировка
+        ждется не дольше movements_detach_lock_timeout_ms, чтобы ожидание не задержало
+        запросы, вставшие в очередь за ней, а секция отсоединяется при следующем запуске.
+        """
+        if not self.movements_retention_months:
+            return
 
-            DB_CONNECTIONS.set(self.pool._queue.qsize())
+        current = partitions.month_start(datetime.now(UTC).date())
+        cutoff = partitions.add_months(current, -self.movements_retention_months)
 
-            quantity = row['quantity'] if row else 0
+        async with self._connection() as conn:
+            # Архивацию выполняет одна реплика, остальные пропускают этот запуск
+            if not await conn.fetchval(
+                'SELECT pg_try_advisory_lock($1)', partitions.PARTITION_MAINTENANCE_LOCK
+            ):
+                return
 
-            WAREHOUSE_PRODUCT_QUANTITY.labels(warehouse_id=warehouse_id, product_id=product_id).set(
-                quantity
+            try:
+                concurrently = await conn.fetchval(partitions.DETACH_CONCURRENTLY_SQL)
+                rows = await conn.fetch(
+                    partitions.LIST_PARTITIONS_SQL.format(
+                        detach_pending='coalesce(i.inhdetachpending, false)'
+                        if concurrently
+                        else 'false'
+                    )
+                )
+
+                for row in sorted(rows, key=lambda r: r['relname']):
+                    month = partitions.partition_month(row['relname'])
+                    if month is None or partitions.add_months(month, 1) > cutoff:
+                        continue
+
+                    await self._archive_movement_partition(
+                        conn, month, row['attached'], row['detach_pending'], concurrently
+                    )
+
+                await self._archive_default_movements(conn, cutoff)
+            finally:
+                await conn.execute(
+                    'SELECT pg_advisory_unlock($1)', partitions.PARTITION_MAINTENANCE_LOCK
+                )
+
+    async def _archive_movement_partition(
+        self,
+        conn: asyncpg.Connection,
+        month: date,
+        attached: bool,
+        detach_pending: bool,
+        concurrently: bool,
+    ) -> None:
+        name = partitions.partition_name(month)
+        if attached and not await self._detach_movement_partition(
+            conn, name, detach_pending, concurrently
+        ):
+            return
+
+        os.makedirs(self.movements_archive_dir, exist_ok=True)
+        csv_path = os.path.join(self.movements_archive_dir, f'{name}.csv')
+        archive_path = f'{csv_path}.gz'
+        await conn.copy_from_table(name, output=csv_path, format='csv', header=True)
+        # Сжатие - в отдельном потоке, чтобы не блокировать цикл событий
+        await asyncio.to_thread(partitions.gzip_file, csv_path, archive_path)
+
+        async with conn.transaction():
+            await conn.execute(f'DROP TABLE {name}')
+            # Маршруты строк, оставшихся в секции по умолчанию, сохраняются
+            await conn.execute(
+                """
+                DELETE FROM movement_routes r
+                WHERE r.moved_at >= $1 AND r.moved_at < $2
+                  AND NOT EXISTS (
+                      SELECT 1 FROM movements m WHERE m.id = r.id AND m.moved_at = r.moved_at
+                  )
+            """,
+                partitions.month_bound(month),
+                partitions.month_bound(partitions.add_months(month, 1)),
             )
 
-            return quantity
+        self.logger.info(f'Movements partition {name} archived to {archive_path}')
 
-    async def update_warehouse_product_quantity(
-        self, warehouse_id: str, product_id: str, quantity_change: int
-    ) -> int:
-        await self.ensure_warehouse_exists(warehouse_id)
-        await self.ensure_product_exists(product_id)
+    async def _detach_movement_partition(
+        self, conn: asyncpg.Connection, name: str, detach_pending: bool, concurrently: bool
+    ) -> bool:
+        """Отсоединяет секцию; False, если блокировку movements получить не удалось."""
+        # Выполняется вне транзакции - в транзакции CONCURRENTLY и FINALIZE недоступны
+        if detach_pending:
+            await conn.execute(f'ALTER TABLE movements DETACH PARTITION {name} FINALIZE')
+            return True
+        if concurrently:
+            await conn.execute(f'ALTER TABLE movements DETACH PARTITION {name} CONCURRENTLY')
+            return True
 
-        async with self.pool.acquire() as conn:
+        try:
             async with conn.transaction():
-                # Получаем текущее количество
-                current_quantity = await self.get_warehouse_product_quantity(
-                    warehouse_id, product_id
+                await conn.execute(
+                    f'SET LOCAL lock_timeout = {int(self.movements_detach_lock_timeout_ms)}'
                 )
+                await conn.execute(f'ALTER TABLE movements DETACH PARTITION {name}')
+        except asyncpg.LockNotAvailableError:
+            self.logger.warning(f'Movements table is busy, partition {name} will be archived later')
+            return False
+        return True
 
-                # Вычисляем новое количество
-                new_quantity = current_quantity + quantity_change
+    async def _archive_default_movements(self, conn: asyncpg.Connection, cutoff: date) -> None:
+        """
+        Выгружает и удаляет строки секции по умолчанию, время которых старше cutoff.
+        Удаление строк берет только блокировки строк, а не всей таблицы.
+        """
+        if not await conn.fetchval("SELECT to_regclass('movements_default') IS NOT NULL"):
+            return
 
-                # Проверяем, что количество не станет отрицательным
-                if new_quantity < 0:
-                    raise ValueError(
-                        f'Cannot have negative quantity for product {product_id} at warehouse {warehouse_id}'  # noqa: E501
-                    )
+        os.makedirs(self.movements_archive_dir, exist_ok=True)
+        # Запусков за месяц бывает несколько - имя файла включает время выгрузки
+        name = f'movements_default_{datetime.now(UTC):%Y%m%d%H%M%S}'
+        csv_path = os.path.join(self.movements_archive_dir, f'{name}.csv')
+        bound = partitions.month_bound(cutoff)
 
-                # Обновляем или вставляем новое значение
+        # Строки удаляются в той же транзакции, в которой выгружаются
+        async with conn.transaction():
+            status = await conn.copy_from_query(
+                'DELETE FROM movements_default WHERE moved_at < $1 RETURNING *',
+                bound,
+                output=csv_path,
+                format='csv',
+                header=True,
+            )
+            archived = int(status.split()[-1])
+            if archived:
                 await conn.execute(
                     """
-                    INSERT INTO warehouse_products (warehouse_id, product_id, quantity)
-                    VALUES ($1, $2, $3)
-                    ON CONFLICT (warehouse_id, product_id)
-                    DO UPDATE SET quantity = $3
+                    DELETE FROM movement_routes r
+                    WHERE r.moved_at < $1
+                      AND NOT EXISTS (
+                          SELECT 1 FROM movements m WHERE m.id = r.id AND m.moved_at = r.moved_at
+                      )
                 """,
-                    warehouse_id,
-                    product_id,
-                    new_quantity,
+                    bound,
                 )
 
-                DB_CONNECTIONS.set(self.pool._queue.qsize())
+        if not archived:
+            os.remove(csv_path)
+            return
+
+        archive_path = f'{csv_path}.gz'
+        await asyncio.to_thread(partitions.gzip_file, csv_path, archive_path)
+        self.logger.info(
+            f'{archived} movements from the default partition archived to {archive_path}'
+        )
+
+    async def warm_known_entities(self) -> None:
+        """Заполняет реестры известных складов и товаров из таблиц при старте."""
+        async with self._connection() as conn:
+            rows = await self._query(
+                conn, 'fetch', 'list_warehouse_ids', self.known_warehouses.max_size
+            )
+            self.known_warehouses.update(row['id'] for row in rows)
+
+            rows = await self._query(
+                conn, 'fetch', 'list_product_ids', self.known_products.max_size
+            )
+            self.known_products.update(row['id'] for row in rows)
+
+        self.logger.info(
+            f'Known entities loaded: {len(self.known_warehouses)} warehouses, '
+            f'{len(self.known_products)} products'
+        )
+
+    def _remember_entities(self, warehouse_ids: Iterable[str], product_ids: Iterable[str]) -> None:
+        """Запоминает сущности после фиксации транзакции, в которой они были созданы."""
+        self.known_warehouses.update(warehouse_ids)
+        self.known_products.update(product_ids)
+
+    @contextlib.asynccontextmanager
+    async def _connection(
+        self, conn: Optional[asyncpg.Connection] = None
+    ) -> AsyncIterator[asyncpg.Connection]:
+        """
+        Возвращает переданное соединение вызывающего или берет новое из пула,
+        замеряя время ожидания свободного соединения.
+        """
+        if conn is not None:
+            yield conn
+            return
+
+        start_time = time.perf_counter()
+        async with self.pool.acquire() as acquired:
+            DB_POOL_WAIT_TIME.observe(time.perf_counter() - start_time)
+            yield acquired
+
+    async def ensure_warehouse_exists(
+        self, warehouse_id: str, conn: Optional[asyncpg.Connection] = None
+    ) -> None:
+        """
+        Создает склад, если его нет. Если передано соединение вызывающего, склад
+        запоминается в реестре только вызывающим после фиксации его транзакции.
+        """
+        if warehouse_id in self.known_warehouses:
+            return
+
+        async with self._connection(conn) as connection:
+            await self._query(connection, 'execute', 'insert_warehouse', warehouse_id)
+
+        if conn is None:
+            self.known_warehouses.add(warehouse_id)
+
+    async def ensure_product_exists(
+        self, product_id: str, conn: Optional[asyncpg.Connection] = None
+    ) -> None:
+        """Создает товар, если его нет. Регистрация в реестре - как в ensure_warehouse_exists."""
+        if product_id in self.known_products:
+            return
+
+        async with self._connection(conn) as connection:
+            await self._query(connection, 'execute', 'insert_product', product_id)
+
+        if conn is None:
+            self.known_products.add(product_id)
+
+    async def get_warehouse_product_quantity(
+        self, warehouse_id: str, product_id: str, conn: Optional[asyncpg.Connection] = None
+    ) -> int:
+        if not self._valid_ids(warehouse_id, product_id):
+            return 0
+
+        async with self._connection(conn) as conn:
+            row = await self._query(conn, 'fetchrow', 'get_quantity', warehouse_id, product_id)
+
+            return row['quantity'] if row else 0
 
-                WAREHOUSE_PRODUCT_QUANTITY.labels(
-                    warehouse_id=warehouse_id, product_id=product_id
-                ).set(new_quantity)
+    async def update_warehouse_product_quantity(
+        self,
+        warehouse_id: str,
+        product_id: str,
+        quantity_change: int,
+        conn: Optional[asyncpg.Connection] = None,
+    ) -> int:
+        """
+        Атомарно изменяет остаток одним запросом и возвращает новое значение.
+        Если передано соединение, все запросы выполняются на нем (в транзакции вызывающего).
+        """
+        async with self._connection(conn) as connection:
+            await self.ensure_warehouse_exists(warehouse_id, connection)
+            await self.ensure_product_exists(product_id, connection)
+
+            new_quantity, _ = await self._apply_quantity_change(
+                connection, warehouse_id, product_id, quantity_change
+            )
+
+        if conn is None:
+            self._remember_entities([warehouse_id], [product_id])
+
+        return new_quantity
+
+    async def _apply_quantity_change(
+        self, conn: asyncpg.Connection, warehouse_id: str, product_id: str, quantity_change: int
+    ) -> tuple[int, int]:
+        """Изменяет остаток и возвращает новые количество и версию строки."""
+        # Списание возможно только с существующей строки и только в пределах остатка
+        name = 'add_quantity' if quantity_change >= 0 else 'subtract_quantity'
+        row = await self._query(conn, 'fetchrow', name, warehouse_id, product_id, quantity_change)
+
+        if row is None:
+            raise ValueError(
+                f'Cannot have negative quantity for product {product_id} at warehouse {warehouse_id}'  # noqa: E501
+            )
+
+        WAREHOUSE_PRODUCT_QUANTITY.set(warehouse_id, product_id, row['quantity'])
 
-                return new_quantity
+        return row['quantity'], row['version']
 
     async def get_warehouse_product_info(
-        self, warehouse_id: str, product_id: str
+        self, warehouse_id: str, product_id: str, conn: Optional[asyncpg.Connection] = None
     ) -> WarehouseProductInfo:
-        quantity = await self.get_warehouse_product_quantity(warehouse_id, product_id)
-        return WarehouseProductInfo(
-            warehouse_id=warehouse_id, product_id=product_id, quantity=quantity
+        info = WarehouseProductInfo(warehouse_id=warehouse_id, product_id=product_id, quantity=0)
+        if not self._valid_ids(warehouse_id, product_id):
+            return info
+
+        async with self._connection(conn) as conn:
+            row = await self._query(conn, 'fetchrow', 'get_quantity', warehouse_id, product_id)
+
+        if row:
+            info.quantity = row['quantity']
+            info.version = row['version']
+        return info
+
+    async def get_warehouse_products_info(
+        self, pairs: list[tuple[str, str]], conn: Optional[asyncpg.Connection] = None
+    ) -> list[WarehouseProductInfo]:
+        """
+        Остатки по списку пар (склад, товар) одним запросом, в порядке запроса.
+        Для пар без записи в warehouse_products возвращается нулевое количество.
+        """
+        if not pairs:
+            return []
+
+        # БД возвращает идентификаторы в канонической записи - по ней и ищем строки
+        normalized = {}
+        for warehouse_id, product_id in pairs:
+            with contextlib.suppress(ValueError):
+                normalized[warehouse_id, product_id] = (
+                    normalize_id(warehouse_id, self.id_type),
+                    normalize_id(product_id, self.id_type),
+                )
+
+        async with self._connection(conn) as conn:
+            rows = await self._query(
+                conn,
+                'fetch',
+                'get_quantities',
+                [warehouse_id for warehouse_id, _ in normalized.values()],
+                [product_id for _, product_id in normalized.values()],
+            )
+
+        found = {(row['warehouse_id'], row['product_id']): row for row in rows}
+        result = []
+        for warehouse_id, product_id in pairs:
+            row = found.get(normalized.get((warehouse_id, product_id)))
+            result.append(
+                WarehouseProductInfo(
+                    warehouse_id=warehouse_id,
+                    product_id=product_id,
+                    quantity=row['quantity'] if row else 0,
+                    version=row['version'] if row else 0,
+                )
+            )
+        return result
+
+    async def list_warehouse_products(
+        self,
+        warehouse_id: str,
+        after_product_id: Optional[str] = None,
+        limit: int = 100,
+        in_stock: bool = False,
+        conn: Optional[asyncpg.Connection] = None,
+    ) -> list[WarehouseProductInfo]:
+        """
+        Страница остатков склада, упорядоченная по product_id. Следующая страница
+        запрашивается с after_product_id последней записи: поиск идет по первичному
+        ключу (warehouse_id, product_id) без сканирования пропущенных строк.
+        """
+        if not self._valid_ids(warehouse_id, after_product_id):
+            return []
+
+        conditions = ['warehouse_id = $1']
+        args: list[Any] = [warehouse_id]
+        if after_product_id is not None:
+            args.append(after_product_id)
+            conditions.append(f'product_id > ${len(args)}')
+        if in_stock:
+            conditions.append('quantity > 0')
+        args.append(limit)
+
+        async with self._connection(conn) as conn:
+            rows = await self._query(
+                conn,
+                'fetch',
+                'list_warehouse_products',
+                *args,
+                sql=f"""
+                SELECT product_id, quantity
+                FROM warehouse_products
+                WHERE {' AND '.join(conditions)}
+                ORDER BY product_id
+                LIMIT ${len(args)}
+            """,
+            )
+
+        return [
+            WarehouseProductInfo(
+                warehouse_id=warehouse_id, product_id=row['product_id'], quantity=row['quantity']
+            )
+            for row in rows
+        ]
+
+    async def search_movements(
+        self,
+        warehouse_id: Optional[str] = None,
+        product_id: Optional[str] = None,
+        time_from: Optional[datetime] = None,
+        time_to: Optional[datetime] = None,
+        after: Optional[tuple[datetime, str]] = None,
+        limit: int = 100,
+        conn: Optional[asyncpg.Connection] = None,
+    ) -> list[MovementInfo]:
+        """
+        Поиск перемещений, упорядоченных по времени перемещения и id.
+        warehouse_id совпадает как со складом-отправителем, так и с получателем;
+        after - ключ (время, id) последней записи предыдущей страницы.
+        """
+        if not self._valid_ids(warehouse_id, product_id, after[1] if after else None):
+            return []
+
+        args: list[Any] = []
+
+        def param(value: Any) -> str:
+            args.append(value)
+            return f'${len(args)}'
+
+        # Секция выбирается по moved_at - времени первого полученного события. Оно не
+        # раньше времени перемещения (отправление предшествует прибытию), поэтому нижние
+        # границы времени повторяются для moved_at и отсекают более старые секции
+        lower_bounds = []
+        conditions = []
+        if product_id is not None:
+            conditions.append(f'product_id = {param(product_id)}')
+        if time_from is not None:
+            lower_bounds.append(param(time_from))
+            conditions.append(f'{MOVEMENT_TIME} >= {lower_bounds[-1]}')
+        if time_to is not None:
+            conditions.append(f'{MOVEMENT_TIME} < {param(time_to)}')
+        if after is not None:
+            lower_bounds.append(param(after[0]))
+            conditions.append(f'({MOVEMENT_TIME}, id) > ({lower_bounds[-1]}, {param(after[1])})')
+        if self.movements_partitioned:
+            conditions.extend(f'moved_at >= {bound}' for bound in lower_bounds)
+        limit_ph = param(limit)
+        order = f'ORDER BY {MOVEMENT_TIME}, id LIMIT {limit_ph}'
+
+        if warehouse_id is None:
+            where = f'WHERE {" AND ".join(conditions)}' if conditions else ''
+            query = f'SELECT * FROM movements {where} {order}'
+        else:
+            # OR по двум колонкам не дает упорядоченного чтения индекса, поэтому каждая
+            # сторона читается своим индексом и результаты сливаются
+            warehouse = param(warehouse_id)
+            sides = [
+                f'(SELECT * FROM movements WHERE '
+                f'{" AND ".join([f"{column} = {warehouse}", *conditions])} {order})'
+                for column in ('source_warehouse_id', 'destination_warehouse_id')
+            ]
+            query = (
+                f'SELECT * FROM ({sides[0]} UNION {sides[1]}) m '
+                f'ORDER BY {MOVEMENT_TIME}, id LIMIT {limit_ph}'
+            )
+
+        async with self._connection(conn) as conn:
+            rows = await self._query(conn, 'fetch', 'search_movements', *args, sql=query)
+
+        return [self._movement_info_from_row(row) for row in rows]
+
+    def export_warehouse_products(self) -> AsyncIterator[str]:
+        """Все остатки строками JSON, в порядке первичного ключа."""
+        return self._export_json(
+            'SELECT row_to_json(t)::text FROM warehouse_products t '
+            'ORDER BY warehouse_id, product_id'
+        )
+
+    def export_movements(self) -> AsyncIterator[str]:
+        """Все перемещения строками JSON, в порядке id."""
+        return self._export_json('SELECT row_to_json(t)::text FROM movements t ORDER BY id')
+
+    def iter_warehouse_products(self) -> AsyncIterator[asyncpg.Record]:
+        """Все остатки строками (warehouse_id, product_id, quantity, version)."""
+        return self._iter_rows(
+            'SELECT warehouse_id, product_id, quantity, version FROM warehouse_products'
         )
 
+    async def _export_json(self, query: str) -> AsyncIterator[str]:
+        """JSON строится на стороне PostgreSQL, см. _iter_rows."""
+        async for row in self._iter_rows(query):
+            yield row[0]
+
+    async def _iter_rows(self, query: str) -> AsyncIterator[asyncpg.Record]:
+        """
+        Читает результат запроса серверным курсором порциями по export_prefetch строк.
+        Следующая порция запрашивается, только когда потребитель забрал предыдущую,
+        поэтому память не зависит от размера таблицы.
+        """
+        async with self._connection() as conn:
+            # Курсор живет внутри транзакции; repeatable read дает согласованный снимок
+            async with conn.transaction(isolation='repeatable_read', readonly=True):
+                async for row in conn.cursor(query, prefetch=self.export_prefetch):
+                    yield row
+
     async def save_movement_event(
         self,
         movement_id: str,
@@ -170,136 +851,280 @@ class DBAgent(Agent):
         timestamp: datetime,
         product_id: str,
         quantity: int,
-    ) -> None:
-        with Timer(KAFKA_PROCESSING_TIME, {'message_type': event_type}):
-            await self.ensure_warehouse_exists(warehouse_id)
-            await self.ensure_product_exists(product_id)
-
-            async with self.pool.acquire() as conn:
-                async with conn.transaction():
-                    # Проверяем, существует ли уже такое перемещение
-                    existing = await conn.fetchrow(
-                        'SELECT * FROM movements WHERE id = $1', movement_id
+        event_id: Optional[str] = None,
+        conn: Optional[asyncpg.Connection] = None,
+    ) -> Optional[SavedMovements]:
+        """
+        Сохраняет событие перемещения и возвращает новое состояние перемещения и остатка.
+        Если передан event_id и событие уже есть в журнале processed_events,
+        изменения не применяются и возвращается None.
+        """
+        # Все запросы события выполняются на одном соединении в одной транзакции
+        async with self._connection(conn) as conn:
+            async with conn.transaction():
+                # Журнал пишется в той же транзакции, что и изменение остатков
+                if event_id is not None and not await self._register_events(conn, [event_id]):
+                    KAFKA_MESSAGES_DUPLICATE.inc()
+                    return None
+
+                await self.ensure_warehouse_exists(warehouse_id, conn)
+                await self.ensure_product_exists(product_id, conn)
+
+                # Upsert вместо SELECT + INSERT/UPDATE: события отправки и прибытия
+                # одного перемещения могут обрабатываться параллельно
+                if event_type == 'departure':
+                    movement = self._movement_fields(product_id)
+                    movement['source_warehouse_id'] = warehouse_id
+                    movement['departure_time'] = timestamp
+                    movement['departure_quantity'] = quantity
+                    (row,) = await self._upsert_movements(conn, {movement_id: movement})
+
+                    # Обновляем количество товара на складе-отправителе
+                    new_quantity, version = await self._apply_quantity_change(
+                        conn, warehouse_id, product_id, -quantity
                     )
 
-                    if event_type == 'departure':
-                        if existing:
-                            # Обновляем существующую запись
-                            await conn.execute(
-                                """
-                                UPDATE movements
-                                SET source_warehouse_id = $1, departure_time = $2, departure_quantity = $3
-                                WHERE id = $4
-                            """,  # noqa: E501
-                                warehouse_id,
-                                timestamp,
-                                quantity,
-                                movement_id,
-                            )
-                        else:
-                            # Создаем новую запись
-                            await conn.execute(
-                                """
-                                INSERT INTO movements 
-                                (id, source_warehouse_id, departure_time, product_id, departure_quantity)
-                                VALUES ($1, $2, $3, $4, $5)
-                            """,  # noqa: E501
-                                movement_id,
-                                warehouse_id,
-                                timestamp,
-                                product_id,
-                                quantity,
-                            )
-
-                        # Обновляем количество товара на складе-отправителе
-                        await self.update_warehouse_product_quantity(
-                            warehouse_id, product_id, -quantity
-                        )
-
-                    elif event_type == 'arrival':
-                        if existing:
-                            # Обновляем существующую запись
-                            await conn.execute(
-                                """
-                                UPDATE movements
-                                SET destination_warehouse_id = $1, arrival_time = $2, arrival_quantity = $3
-                                WHERE id = $4
-                            """,  # noqa: E501
-                                warehouse_id,
-                                timestamp,
-                                quantity,
-                                movement_id,
-                            )
-                        else:
-                            # Создаем новую запись
-                            await conn.execute(
-                                """
-                                INSERT INTO movements 
-                                (id, destination_warehouse_id, arrival_time, product_id, arrival_quantity)
-                                VALUES ($1, $2, $3, $4, $5)
-                            """,  # noqa: E501
-                                movement_id,
-                                warehouse_id,
-                                timestamp,
-                                product_id,
-                                quantity,
-                            )
-
-                        # Обновляем количество товара на складе-получателе
-                        await self.update_warehouse_product_quantity(
-                            warehouse_id, product_id, quantity
-                        )
-
-                    DB_CONNECTIONS.set(self.pool._queue.qsize())
-
-    async def get_movement_info(self, movement_id: str) -> Optional[MovementInfo]:
-        async with self.pool.acquire() as conn:
-            row = await conn.fetchrow(
-                """
-                SELECT 
-                    id, 
-                    source_warehouse_id, 
-                    destination_warehouse_id, 
-                    departure_time, 
-                    arrival_time, 
-                    product_id, 
-                    departure_quantity, 
-                    arrival_quantity
-                FROM movements
-                WHERE id = $1
-            """,
-                movement_id,
+                elif event_type == 'arrival':
+                    movement = self._movement_fields(product_id)
+                    movement['destination_warehouse_id'] = warehouse_id
+                    movement['arrival_time'] = timestamp
+                    movement['arrival_quantity'] = quantity
+                    (row,) = await self._upsert_movements(conn, {movement_id: movement})
+
+                    # Обновляем количество товара на складе-получателе
+                    new_quantity, version = await self._apply_quantity_change(
+                        conn, warehouse_id, product_id, quantity
+                    )
+
+                else:
+                    return SavedMovements([], [])
+
+        self._remember_entities([warehouse_id], [product_id])
+
+        return SavedMovements(
+            movements=[self._movement_info_from_row(row)],
+            stock=[
+                WarehouseProductInfo(
+                    warehouse_id=warehouse_id,
+                    product_id=product_id,
+                    quantity=new_quantity,
+                    version=version,
+                )
+            ],
+            event_ids=frozenset([event_id]) if event_id is not None else frozenset(),
+        )
+
+    async def save_movement_events_batch(
+        self, events: list[MovementEvent], conn: Optional[asyncpg.Connection] = None
+    ) -> SavedMovements:
+        """
+        Сохраняет пачку событий перемещения набором set-based запросов в одной транзакции.
+
+        События одного перемещения сворачиваются в одну строку movements, изменения
+        остатков агрегируются по паре (склад, товар). События, уже записанные в журнал
+        processed_events, пропускаются. Возвращает новое состояние затронутых перемещений
+        и остатков.
+        Если хотя бы один остаток становится отрицательным, транзакция откатывается целиком.
+        """
+        async with self._connection(conn) as conn:
+            async with conn.transaction():
+                event_ids = list(
+                    dict.fromkeys(event.event_id for event in events if event.event_id is not None)
+                )
+                registered: frozenset[str] = frozenset()
+                if event_ids:
+                    new_ids = await self._register_events(conn, event_ids)
+                    registered = frozenset(new_ids)
+                    KAFKA_MESSAGES_DUPLICATE.inc(
+                        sum(1 for event in events if event.event_id is not None) - len(new_ids)
+                    )
+
+                    # Повторы внутри пачки и уже обработанные события отбрасываем
+                    unique_events = []
+                    for event in events:
+                        if event.event_id is None:
+                            unique_events.append(event)
+                        elif event.event_id in new_ids:
+                            unique_events.append(event)
+                            new_ids.discard(event.event_id)
+                    events = unique_events
+
+                saved = await self._write_movement_events(conn, events)
+                saved = saved._replace(event_ids=registered)
+
+        self._remember_entities(
+            (info.warehouse_id for info in saved.stock),
+            (info.product_id for info in saved.stock),
+        )
+
+        for info in saved.stock:
+            WAREHOUSE_PRODUCT_QUANTITY.set(info.warehouse_id, info.product_id, info.quantity)
+
+        return saved
+
+    async def _register_events(self, conn: asyncpg.Connection, event_ids: list[str]) -> set[str]:
+        """Записывает события в журнал и возвращает идентификаторы, которых там еще не было."""
+        rows = await self._query(conn, 'fetch', 'register_events', event_ids)
+        return {row['id'] for row in rows}
+
+    async def _write_movement_events(
+        self, conn: asyncpg.Connection, events: list[MovementEvent]
+    ) -> SavedMovements:
+        movements: dict[str, dict[str, Any]] = {}
+        deltas: dict[tuple[str, str], int] = {}
+        # Изменения остатка каждой пары в порядке событий
+        changes: dict[tuple[str, str], list[int]] = {}
+
+        for event in events:
+            movement = movements.setdefault(
+                event.movement_id, self._movement_fields(event.product_id)
             )
 
-            if not row:
-                return None
-
-            # Вычисляем время в пути, если известны оба временных штампа
-            transit_time_seconds = None
-            if row['departure_time'] and row['arrival_time']:
-                delta = row['arrival_time'] - row['departure_time']
-                transit_time_seconds = delta.total_seconds()
-
-            # Вычисляем разницу в количестве
-            quantity_difference = 0
-            if row['departure_quantity'] is not None and row['arrival_quantity'] is not None:
-                quantity_difference = row['arrival_quantity'] - row['departure_quantity']
-
-            # Определяем количество для отображения
-            quantity = (
-                row['departure_quantity']
-                if row['departure_quantity'] is not None
-                else row['arrival_quantity']
+            if event.event_type == 'departure':
+                movement['source_warehouse_id'] = event.warehouse_id
+                movement['departure_time'] = event.timestamp
+                movement['departure_quantity'] = event.quantity
+                delta = -event.quantity
+            elif event.event_type == 'arrival':
+                movement['destination_warehouse_id'] = event.warehouse_id
+                movement['arrival_time'] = event.timestamp
+                movement['arrival_quantity'] = event.quantity
+                delta = event.quantity
+            else:
+                continue
+
+            key = (event.warehouse_id, event.product_id)
+            deltas[key] = deltas.get(key, 0) + delta
+            changes.setdefault(key, []).append(delta)
+
+        if not deltas:
+            return SavedMovements([], [])
+
+        # Сортировка задает одинаковый порядок блокировок для параллельных транзакций
+        stock_keys = sorted(deltas)
+        warehouse_ids = self.known_warehouses.missing(
+            warehouse_id for warehouse_id, _ in stock_keys
+        )
+        product_ids = self.known_products.missing(product_id for _, product_id in stock_keys)
+
+        # Запросы выполняются только для сущностей, которых нет в реестре
+        if warehouse_ids:
+            await self._query(conn, 'execute', 'insert_warehouses', warehouse_ids)
+
+        if product_ids:
+            await self._query(conn, 'execute', 'insert_products', product_ids)
+
+        movement_rows = await self._upsert_movements(conn, movements)
+
+        try:
+            rows = await self._query(
+                conn,
+                'fetch',
+                'upsert_stock',
+                [warehouse_id for warehouse_id, _ in stock_keys],
+                [product_id for _, product_id in stock_keys],
+                [deltas[key] for key in stock_keys],
             )
+        except asyncpg.CheckViolationError as e:
+            raise ValueError(f'Cannot have negative quantity in batch: {e}') from e
 
-            return MovementInfo(
-                movement_id=row['id'],
-                source_warehouse=row['source_warehouse_id'],
-                destination_warehouse=row['destination_warehouse_id'],
-                departure_time=row['departure_time'],
-                arrival_time=row['arrival_time'],
-                transit_time_seconds=transit_time_seconds,
-                product_id=row['product_id'],
-                quantity=quantity,
-                quantity_difference=quantity_difference,
+        stock = []
+        for row in rows:
+            # Итог пачки бывает неотрицательным, хотя промежуточный остаток уходил в минус
+            # (отправление раньше прибытия при нулевом остатке). Поштучно такое отправление
+            # отклоняется, поэтому остаток проверяется после каждого события по порядку
+            key = (row['warehouse_id'], row['product_id'])
+            balance = lowest = row['quantity'] - deltas.get(key, 0)
+            for delta in changes.get(key, ()):
+                balance += delta
+                lowest = min(lowest, balance)
+            if min(lowest, row['quantity']) < 0:
+                raise ValueError(
+                    f'Cannot have negative quantity for product {row["product_id"]} at warehouse {row["warehouse_id"]}'  # noqa: E501
+                )
+            stock.append(
+                WarehouseProductInfo(
+                    warehouse_id=row['warehouse_id'],
+                    product_id=row['product_id'],
+                    quantity=row['quantity'],
+                    version=row['version'],
+                )
             )
+
+        return SavedMovements(
+            movements=[self._movement_info_from_row(row) for row in movement_rows],
+            stock=stock,
+        )
+
+    @staticmethod
+    def _movement_fields(product_id: str) -> dict[str, Any]:
+        return {
+            'product_id': product_id,
+            'source_warehouse_id': None,
+            'destination_warehouse_id': None,
+            'departure_time': None,
+            'arrival_time': None,
+            'departure_quantity': None,
+            'arrival_quantity': None,
+        }
+
+    async def _upsert_movements(
+        self, conn: asyncpg.Connection, movements: dict[str, dict[str, Any]]
+    ) -> list[asyncpg.Record]:
+        """
+        Записывает перемещения одним запросом: известные поля дополняют уже записанную
+        строку, а не затирают ее. Возвращает итоговые строки.
+        """
+        # Сортировка задает одинаковый порядок блокировок для параллельных транзакций
+        movement_ids = sorted(movements)
+        args = [
+            movement_ids,
+            *([movements[m][column] for m in movement_ids] for column in MOVEMENT_COLUMNS),
+        ]
+
+        # Для секционированной таблицы запрос также ведет маршруты movement_routes
+        return await self._query(conn, 'fetch', 'upsert_movements', *args)
+
+    async def get_movement_info(
+        self, movement_id: str, conn: Optional[asyncpg.Connection] = None
+    ) -> Optional[MovementInfo]:
+        if not self._valid_ids(movement_id):
+            return None
+
+        async with self._connection(conn) as conn:
+            row = await self._query(conn, 'fetchrow', 'get_movement', movement_id)
+
+        return self._movement_info_from_row(row) if row else None
+
+    @staticmethod
+    def _movement_info_from_row(row: asyncpg.Record) -> MovementInfo:
+        # Вычисляем время в пути, если известны оба временных штампа
+        transit_time_seconds = None
+        if row['departure_time'] and row['arrival_time']:
+            delta = row['arrival_time'] - row['departure_time']
+            transit_time_seconds = delta.total_seconds()
+
+        # Вычисляем разницу в количестве
+        quantity_difference = 0
+        if row['departure_quantity'] is not None and row['arrival_quantity'] is not None:
+            quantity_difference = row['arrival_quantity'] - row['departure_quantity']
+
+        # Определяем количество для отображения
+        quantity = (
+            row['departure_quantity']
+            if row['departure_quantity'] is not None
+            else row['arrival_quantity']
+        )
+
+        return MovementInfo(
+            movement_id=row['id'],
+            source_warehouse=row['source_warehouse_id'],
+            destination_warehouse=row['destination_warehouse_id'],
+            departure_time=row['departure_time'],
+            arrival_time=row['arrival_time'],
+            transit_time_seconds=transit_time_seconds,
+            product_id=row['product_id'],
+            quantity=quantity,
+            quantity_difference=quantity_difference,
+            version=row.get('version', 0),
+        )
@@ -0,0 +1,183 @@
+"""
+Реестр именованных запросов DBAgent.
+
+Текст запросов зависит от схемы (тип идентификаторов и секционирование movements),
+поэтому реестр строится после ее определения. Запросы выполняются обычными
+conn.fetch/fetchrow/fetchval: asyncpg держит подготовленные выражения в кеше
+соединения по тексту запроса, и повторное выполнение обходится без разбора и
+планирования заново. Горячие запросы (prepare=True) выполняются один раз при
+создании соединения, чтобы первое событие на новом соединении не платило за это.
+"""
+
+import re
+from typing import NamedTuple
+
+from app.migrations import MOVEMENT_TIME
+
+MOVEMENT_COLUMNS = (
+    'source_warehouse_id',
+    'destination_warehouse_id',
+    'departure_time',
+    'arrival_time',
+    'product_id',
+    'departure_quantity',
+    'arrival_quantity',
+)
+
+# {id} - тип массива идентификаторов, см. DBAgent.id_type
+MOVEMENTS_UNNEST = """unnest(
+    $1::{id}[], $2::{id}[], $3::{id}[], $4::timestamptz[],
+    $5::timestamptz[], $6::{id}[], $7::integer[], $8::integer[]
+)"""
+
+# Поля из события дополняют строку: NULL в EXCLUDED не затирает известное значение.
+# Версия строки растет с каждым изменением, см. migrations.add_row_versions
+MOVEMENTS_MERGE = ', '.join(
+    [
+        f'{column} = COALESCE(EXCLUDED.{column}, movements.{column})'
+        for column in MOVEMENT_COLUMNS
+        if column != 'product_id'
+    ]
+    + ['version = movements.version + 1']
+)
+
+
+PARAMETER = re.compile(r'\$(\d+)')
+
+
+class Query(NamedTuple):
+    sql: str
+    prepare: bool = False
+
+    @property
+    def parameters(self) -> int:
+        """Число параметров $n запроса."""
+        return max((int(n) for n in PARAMETER.findall(self.sql)), default=0)
+
+
+def build_queries(id_type: str, partitioned: bool) -> dict[str, Query]:
+    """Запросы DBAgent по имени для заданного типа идентификаторов и схемы movements."""
+    unnest = MOVEMENTS_UNNEST.format(id=id_type)
+    columns = ', '.join(MOVEMENT_COLUMNS)
+
+    if partitioned:
+        # Секция строки определяется временем первого события: маршрут создается при
+        # первой записи и дальше не меняется. DO UPDATE вместо DO NOTHING нужен, чтобы
+        # RETURNING вернул moved_at и для уже существующих, в том числе параллельно
+        # вставленных маршрутов
+        upsert_movements = f"""
+            WITH input AS (
+                SELECT * FROM {unnest}
+                AS t(id, {columns})
+            ),
+            route AS (
+                INSERT INTO movement_routes (id, moved_at)
+                SELECT id, {MOVEMENT_TIME} FROM input
+                ON CONFLICT (id) DO UPDATE SET moved_at = movement_routes.moved_at
+                RETURNING id, moved_at
+            )
+            INSERT INTO movements (id, moved_at, {columns})
+            SELECT input.id, route.moved_at, {', '.join(f'input.{c}' for c in MOVEMENT_COLUMNS)}
+            FROM input JOIN route ON route.id = input.id
+            ON CONFLICT (id, moved_at) DO UPDATE SET {MOVEMENTS_MERGE}
+            RETURNING *
+        """
+        # Маршрут дает moved_at, по которому запрос читает только одну секцию
+        get_movement = """
+            SELECT m.*
+            FROM movement_routes r
+            JOIN movements m ON m.id = r.id AND m.moved_at = r.moved_at
+            WHERE r.id = $1
+        """
+    else:
+        upsert_movements = f"""
+            INSERT INTO movements (id, {columns})
+            SELECT * FROM {unnest}
+            ON CONFLICT (id) DO UPDATE SET {MOVEMENTS_MERGE}
+            RETURNING *
+        """
+        get_movement = f'SELECT id, {columns}, version FROM movements WHERE id = $1'
+
+    return {
+        # Запись событий
+        'register_events': Query(
+            """
+            INSERT INTO processed_events (id)
+            SELECT unnest($1::text[])
+            ON CONFLICT DO NOTHING
+            RETURNING id
+        """,
+            prepare=True,
+        ),
+        'insert_warehouse': Query(
+            'INSERT INTO warehouses (id) VALUES ($1) ON CONFLICT DO NOTHING', prepare=True
+        ),
+        'insert_product': Query(
+            'INSERT INTO products (id) VALUES ($1) ON CONFLICT DO NOTHING', prepare=True
+        ),
+        'insert_warehouses': Query(
+            f'INSERT INTO warehouses (id) SELECT unnest($1::{id_type}[]) ON CONFLICT DO NOTHING',
+            prepare=True,
+        ),
+        'insert_products': Query(
+            f'INSERT INTO products (id) SELECT unnest($1::{id_type}[]) ON CONFLICT DO NOTHING',
+            prepare=True,
+        ),
+        'upsert_movements': Query(upsert_movements, prepare=True),
+        'add_quantity': Query(
+            """
+            INSERT INTO warehouse_products (warehouse_id, product_id, quantity)
+            VALUES ($1, $2, $3)
+            ON CONFLICT (warehouse_id, product_id)
+            DO UPDATE SET quantity = warehouse_products.quantity + EXCLUDED.quantity,
+                version = warehouse_products.version + 1
+            RETURNING quantity, version
+        """,
+            prepare=True,
+        ),
+        # Списание возможно только с существующей строки и только в пределах остатка
+        'subtract_quantity': Query(
+            """
+            UPDATE warehouse_products
+            SET quantity = quantity + $3, version = version + 1
+            WHERE warehouse_id = $1 AND product_id = $2 AND quantity + $3 >= 0
+            RETURNING quantity, version
+        """,
+            prepare=True,
+        ),
+        'upsert_stock': Query(
+            f"""
+            INSERT INTO warehouse_products (warehouse_id, product_id, quantity)
+            SELECT * FROM unnest($1::{id_type}[], $2::{id_type}[], $3::integer[])
+            ON CONFLICT (warehouse_id, product_id)
+            DO UPDATE SET quantity = warehouse_products.quantity + EXCLUDED.quantity,
+                version = warehouse_products.version + 1
+            RETURNING warehouse_id, product_id, quantity, version
+        """,
+            prepare=True,
+        ),
+        # Чтение
+        'get_quantity': Query(
+            'SELECT quantity, version FROM warehouse_products '
+            'WHERE warehouse_id = $1 AND product_id = $2',
+            prepare=True,
+        ),
+        # Пары передаются двумя массивами: поиск по ним идет по первичному ключу
+        'get_quantities': Query(
+            f"""
+            SELECT wp.warehouse_id, wp.product_id, wp.quantity, wp.version
+            FROM warehouse_products wp
+            JOIN unnest($1::{id_type}[], $2::{id_type}[])
+                AS p(warehouse_id, product_id)
+                ON wp.warehouse_id = p.warehouse_id AND wp.product_id = p.product_id
+        """,
+            prepare=True,
+        ),
+        'get_movement': Query(get_movement, prepare=True),
+        # Обслуживание
+        'prune_processed_events': Query(
+            "DELETE FROM processed_events WHERE processed_at < now() - $1 * interval '1 day'"
+        ),
+        'list_warehouse_ids': Query('SELECT id FROM warehouses LIMIT $1'),
+        'list_product_ids': Query('SELECT id FROM products LIMIT $1'),
+    }
@@ -0,0 +1,220 @@
+import asyncio
+import contextlib
+import json
+import logging
+import socket
+from collections.abc import Awaitable, Callable
+from typing import Any, Optional
+
+from aiokafka import AIOKafkaConsumer, TopicPartition
+from pydantic import BaseModel
+
+from app.agents import Agent
+from app.agents.kafka_agent import KafkaAgent
+from app.metrics import CACHE_INVALIDATIONS_PUBLISHED, CACHE_INVALIDATIONS_RECEIVED
+
+# Ключ кеша, новое значение (None - сбросить ключ) и версия строки в БД
+InvalidationHandler = Callable[[str, Optional[dict[str, Any]], Optional[int]], Awaitable[None]]
+
+# False - изменения других реплик сейчас не доходят; True - они могли быть пропущены
+# и состояние нужно перечитать из БД
+SyncHandler = Callable[[bool], None]
+
+
+class InvalidationAgent(Agent):
+    """
+    Агент для рассылки изменений кеша между репликами сервиса через Kafka.
+
+    Сообщения публикуются продюсером KafkaAgent в отдельный топик с ключом, равным ключу
+    кеша, поэтому топик можно держать компактируемым (cleanup.policy=compact): в нем
+    остается только последнее состояние каждого ключа. Каждая реплика читает топик
+    потребителем без группы: партиции назначаются вручную и читаются с конца - новой
+    реплике история не нужна, ее кеш пуст, а коммиты смещений не оставляют на брокере
+    группу за каждым перезапуском. Собственные сообщения реплика пропускает по instance_id.
+
+    Значения передаются вместе с версией строки в БД: сообщения об одной паре приходят
+    от разных реплик и могут переупорядочиваться, и получатель отбрасывает значения
+    старее уже известного.
+
+    Пропущенные изменения не исправит TTL: у проекции остатков его нет. Поэтому при
+    сбое чтения вызывается sync_handler(False), а после его восстановления -
+    sync_handler(True), чтобы реплика перечитала состояние из БД. Изменения, которые
+    не удалось отправить, копятся и отправляются повторно; если их слишком много,
+    вместо них рассылается команда перечитать состояние всем репликам.
+    """
+
+    def __init__(self, kafka_agent: KafkaAgent):
+        self.kafka_agent = kafka_agent
+        self.consumer = None
+        self.enabled = False
+        self.topic = 'warehouse_cache_invalidation'
+        self.instance_id = socket.gethostname()
+        self.retry_backoff = 5
+        self.max_pending = 100_000
+        # Неотправленные изменения по ключу; более новое значение заменяет старое
+        self.pending: dict[str, Optional[BaseModel]] = {}
+        self.resync_pending = False
+        self.connected = False
+        self.sync_handler: Optional[SyncHandler] = None
+        self.consume_task = None
+        self.retry_task = None
+        self.logger = logging.getLogger(__name__)
+
+    async def initialize(self, config: dict[str, Any]) -> None:
+        self.enabled = config.get('cache_invalidation_enabled', False)
+        if not self.enabled:
+            return
+
+        self.topic = config.get('cache_invalidation_topic', 'warehouse_cache_invalidation')
+        self.instance_id = config.get('instance_id') or socket.gethostname()
+        self.retry_backoff = config.get('cache_invalidation_retry_backoff', 5)
+        self.max_pending = config.get('cache_invalidation_max_pending', 100_000)
+
+        self.consumer = AIOKafkaConsumer(
+            bootstrap_servers=config.get('kafka_bootstrap_servers', 'localhost:9092'),
+            group_id=None,
+            enable_auto_commit=False,
+            value_deserializer=lambda m: json.loads(m.decode('utf-8')),
+        )
+        await self.consumer.start()
+
+    async def shutdown(self) -> None:
+        for task in (self.consume_task, self.retry_task):
+            if task:
+                task.cancel()
+                with contextlib.suppress(asyncio.CancelledError):
+                    await task
+        if self.consumer:
+            await self.consumer.stop()
+
+    @property
+    def in_sync(self) -> bool:
+        """Изменения других реплик доходят до этой: топик читается или рассылка выключена."""
+        return not self.enabled or self.connected
+
+    def start(
+        self, handler: InvalidationHandler, sync_handler: Optional[SyncHandler] = None
+    ) -> None:
+        """Запускает чтение топика; handler получает ключ, новое значение либо None и версию."""
+        if self.consumer is not None:
+            self.sync_handler = sync_handler
+            self.consume_task = asyncio.create_task(self._consume_loop(handler))
+
+    async def publish(self, updates: dict[str, Optional[BaseModel]]) -> None:
+        """
+        Рассылает остальным репликам новые значения ключей кеша.
+        None вместо значения означает, что ключ нужно сбросить.
+        """
+        if not self.enabled or not updates:
+            return
+
+        self.pending.update(updates)
+        await self._flush()
+
+    async def _flush(self) -> None:
+        # Ранее неотправленные изменения уходят вместе с новыми. Повторная отправка
+        # безопасна: получатель отбрасывает значения не новее известных
+        updates, self.pending = self.pending, {}
+        resync = self.resync_pending
+        producer = self.kafka_agent.producer
+        try:
+            if resync:
+                await producer.send_and_wait(
+                    self.topic, {'origin': self.instance_id, 'resync': True}
+                )
+                self.resync_pending = False
+
+            # Отправляем все сообщения сразу и ждем подтверждений вместе
+            deliveries = [
+                await producer.send(
+                    self.topic,
+                    {
+                        'origin': self.instance_id,
+                        'key': key,
+                        'value': value.model_dump(mode='json') if value is not None else None,
+                        'version': getattr(value, 'version', None),
+                    },
+                    key=key.encode('utf-8'),
+                )
+                for key, value in updates.items()
+            ]
+            await asyncio.gather(*deliveries)
+            CACHE_INVALIDATIONS_PUBLISHED.inc(len(updates))
+        except Exception as e:
+            self.logger.warning(f'Failed to publish cache invalidation, will retry: {e}')
+            self._keep_pending(updates)
+
+    def _keep_pending(self, updates: dict[str, Optional[BaseModel]]) -> None:
+        # Значения, добавленные во время отправки, новее возвращаемых
+        self.pending = {**updates, **self.pending}
+        if len(self.pending) > self.max_pending:
+            self.logger.error(
+                f'{len(self.pending)} cache changes not delivered, '
+                'requesting a full resync from other replicas'
+            )
+            self.pending = {}
+            self.resync_pending = True
+
+        if self.retry_task is None or self.retry_task.done():
+            self.retry_task = asyncio.create_task(self._retry_pending())
+
+    async def _retry_pending(self) -> None:
+        while self.pending or self.resync_pending:
+            await asyncio.sleep(self.retry_backoff)
+            await self._flush()
+
+    async def _consume_loop(self, handler: InvalidationHandler) -> None:
+        """Читает топик и перезапускает чтение после сбоев."""
+        failed = False
+        while True:
+            try:
+                await self._assign()
+                self.connected = True
+                if failed:
+                    # Изменения, пришедшие за время сбоя, уже не получить
+                    self._notify(True)
+                    failed = False
+                await self._consume(handler)
+            except Exception as e:
+                self.logger.error(f'Cache invalidation consumer failed, restarting: {e}')
+
+            self.connected = False
+            failed = True
+            self._notify(False)
+            await asyncio.sleep(self.retry_backoff)
+
+    async def _assign(self) -> None:
+        # Потребитель без подписки сам метаданные топика не запрашивает
+        await self.consumer.topics()
+        partitions = [
+            TopicPartition(self.topic, partition)
+            for partition in sorted(self.consumer.partitions_for_topic(self.topic) or ())
+        ]
+        if not partitions:
+            raise RuntimeError(f'Topic {self.topic} has no partitions')
+
+        self.consumer.assign(partitions)
+        await self.consumer.seek_to_end(*partitions)
+
+    async def _consume(self, handler: InvalidationHandler) -> None:
+        async for record in self.consumer:
+            message = record.value
+            if message.get('origin') == self.instance_id:
+                continue
+
+            if message.get('resync'):
+                # Другая реплика не смогла разослать часть изменений
+                self._notify(True)
+                continue
+
+            action = 'delete' if message.get('value') is None else 'update'
+            CACHE_INVALIDATIONS_RECEIVED.labels(action=action).inc()
+
+            try:
+                await handler(message['key'], message.get('value'), message.get('version'))
+            except Exception as e:
+                self.logger.warning(f'Error applying cache invalidation: {e}')
+
+    def _notify(self, resync: bool) -> None:
+        if self.sync_handler is not None:
+            self.sync_handler(resync)
@@ -1,18 +1,125 @@
+import asyncio
+import contextlib
 import json
-from collections.abc import Awaitable, Callable
-from typing import Any
+import time
+import zlib
+from collections.abc import Awaitable, Callable, Iterable
+from typing import Any, Optional
 
-from aiokafka import AIOKafkaConsumer, AIOKafkaProducer
+from aiokafka import (
+    AIOKafkaConsumer,
+    AIOKafkaProducer,
+    ConsumerRebalanceListener,
+    TopicPartition,
+)
+from aiokafka.errors import KafkaError
 
 from app.agents import Agent
 from app.metrics import (
+    KAFKA_BATCH_SIZE,
+    KAFKA_CONSUMER_LAG,
+    KAFKA_EVENT_COMMIT_LATENCY_EVENT,
+    KAFKA_EVENT_COMMIT_LATENCY_MOVEMENT,
+    KAFKA_MESSAGES_DEAD_LETTERED,
     KAFKA_MESSAGES_FAILED,
-    KAFKA_MESSAGES_PROCESSED,
     KAFKA_MESSAGES_RECEIVED,
+    KAFKA_MESSAGES_RETRIED,
+    KAFKA_STAGE_PARSE,
+    KAFKA_STAGE_VALIDATE,
+    Timer,
 )
 from app.models import KafkaMessage
 
 
+def deserialize_message(value: bytes) -> Any:
+    with Timer(KAFKA_STAGE_PARSE):
+        return json.loads(value.decode('utf-8'))
+
+
+class PartitionOffsetTracker:
+    """
+    Отслеживает смещения, переданные в обработку, и вычисляет для каждой партиции
+    смещение, до которого все сообщения уже обработаны и которое безопасно коммитить.
+    """
+
+    def __init__(self):
+        self.pending: dict[TopicPartition, set[int]] = {}
+        self.next_offsets: dict[TopicPartition, int] = {}
+        self.committed: dict[TopicPartition, int] = {}
+        # Время события и перемещения (секунды эпохи) для еще не закоммиченных смещений
+        self.event_times: dict[TopicPartition, dict[int, tuple[float, float]]] = {}
+
+    def track(self, tp: TopicPartition, offset: int) -> None:
+        self.pending.setdefault(tp, set()).add(offset)
+        self.next_offsets[tp] = max(self.next_offsets.get(tp, 0), offset + 1)
+
+    def record_event_time(
+        self, tp: TopicPartition, offset: int, event_time: float, movement_time: float
+    ) -> None:
+        self.event_times.setdefault(tp, {})[offset] = (event_time, movement_time)
+
+    def done(self, tp: TopicPartition, offset: int) -> None:
+        pending = self.pending.get(tp)
+        if pending is not None:
+            pending.discard(offset)
+
+    def has_pending(self, partitions: Iterable[TopicPartition]) -> bool:
+        return any(self.pending.get(tp) for tp in partitions)
+
+    def processed_offsets(self) -> dict[TopicPartition, int]:
+        """
+        Смещения, до которых обработаны все сообщения партиций:
+        наименьшее необработанное либо следующее за последним.
+        """
+        offsets = {}
+        for tp, next_offset in self.next_offsets.items():
+            pending = self.pending.get(tp)
+            offsets[tp] = min(pending) if pending else next_offset
+        return offsets
+
+    def commit_offsets(self) -> dict[TopicPartition, int]:
+        """Обработанные смещения, которые еще не закоммичены."""
+        return {
+            tp: offset
+            for tp, offset in self.processed_offsets().items()
+            if offset > self.committed.get(tp, -1)
+        }
+
+    def mark_committed(self, offsets: dict[TopicPartition, int]) -> list[tuple[float, float]]:
+        """Отмечает коммит и возвращает времена событий, смещения которых он покрыл."""
+        self.committed.update(offsets)
+        committed_times = []
+        for tp, offset in offsets.items():
+            times = self.event_times.get(tp)
+            if not times:
+                continue
+            for message_offset in [o for o in times if o < offset]:
+                committed_times.append(times.pop(message_offset))
+        return committed_times
+
+    def forget(self, partitions: Iterable[TopicPartition]) -> None:
+        for tp in partitions:
+            self.pending.pop(tp, None)
+            self.next_offsets.pop(tp, None)
+            self.committed.pop(tp, None)
+            self.event_times.pop(tp, None)
+
+
+class OffsetCommitListener(ConsumerRebalanceListener):
+    """Коммитит обработанные смещения перед тем, как партиции будут отозваны."""
+
+    def __init__(self, agent: 'KafkaAgent'):
+        self.agent = agent
+
+    async def on_partitions_revoked(self, revoked: set[TopicPartition]) -> None:
+        await self.agent.drain_partitions(revoked)
+        await self.agent.commit_processed()
+        self.agent.offset_tracker.forget(revoked)
+
+    async def on_partitions_assigned(self, assigned: set[TopicPartition]) -> None:
+        pass
+
+
 class KafkaAgent(Agent):
     """Агент для работы с Kafka."""
 
@@ -21,19 +128,56 @@ class KafkaAgent(Agent):
         self.producer = None
         self.running = False
         self.message_handler = None
+        self.batch_handler = None
+        self.batch_max_size = 500
+        self.batch_linger_ms = 50
+        self.poll_timeout_ms = 1000
+        self.workers = 1
+        self.worker_key = 'stock'
+        self.worker_queue_size = 1000
+        self.commit_interval_ms = 1000
+        self.rebalance_drain_timeout_ms = 10000
+        self.retry_backoff_ms = 1000
+        self.last_commit = time.monotonic()
+        self.worker_tasks = []
+        self.offset_tracker = PartitionOffsetTracker()
+        self.bootstrap_servers = 'localhost:9092'
+        self.topic = 'warehouse_movements'
+        self.dead_letter_topic = 'warehouse_movements_dead_letter'
+        self.lag_interval = 15
+        self.lag_task = None
+        self.lag: dict[TopicPartition, int] = {}
+        self.lag_measured = False
 
     async def initialize(self, config: dict[str, Any]) -> None:
         bootstrap_servers = config.get('kafka_bootstrap_servers', 'localhost:9092')
         topic = config.get('kafka_topic', 'warehouse_movements')
+        self.bootstrap_servers = bootstrap_servers
+        self.topic = topic
+        self.dead_letter_topic = config.get(
+            'kafka_dead_letter_topic', 'warehouse_movements_dead_letter'
+        )
         group_id = config.get('kafka_group_id', 'warehouse_monitoring_service')
+        self.batch_max_size = config.get('kafka_batch_max_size', 500)
+        self.batch_linger_ms = config.get('kafka_batch_linger_ms', 50)
+        self.poll_timeout_ms = config.get('kafka_poll_timeout_ms', 1000)
+        self.workers = config.get('kafka_workers', 1)
+        self.worker_key = config.get('kafka_worker_key', 'stock')
+        self.worker_queue_size = config.get('kafka_worker_queue_size', 1000)
+        self.commit_interval_ms = config.get('kafka_commit_interval_ms', 1000)
+        self.rebalance_drain_timeout_ms = config.get('kafka_rebalance_drain_timeout_ms', 10000)
+        self.retry_backoff_ms = config.get('kafka_retry_backoff_ms', 1000)
+        self.lag_interval = config.get('kafka_lag_interval', 15)
 
+        # Смещения коммитятся вручную через PartitionOffsetTracker только после обработки
         self.consumer = AIOKafkaConsumer(
-            topic,
             bootstrap_servers=bootstrap_servers,
             group_id=group_id,
             auto_offset_reset='earliest',
-            value_deserializer=lambda m: json.loads(m.decode('utf-8')),
+            enable_auto_commit=False,
+            value_deserializer=deserialize_message,
         )
+        self.consumer.subscribe([topic], listener=OffsetCommitListener(self))
 
         self.producer = AIOKafkaProducer(
             bootstrap_servers=bootstrap_servers,
@@ -47,30 +191,107 @@ class KafkaAgent(Agent):
 
     async def shutdown(self) -> None:
         self.running = False
+        if self.lag_task:
+            self.lag_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self.lag_task
+        # Обработанное до остановки коммитится, чтобы не перечитывать его при старте
+        if self.consumer:
+            with contextlib.suppress(Exception):
+                await self.commit_processed()
+        if self.worker_tasks:
+            for task in self.worker_tasks:
+                task.cancel()
+            await asyncio.gather(*self.worker_tasks, return_exceptions=True)
+            self.worker_tasks = []
         if self.consumer:
             await self.consumer.stop()
         if self.producer:
             await self.producer.stop()
 
+    def start_lag_monitor(self) -> None:
+        """Запускает периодический замер отставания по назначенным партициям."""
+        if self.consumer is not None and self.lag_interval > 0:
+            self.lag_task = asyncio.create_task(self._lag_loop())
+
+    async def _lag_loop(self) -> None:
+        while True:
+            try:
+                await self.update_lag()
+            except Exception as e:
+                print(f'Error measuring consumer lag: {e}')
+            await asyncio.sleep(self.lag_interval)
+
+    async def update_lag(self) -> None:
+        """
+        Отставание партиций: последнее смещение (high watermark) минус закоммиченное.
+        Считается от коммита, а не от позиции чтения: прочитанные, но не обработанные
+        сообщения при сбое будут прочитаны заново.
+        """
+        partitions = list(self.consumer.assignment())
+        end_offsets = await self.consumer.end_offsets(partitions) if partitions else {}
+
+        lag = {}
+        for tp in partitions:
+            committed = self.offset_tracker.committed.get(tp)
+            if committed is None:
+                # Эта реплика по партиции еще не коммитила - берем коммит группы
+                committed = await self.consumer.committed(tp)
+            if committed is None:
+                committed = (await self.consumer.beginning_offsets([tp]))[tp]
+            lag[tp] = max(end_offsets[tp] - committed, 0)
+            KAFKA_CONSUMER_LAG.labels(topic=tp.topic, partition=str(tp.partition)).set(lag[tp])
+
+        # Отставание отозванных партиций теперь показывает реплика, которой они достались
+        for tp in self.lag.keys() - lag.keys():
+            KAFKA_CONSUMER_LAG.remove(tp.topic, str(tp.partition))
+
+        self.lag = lag
+        self.lag_measured = True
+
+    def total_lag(self) -> Optional[int]:
+        """Суммарное отставание по партициям реплики или None, если замеров еще не было."""
+        return sum(self.lag.values()) if self.lag_measured else None
+
     async def send_message(self, topic: str, message: dict[str, Any]) -> None:
         await self.producer.send_and_wait(topic, message)
 
+    async def send_dead_letter(self, message: KafkaMessage, error: Exception) -> None:
+        """
+        Откладывает событие, которое нельзя записать в БД, в топик dead_letter_topic
+        вместе с причиной, чтобы обработать его после исправления источника.
+        """
+        error_type = type(error).__name__
+        await self.send_message(
+            self.dead_letter_topic,
+            {
+                'error_type': error_type,
+                'error': str(error),
+                'message': message.model_dump(mode='json'),
+            },
+        )
+        message_type = message.subject.split(':')[-1].lower()
+        KAFKA_MESSAGES_DEAD_LETTERED.labels(message_type=message_type, error_type=error_type).inc()
+
     async def start_consuming(self, handler: Callable[[KafkaMessage], Awaitable[None]]) -> None:
         self.message_handler = handler
         self.running = True
+        # Без новых сообщений цикл ниже ждет и сам не коммитит - коммит идет по таймеру
+        commit_task = asyncio.create_task(self._commit_loop())
 
         try:
             async for message in self.consumer:
+                tp = TopicPartition(message.topic, message.partition)
+                self.offset_tracker.track(tp, message.offset)
+
+                kafka_message = None
                 try:
                     message_type = message.value.get('subject', 'unknown').split(':')[-1].lower()
                     KAFKA_MESSAGES_RECEIVED.labels(message_type=message_type).inc()
 
-                    kafka_message = KafkaMessage(**message.value)
-
-                    await self.message_handler(kafka_message)
-
-                    KAFKA_MESSAGES_PROCESSED.labels(message_type=message_type).inc()
-
+                    with Timer(KAFKA_STAGE_VALIDATE):
+                        kafka_message = KafkaMessage(**message.value)
+                    self._record_event_time(tp, message.offset, kafka_message)
                 except Exception as e:
                     error_type = type(e).__name__
                     message_type = (
@@ -81,9 +302,265 @@ class KafkaAgent(Agent):
                     KAFKA_MESSAGES_FAILED.labels(
                         message_type=message_type, error_type=error_type
                     ).inc()
-                    print(f'Error processing message: {e}')
+                    print(f'Error parsing message: {e}')
+
+                # Успешную обработку учитывает обработчик: он знает о пропущенных повторах
+                if kafka_message is not None and not await self._handle_until_done(kafka_message):
+                    # Остановка во время повторов: смещение не коммитится
+                    break
+
+                self.offset_tracker.done(tp, message.offset)
+                await self._maybe_commit()
 
                 if not self.running:
                     break
         except Exception as e:
             print(f'Kafka consumer error: {e}')
+        finally:
+            commit_task.cancel()
+
+    async def start_consuming_batch(
+        self, handler: Callable[[list[KafkaMessage]], Awaitable[None]]
+    ) -> None:
+        """Пакетное чтение сообщений через getmany() с ограничением размера и задержки."""
+        self.batch_handler = handler
+        self.running = True
+
+        try:
+            while self.running:
+                records = await self._collect_batch()
+                if not records:
+                    continue
+
+                first_offsets = {}
+                for record in records:
+                    tp = TopicPartition(record.topic, record.partition)
+                    self.offset_tracker.track(tp, record.offset)
+                    first_offsets.setdefault(tp, record.offset)
+
+                messages = self._parse_records(records)
+                if messages:
+                    KAFKA_BATCH_SIZE.observe(len(messages))
+
+                try:
+                    if messages:
+                        await self.batch_handler(messages)
+                except Exception as e:
+                    error_type = type(e).__name__
+                    for message in messages:
+                        message_type = message.subject.split(':')[-1].lower()
+                        KAFKA_MESSAGES_RETRIED.labels(
+                            message_type=message_type, error_type=error_type
+                        ).inc()
+                    print(f'Error processing batch: {e}')
+
+                    # Ошибки данных событий обработчик учитывает сам, сюда доходят
+                    # временные сбои. Смещения не коммитятся - перечитываем пачку после паузы
+                    for tp, offset in first_offsets.items():
+                        self._seek(tp, offset)
+                    await asyncio.sleep(self.retry_backoff_ms / 1000)
+                    continue
+
+                for record in records:
+                    tp = TopicPartition(record.topic, record.partition)
+                    self.offset_tracker.done(tp, record.offset)
+                await self._commit_or_rewind()
+        except Exception as e:
+            print(f'Kafka consumer error: {e}')
+
+    async def _collect_batch(self) -> list[Any]:
+        """
+        Набирает пачку записей: ждет первую запись до poll_timeout_ms, затем
+        дочитывает доступные записи, пока не наберется batch_max_size или не
+        истечет batch_linger_ms.
+        """
+        batch = []
+        deadline = None
+        timeout_ms = self.poll_timeout_ms
+
+        while self.running and len(batch) < self.batch_max_size:
+            result = await self.consumer.getmany(
+                timeout_ms=timeout_ms, max_records=self.batch_max_size - len(batch)
+            )
+            for records in result.values():
+                batch.extend(records)
+
+            if not batch:
+                # Пока ничего не пришло - отдаем управление циклу опроса
+                return batch
+
+            if deadline is None:
+                deadline = time.monotonic() + self.batch_linger_ms / 1000
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            timeout_ms = int(remaining * 1000)
+
+        return batch
+
+    def _parse_records(self, records: list[Any]) -> list[KafkaMessage]:
+        messages = []
+        for record in records:
+            message_type = 'unknown'
+            try:
+                message_type = record.value.get('subject', 'unknown').split(':')[-1].lower()
+                KAFKA_MESSAGES_RECEIVED.labels(message_type=message_type).inc()
+
+                with Timer(KAFKA_STAGE_VALIDATE):
+                    message = KafkaMessage(**record.value)
+                messages.append(message)
+                tp = TopicPartition(record.topic, record.partition)
+                self._record_event_time(tp, record.offset, message)
+            except Exception as e:
+                KAFKA_MESSAGES_FAILED.labels(
+                    message_type=message_type, error_type=type(e).__name__
+                ).inc()
+                print(f'Error parsing message: {e}')
+
+        return messages
+
+    def _record_event_time(self, tp: TopicPartition, offset: int, message: KafkaMessage) -> None:
+        # time сообщения - миллисекунды эпохи
+        self.offset_tracker.record_event_time(
+            tp, offset, message.time / 1000, message.data.timestamp.timestamp()
+        )
+
+    async def start_consuming_concurrent(
+        self, handler: Callable[[KafkaMessage], Awaitable[None]]
+    ) -> None:
+        """
+        Параллельная обработка: записи распределяются по воркерам по ключу
+        (склад, товар) или по партиции, порядок внутри ключа сохраняется.
+        """
+        self.message_handler = handler
+        self.running = True
+
+        queues = [asyncio.Queue(maxsize=self.worker_queue_size) for _ in range(self.workers)]
+        self.worker_tasks = [asyncio.create_task(self._worker_loop(queue)) for queue in queues]
+
+        try:
+            while self.running:
+                records = await self._collect_batch()
+
+                for record in records:
+                    tp = TopicPartition(record.topic, record.partition)
+                    self.offset_tracker.track(tp, record.offset)
+
+                    messages = self._parse_records([record])
+                    if not messages:
+                        self.offset_tracker.done(tp, record.offset)
+                        continue
+
+                    queue = queues[self._worker_index(record, messages[0])]
+                    # Ограниченная очередь дает обратное давление на чтение из Kafka
+                    await queue.put((tp, record.offset, messages[0]))
+
+                # Вызывается и после пустого опроса: смещения, отмеченные воркерами уже
+                # после последних записей, коммитятся и без новых сообщений
+                await self._maybe_commit()
+        except Exception as e:
+            print(f'Kafka consumer error: {e}')
+
+    def _worker_index(self, record: Any, message: KafkaMessage) -> int:
+        if self.worker_key == 'partition':
+            return record.partition % self.workers
+
+        key = f'{message.data.warehouse_id}:{message.data.product_id}'
+        return zlib.crc32(key.encode('utf-8')) % self.workers
+
+    async def _worker_loop(self, queue: asyncio.Queue) -> None:
+        while True:
+            tp, offset, message = await queue.get()
+            try:
+                # Смещение отмечается обработанным только после успеха; при остановке
+                # во время повторов оно остается незакоммиченным и будет перечитано
+                if await self._handle_until_done(message):
+                    self.offset_tracker.done(tp, offset)
+            finally:
+                queue.task_done()
+
+    async def _handle_until_done(self, message: KafkaMessage) -> bool:
+        """
+        Вызывает обработчик, пока он не завершится успешно. Обработчик сам учитывает
+        ошибки данных события, поэтому исключение из него означает временный сбой
+        (например, недоступность БД) - сообщение повторяется после паузы с сохранением
+        порядка. False, если агент остановлен до успешной обработки.
+        """
+        while True:
+            try:
+                await self.message_handler(message)
+                return True
+            except Exception as e:
+                message_type = message.subject.split(':')[-1].lower()
+                KAFKA_MESSAGES_RETRIED.labels(
+                    message_type=message_type, error_type=type(e).__name__
+                ).inc()
+                print(f'Error processing message, retrying: {e}')
+
+            if not self.running:
+                return False
+            await asyncio.sleep(self.retry_backoff_ms / 1000)
+
+    async def _commit_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.commit_interval_ms / 1000)
+            try:
+                await self._maybe_commit()
+            except Exception as e:
+                print(f'Error committing offsets: {e}')
+
+    async def _maybe_commit(self) -> None:
+        if time.monotonic() - self.last_commit >= self.commit_interval_ms / 1000:
+            await self._commit_or_rewind()
+            self.last_commit = time.monotonic()
+
+    async def _commit_or_rewind(self) -> None:
+        """
+        Коммит обработанных смещений из цикла чтения. Коммит может не пройти во время
+        ребалансировки (CommitFailedError, IllegalStateError) - тогда чтение не
+        прерывается, а позиции партиций возвращаются к закоммиченным смещениям:
+        сообщения после них будут прочитаны и обработаны повторно.
+        """
+        try:
+            await self.commit_processed()
+        except KafkaError as e:
+            print(f'Error committing offsets, rewinding to committed: {e}')
+            await self._seek_committed()
+
+    async def _seek_committed(self) -> None:
+        for tp in self.consumer.assignment():
+            try:
+                offset = await self.consumer.committed(tp)
+            except KafkaError as e:
+                print(f'Error reading committed offset for {tp}: {e}')
+                continue
+            # Без коммита позицию задаст auto_offset_reset
+            if offset is not None:
+                self._seek(tp, offset)
+
+    def _seek(self, tp: TopicPartition, offset: int) -> None:
+        try:
+            self.consumer.seek(tp, offset)
+        except KafkaError as e:
+            # Партиция уже отозвана - ее дочитает реплика, которой она досталась
+            print(f'Error seeking {tp} to {offset}: {e}')
+
+    async def commit_processed(self) -> None:
+        """Коммит смещений, до которых все сообщения партиции обработаны."""
+        offsets = self.offset_tracker.commit_offsets()
+        if not offsets:
+            return
+
+        await self.consumer.commit(offsets)
+        now = time.time()
+        # Часы источника могут спешить - отрицательную задержку считаем нулевой
+        for event_time, movement_time in self.offset_tracker.mark_committed(offsets):
+            KAFKA_EVENT_COMMIT_LATENCY_EVENT.observe(max(now - event_time, 0.0))
+            KAFKA_EVENT_COMMIT_LATENCY_MOVEMENT.observe(max(now - movement_time, 0.0))
+
+    async def drain_partitions(self, partitions: Iterable[TopicPartition]) -> None:
+        """Ожидает завершения обработки уже выданных воркерам записей партиций."""
+        deadline = time.monotonic() + self.rebalance_drain_timeout_ms / 1000
+        while self.offset_tracker.has_pending(partitions) and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
@@ -0,0 +1,131 @@
+"""
+Помесячное секционирование таблицы movements.
+
+Секционированная таблица требует, чтобы ключ секционирования входил в первичный ключ,
+поэтому строки секционируются по moved_at - времени первого полученного события
+перемещения, которое потом не меняется. Для поиска по одному id рядом хранится
+таблица маршрутов movement_routes (id -> moved_at): по ней запрос попадает сразу
+в нужную секцию.
+"""
+
+import gzip
+import os
+import re
+import shutil
+from datetime import UTC, date, datetime
+from typing import Optional
+
+PARTITION_NAME_RE = re.compile(r'^movements_p(\d{4})(\d{2})$')
+
+# Ключ pg_advisory_lock для обслуживания секций, общий для всех реплик
+PARTITION_MAINTENANCE_LOCK = 0x6D6F76  # 'mov'
+
+# {id_type} - тип идентификаторов, см. DBAgent.id_type
+PARTITIONED_MOVEMENTS_SQL = """
+    CREATE TABLE IF NOT EXISTS movements (
+        id {id_type} NOT NULL,
+        moved_at TIMESTAMPTZ NOT NULL,
+        source_warehouse_id {id_type} NULL REFERENCES warehouses(id),
+        destination_warehouse_id {id_type} NULL REFERENCES warehouses(id),
+        departure_time TIMESTAMPTZ NULL,
+        arrival_time TIMESTAMPTZ NULL,
+        product_id {id_type} NOT NULL REFERENCES products(id),
+        departure_quantity INTEGER NULL,
+        arrival_quantity INTEGER NULL,
+        PRIMARY KEY (id, moved_at)
+    ) PARTITION BY RANGE (moved_at)
+"""
+
+MOVEMENT_ROUTES_SQL = """
+    CREATE TABLE IF NOT EXISTS movement_routes (
+        id {id_type} PRIMARY KEY,
+        moved_at TIMESTAMPTZ NOT NULL
+    )
+"""
+
+# Сюда попадают события вне созданных секций, например поздние события прошлых периодов
+DEFAULT_PARTITION_SQL = (
+    'CREATE TABLE IF NOT EXISTS movements_default PARTITION OF movements DEFAULT'
+)
+
+
+DEFAULT_HAS_ROWS_SQL = (
+    'SELECT EXISTS (SELECT 1 FROM movements_default WHERE moved_at >= $1 AND moved_at < $2)'
+)
+
+
+# DETACH PARTITION ... CONCURRENTLY не берет ACCESS EXCLUSIVE на movements, но есть
+# только с PostgreSQL 14 и запрещен, пока у таблицы есть секция по умолчанию
+DETACH_CONCURRENTLY_SQL = """
+    SELECT current_setting('server_version_num')::int >= 140000
+       AND NOT EXISTS (
+           SELECT 1 FROM pg_partitioned_table
+           WHERE partrelid = to_regclass('movements') AND partdefid <> 0
+       )
+"""
+
+# {detach_pending} - признак прерванного DETACH ... CONCURRENTLY (колонка с PostgreSQL 14)
+LIST_PARTITIONS_SQL = """
+    SELECT c.relname, i.inhparent IS NOT NULL AS attached,
+           {detach_pending} AS detach_pending
+    FROM pg_class c
+    LEFT JOIN pg_inherits i ON i.inhrelid = c.oid
+    WHERE c.relkind = 'r'
+      AND c.relnamespace = current_schema()::regnamespace
+      AND c.relname LIKE 'movements\\_p%'
+"""
+
+
+def month_start(value: date) -> date:
+    return value.replace(day=1)
+
+
+def add_months(month: date, months: int) -> date:
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month: date) -> str:
+    return f'movements_p{month.year:04d}{month.month:02d}'
+
+
+def partition_month(name: str) -> Optional[date]:
+    """Месяц секции по ее имени или None для таблиц, не являющихся помесячными секциями."""
+    match = PARTITION_NAME_RE.match(name)
+    if match is None:
+        return None
+    return date(int(match.group(1)), int(match.group(2)), 1)
+
+
+def month_bound(month: date) -> datetime:
+    """Граница секции в UTC, не зависящая от часового пояса сессии."""
+    return datetime(month.year, month.month, 1, tzinfo=UTC)
+
+
+def partition_bounds_sql(month: date) -> str:
+    lower = month_bound(month).isoformat()
+    upper = month_bound(add_months(month, 1)).isoformat()
+    return f"FOR VALUES FROM ('{lower}') TO ('{upper}')"
+
+
+def create_partition_sql(month: date) -> str:
+    return (
+        f'CREATE TABLE IF NOT EXISTS {partition_name(month)} PARTITION OF movements '
+        f'{partition_bounds_sql(month)}'
+    )
+
+
+def attach_partition_sql(month: date) -> str:
+    return (
+        f'ALTER TABLE movements ATTACH PARTITION {partition_name(month)} '
+        f'{partition_bounds_sql(month)}'
+    )
+
+
+def gzip_file(source: str, destination: str) -> None:
+    """Сжимает файл в gzip и удаляет исходный; архив появляется под итоговым именем целиком."""
+    partial = f'{destination}.partial'
+    with open(source, 'rb') as f_in, gzip.open(partial, 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.replace(partial, destination)
+    os.remove(source)
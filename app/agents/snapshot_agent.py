@@ -0,0 +1,271 @@
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import time
+from typing import Any, Optional
+
+from aiokafka import AIOKafkaConsumer, TopicPartition
+from pydantic import BaseModel
+
+from app.agents import Agent
+from app.agents.cache_agent import CacheAgent, CacheEntry
+from app.agents.db_agent import DBAgent, normalize_id
+from app.agents.kafka_agent import KafkaAgent
+from app.agents.stock_projection_agent import StockProjectionAgent
+from app.snapshot import Snapshot, read_snapshot, touched_keys, write_snapshot
+
+
+class SnapshotAgent(Agent):
+    """
+    Агент для быстрого старта реплики из снимка кеша и проекции остатков.
+
+    Снимок пишется периодически и при остановке вместе с закоммиченными смещениями
+    группы потребителей по всем партициям топика перемещений: сообщения до них
+    записаны в БД и отражены в снимке. При старте снимок загружается, а сообщения
+    после этих смещений (хвост) читаются отдельным потребителем без группы только для
+    того, чтобы узнать затронутые ими ключи: записи кеша для них сбрасываются, а
+    остатки перечитываются из БД одним запросом.
+
+    Часть хвоста к этому моменту может быть еще не записана в БД - смещения за ним не
+    закоммичены. Снимок остается верным потому, что основной потребитель группы начнет
+    с тех же смещений и обработает хвост заново, обновив кеш и проекцию.
+    """
+
+    def __init__(
+        self,
+        cache_agent: CacheAgent,
+        stock_projection: StockProjectionAgent,
+        kafka_agent: KafkaAgent,
+        db_agent: DBAgent,
+        models: dict[str, type[BaseModel]],
+    ):
+        self.cache_agent = cache_agent
+        self.stock_projection = stock_projection
+        self.kafka_agent = kafka_agent
+        self.db_agent = db_agent
+        # Модели значений кеша по префиксу ключа; записи других типов в снимок не попадают
+        self.models = models
+        self.enabled = False
+        self.path = 'snapshot.bin'
+        self.interval = 300
+        self.max_age = 3600
+        self.max_replay = 1_000_000
+        self.snapshot_task = None
+        self.logger = logging.getLogger(__name__)
+
+    async def initialize(self, config: dict[str, Any]) -> None:
+        self.enabled = config.get('snapshot_enabled', False)
+        self.path = config.get('snapshot_path', 'snapshot.bin')
+        self.interval = config.get('snapshot_interval', 300)
+        self.max_age = config.get('snapshot_max_age', 3600)
+        self.max_replay = config.get('snapshot_max_replay', 1_000_000)
+
+    def start(self) -> None:
+        if self.enabled:
+            self.snapshot_task = asyncio.create_task(self._snapshot_loop())
+
+    async def shutdown(self) -> None:
+        if self.snapshot_task:
+            self.snapshot_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self.snapshot_task
+
+        if self.enabled:
+            try:
+                await self.save()
+            except Exception as e:
+                self.logger.error(f'Failed to write snapshot on shutdown: {e}')
+
+    async def _snapshot_loop(self) -> None:
+        while True:
+            try:
+                await asyncio.sleep(self.interval)
+                await self.save()
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                self.logger.error(f'Error writing snapshot: {e}')
+
+    async def save(self) -> None:
+        # Смещения берутся до копирования состояния: сообщения, обработанные между
+        # этими моментами, при старте просто перечитаются еще раз
+        await self.kafka_agent.commit_processed()
+        offsets = await self._committed_offsets()
+
+        # Состояние копируется без await между чтениями и поэтому согласовано. Словари
+        # копируются целиком, без обхода в Python-коде; записи кеша не изменяются после
+        # создания, поэтому достаточно ссылок на них
+        now = time.time()
+        stock_complete = self.stock_projection.ready
+        warehouse_ids, product_ids, quantities = self.stock_projection.dump()
+        cache_entries = list(self.cache_agent.cache.items())
+
+        # Сериализация и запись идут в отдельном потоке, не блокируя цикл событий
+        snapshot = await asyncio.to_thread(
+            self._write,
+            Snapshot(
+                created_at=now,
+                offsets=offsets,
+                stock_complete=stock_complete,
+                warehouse_ids=warehouse_ids,
+                product_ids=product_ids,
+                stock=[],
+                cache=[],
+            ),
+            quantities,
+            cache_entries,
+        )
+        self.logger.info(
+            f'Snapshot written to {self.path}: {len(snapshot.stock)} stock entries, '
+            f'{len(snapshot.cache)} cache entries'
+        )
+
+    def _write(
+        self,
+        snapshot: Snapshot,
+        quantities: dict[int, int],
+        cache_entries: list[tuple[str, CacheEntry]],
+    ) -> Snapshot:
+        stock = [(key >> 32, key & 0xFFFFFFFF, quantity) for key, quantity in quantities.items()]
+        cache = [
+            (key, entry.value.model_dump(mode='json'), entry.expires_at)
+            for key, entry in cache_entries
+            if entry.expires_at > snapshot.created_at
+            and isinstance(entry.value, BaseModel)
+            and key.split(':', 1)[0] in self.models
+        ]
+        snapshot = snapshot._replace(stock=stock, cache=cache)
+
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        write_snapshot(self.path, snapshot)
+        return snapshot
+
+    async def _committed_offsets(self) -> dict[tuple[str, int], Optional[int]]:
+        consumer = self.kafka_agent.consumer
+        topic = self.kafka_agent.topic
+        offsets = {}
+        for partition in sorted(consumer.partitions_for_topic(topic) or ()):
+            offsets[(topic, partition)] = await consumer.committed(TopicPartition(topic, partition))
+        return offsets
+
+    async def restore(self) -> bool:
+        """
+        Загружает снимок и догоняет его по хвосту Kafka. Возвращает False, если снимка
+        нет, он устарел или хвост слишком длинный - тогда реплика стартует как обычно.
+        """
+        if not self.enabled or not os.path.exists(self.path):
+            return False
+
+        try:
+            snapshot = await asyncio.to_thread(read_snapshot, self.path)
+        except (OSError, ValueError) as e:
+            self.logger.warning(f'Ignoring unreadable snapshot: {e}')
+            return False
+
+        age = time.time() - snapshot.created_at
+        if age > self.max_age:
+            self.logger.info(f'Ignoring snapshot created {age:.0f}s ago')
+            return False
+
+        tail = await self._read_tail(snapshot.offsets)
+        if tail is None:
+            return False
+        stock_pairs, movement_ids = tail
+
+        # Значения, измененные после снимка, в кеш не восстанавливаем
+        skipped = {f'movement:{movement_id}' for movement_id in movement_ids}
+        skipped.update(f'warehouse_product:{w}:{p}' for w, p in stock_pairs)
+        now = time.time()
+        restored = 0
+        for key, value, expires_at in snapshot.cache:
+            if key in skipped or expires_at <= now:
+                continue
+            model = self.models[key.split(':', 1)[0]]
+            self.cache_agent.set(key, model.model_validate(value), ttl=int(expires_at - now))
+            restored += 1
+
+        # Неполную проекцию не восстанавливаем - она загрузится из БД как обычно
+        if snapshot.stock_complete:
+            self.stock_projection.load(snapshot.warehouse_ids, snapshot.product_ids, snapshot.stock)
+        if self.stock_projection.ready and stock_pairs:
+            self.stock_projection.apply(
+                await self.db_agent.get_warehouse_products_info(sorted(stock_pairs))
+            )
+
+        self.logger.info(
+            f'Snapshot restored: {len(snapshot.stock)} stock entries, {restored} cache entries, '
+            f'{len(stock_pairs)} stock entries refreshed from the Kafka tail'
+        )
+        return True
+
+    def _normalize_id(self, value: str) -> str:
+        """
+        Запись идентификатора, по которой сервис строит ключи кеша и проекции.
+        Идентификаторы, которых в БД быть не может, остаются как есть.
+        """
+        try:
+            return normalize_id(value, self.db_agent.id_type)
+        except ValueError:
+            return value
+
+    async def _read_tail(
+        self, offsets: dict[tuple[str, int], Optional[int]]
+    ) -> Optional[tuple[set[tuple[str, str]], set[str]]]:
+        """
+        Читает сообщения после смещений снимка до текущего конца партиций и собирает
+        затронутые ими ключи. None, если хвост не удается прочитать целиком.
+        """
+        topic = self.kafka_agent.topic
+        consumer = AIOKafkaConsumer(
+            bootstrap_servers=self.kafka_agent.bootstrap_servers,
+            group_id=None,
+            enable_auto_commit=False,
+            value_deserializer=lambda m: json.loads(m.decode('utf-8')),
+        )
+        await consumer.start()
+        try:
+            # Потребитель без подписки сам метаданные топика не запрашивает
+            await consumer.topics()
+            partitions = [
+                TopicPartition(topic, partition)
+                for partition in sorted(consumer.partitions_for_topic(topic) or ())
+            ]
+            # Новая партиция, которой нет в снимке, - его смещения неполны
+            if any((tp.topic, tp.partition) not in offsets for tp in partitions):
+                self.logger.info('Ignoring snapshot: topic partitions changed')
+                return None
+
+            consumer.assign(partitions)
+            end_offsets = await consumer.end_offsets(partitions)
+            beginning = await consumer.beginning_offsets(partitions)
+            starts = {}
+            for tp in partitions:
+                offset = offsets[(tp.topic, tp.partition)]
+                starts[tp] = beginning[tp] if offset is None else max(offset, beginning[tp])
+                consumer.seek(tp, starts[tp])
+
+            tail_size = sum(end_offsets[tp] - starts[tp] for tp in partitions)
+            if tail_size > self.max_replay:
+                self.logger.info(f'Ignoring snapshot: Kafka tail of {tail_size} is too long')
+                return None
+
+            stock_pairs: set[tuple[str, str]] = set()
+            movement_ids: set[str] = set()
+            remaining = {tp for tp in partitions if starts[tp] < end_offsets[tp]}
+            while remaining:
+                batch = await consumer.getmany(*remaining, timeout_ms=1000)
+                for tp, records in batch.items():
+                    records = [record for record in records if record.offset < end_offsets[tp]]
+                    pairs, movements = touched_keys(records, self._normalize_id)
+                    stock_pairs |= pairs
+                    movement_ids |= movements
+                # Позиция, а не смещение последней записи: в конце партиции бывают пропуски
+                for tp in list(remaining):
+                    if await consumer.position(tp) >= end_offsets[tp]:
+                        remaining.discard(tp)
+        finally:
+            await consumer.stop()
+
+        return stock_pairs, movement_ids
@@ -0,0 +1,262 @@
+import asyncio
+import contextlib
+import logging
+from collections.abc import Iterable
+from datetime import UTC, datetime
+from typing import Any, Optional
+
+from app.agents import Agent
+from app.agents.db_agent import DBAgent
+from app.agents.kafka_agent import KafkaAgent
+from app.metrics import STOCK_PROJECTION_ENTRIES, STOCK_PROJECTION_READS
+from app.models import WarehouseProductInfo
+
+
+class StockProjectionAgent(Agent):
+    """
+    Проекция остатков (склад, товар) -> количество в памяти процесса.
+
+    Загружается из warehouse_products при старте и затем обновляется значениями,
+    которые база вернула при записи событий этой репликой, и изменениями от других
+    реплик через InvalidationAgent. Идентификаторы интернируются в порядковые номера,
+    а количество хранится в словаре по упакованному ключу из двух номеров - это
+    заметно компактнее словаря с кортежами строк.
+
+    Для каждой пары хранится версия строки в БД: значение с версией не новее известной
+    (изменения от других реплик приходят не по порядку) не применяется. Записи из
+    снимка загружаются без версий и принимают любое следующее значение.
+
+    Начальную загрузку может заменить load() из снимка SnapshotAgent. Пока загрузка
+    не завершена, а также для пар, которых в проекции нет или новое значение которых
+    неизвестно (другая реплика сообщила только о сбросе ключа), проекция не отвечает
+    и чтение идет обычным путем через кеш и БД.
+
+    Раз в stock_projection_reconcile_interval секунд проекция сверяется с
+    warehouse_products: значения из БД с более новой версией заменяют записи, которые
+    разошлись с базой несмотря на рассылку изменений.
+
+    TTL у записей нет, поэтому пропущенные изменения других реплик сами не исправятся:
+    пока рассылка изменений не работает, проекция приостановлена (suspend), а после
+    ее восстановления перечитывается из БД (resync).
+    """
+
+    def __init__(self, db_agent: DBAgent, kafka_agent: KafkaAgent):
+        self.db_agent = db_agent
+        self.kafka_agent = kafka_agent
+        self.enabled = False
+        self.reconcile_interval = 0
+        self.ready = False
+        # Изменения других реплик не доходят - отвечать из проекции нельзя
+        self.suspended = False
+        self.warehouse_ids: dict[str, int] = {}
+        self.product_ids: dict[str, int] = {}
+        self.quantities: dict[int, int] = {}
+        self.versions: dict[int, int] = {}
+        # Пары, изменившиеся во время загрузки: снимок для них уже устарел
+        self.updated_during_bootstrap: set[int] = set()
+        self.unknown: set[int] = set()
+        # Пары, сброшенные во время сверки: строка из БД для них может быть старше сброса
+        self.forgotten_during_reconcile: Optional[set[int]] = None
+        self.last_applied_at: Optional[datetime] = None
+        self.bootstrap_task = None
+        self.reconcile_task = None
+        self.logger = logging.getLogger(__name__)
+
+    async def initialize(self, config: dict[str, Any]) -> None:
+        self.enabled = config.get('stock_projection_enabled', False)
+        self.reconcile_interval = config.get('stock_projection_reconcile_interval', 0)
+
+    def start(self) -> None:
+        """Запускает начальную загрузку, если проекция не восстановлена из снимка."""
+        if not self.enabled:
+            return
+
+        if not self.ready:
+            # Загрузка идет в фоне, чтобы не задерживать старт сервиса
+            self.bootstrap_task = asyncio.create_task(self.bootstrap())
+        if self.reconcile_interval > 0:
+            self.reconcile_task = asyncio.create_task(self._reconcile_loop())
+
+    async def shutdown(self) -> None:
+        for task in (self.reconcile_task, self.bootstrap_task):
+            if task:
+                task.cancel()
+                with contextlib.suppress(asyncio.CancelledError):
+                    await task
+
+    def suspend(self) -> None:
+        """Перестает отвечать, пока не будет вызван resync()."""
+        if not self.enabled:
+            return
+
+        self.suspended = True
+        self.ready = False
+
+    def resync(self) -> None:
+        """Перечитывает проекцию из БД; до окончания загрузки чтение идет через кеш и БД."""
+        if not self.enabled:
+            return
+
+        self.suspended = False
+        self.ready = False
+        if self.bootstrap_task and not self.bootstrap_task.done():
+            self.bootstrap_task.cancel()
+        self.updated_during_bootstrap.clear()
+        self.bootstrap_task = asyncio.create_task(self.bootstrap())
+
+    async def bootstrap(self) -> None:
+        """Заполняет проекцию из warehouse_products согласованным снимком."""
+        try:
+            async for row in self.db_agent.iter_warehouse_products():
+                key = self._key(row['warehouse_id'], row['product_id'])
+                if key not in self.updated_during_bootstrap:
+                    self.quantities[key] = row['quantity']
+                    self.versions[key] = row['version']
+                    self.unknown.discard(key)
+        except Exception as e:
+            self.logger.error(f'Stock projection bootstrap failed, serving from DB: {e}')
+            return
+
+        self.updated_during_bootstrap.clear()
+        self.ready = not self.suspended
+        STOCK_PROJECTION_ENTRIES.set(len(self.quantities))
+        self.logger.info(f'Stock projection loaded: {len(self.quantities)} entries')
+
+    async def reconcile(self) -> int:
+        """
+        Сверяет готовую проекцию с warehouse_products, не прекращая отвечать. Значение
+        из БД применяется, только если его версия новее известной: изменения, пришедшие
+        после чтения строки, сверка не откатывает. Возвращает число исправленных записей.
+        """
+        fixed = 0
+        self.forgotten_during_reconcile = forgotten = set()
+        try:
+            async for row in self.db_agent.iter_warehouse_products():
+                key = self._key(row['warehouse_id'], row['product_id'])
+                if key in forgotten:
+                    continue
+                # Сброшенная до начала сверки пара получает значение из БД
+                if row['version'] <= self.versions.get(key, -1) and key not in self.unknown:
+                    continue
+                if self.quantities.get(key) != row['quantity']:
+                    fixed += 1
+                self.quantities[key] = row['quantity']
+                self.versions[key] = row['version']
+                self.unknown.discard(key)
+        finally:
+            self.forgotten_during_reconcile = None
+
+        STOCK_PROJECTION_ENTRIES.set(len(self.quantities))
+        return fixed
+
+    async def _reconcile_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.reconcile_interval)
+            # Загрузка с нуля и так читает БД целиком
+            if not self.ready:
+                continue
+            try:
+                fixed = await self.reconcile()
+            except Exception as e:
+                self.logger.error(f'Stock projection reconcile failed: {e}')
+                continue
+            if fixed:
+                self.logger.warning(f'Stock projection reconcile fixed {fixed} entries')
+
+    def load(
+        self,
+        warehouse_ids: list[str],
+        product_ids: list[str],
+        entries: Iterable[tuple[int, int, int]],
+    ) -> None:
+        """Восстанавливает проекцию из таблиц идентификаторов и записей снимка."""
+        if not self.enabled:
+            return
+
+        self.warehouse_ids = {warehouse_id: i for i, warehouse_id in enumerate(warehouse_ids)}
+        self.product_ids = {product_id: i for i, product_id in enumerate(product_ids)}
+        self.quantities = {
+            warehouse << 32 | product: quantity for warehouse, product, quantity in entries
+        }
+        self.versions.clear()
+        self.unknown.clear()
+        self.ready = not self.suspended
+        STOCK_PROJECTION_ENTRIES.set(len(self.quantities))
+
+    def dump(self) -> tuple[list[str], list[str], dict[int, int]]:
+        """
+        Копии таблиц идентификаторов и количеств по упакованному ключу (номер склада
+        в старших 32 битах, номер товара в младших). Копирование идет целиком на
+        уровне словарей и не прерывается другими задачами.
+        """
+        return list(self.warehouse_ids), list(self.product_ids), dict(self.quantities)
+
+    def apply(self, stock: Iterable[WarehouseProductInfo]) -> None:
+        """Применяет новые значения остатков, возвращенные базой после записи."""
+        if not self.enabled:
+            return
+
+        for info in stock:
+            key = self._key(info.warehouse_id, info.product_id)
+            if info.version <= self.versions.get(key, -1):
+                continue
+            self.quantities[key] = info.quantity
+            self.versions[key] = info.version
+            self.unknown.discard(key)
+            if not self.ready:
+                self.updated_during_bootstrap.add(key)
+
+        self.last_applied_at = datetime.now(UTC)
+        STOCK_PROJECTION_ENTRIES.set(len(self.quantities))
+
+    def forget(self, warehouse_id: str, product_id: str) -> None:
+        """Отмечает остаток неизвестным до следующего значения."""
+        if not self.enabled:
+            return
+
+        # Версия остается: устаревшее значение не должно вернуться после сброса
+        key = self._key(warehouse_id, product_id)
+        self.quantities.pop(key, None)
+        self.unknown.add(key)
+        if not self.ready:
+            self.updated_during_bootstrap.add(key)
+        if self.forgotten_during_reconcile is not None:
+            self.forgotten_during_reconcile.add(key)
+
+    def get(self, warehouse_id: str, product_id: str) -> Optional[int]:
+        """Количество товара на складе или None, если проекция не может ответить."""
+        if not self.ready:
+            return None
+
+        # Поиск без интернирования: неизвестные идентификаторы не должны расти словари
+        warehouse = self.warehouse_ids.get(warehouse_id)
+        product = self.product_ids.get(product_id)
+        # Пары, которых нет в проекции, не считаются нулевым остатком: строка могла
+        # появиться в БД, а изменение до этой реплики - не дойти
+        quantity = None
+        if warehouse is not None and product is not None:
+            quantity = self.quantities.get(warehouse << 32 | product)
+
+        STOCK_PROJECTION_READS.labels(result='miss' if quantity is None else 'hit').inc()
+        return quantity
+
+    def watermark(self) -> dict[str, Any]:
+        """
+        Свежесть проекции: смещения партиций, все сообщения до которых этой репликой
+        уже применены, и время последнего изменения. Партиции других реплик сюда не
+        входят - их изменения приходят через InvalidationAgent.
+        """
+        offsets = self.kafka_agent.offset_tracker.processed_offsets()
+        return {
+            'enabled': self.enabled,
+            'ready': self.ready,
+            'suspended': self.suspended,
+            'entries': len(self.quantities),
+            'offsets': {f'{tp.topic}:{tp.partition}': offset for tp, offset in offsets.items()},
+            'last_applied_at': self.last_applied_at,
+        }
+
+    def _key(self, warehouse_id: str, product_id: str) -> int:
+        warehouse = self.warehouse_ids.setdefault(warehouse_id, len(self.warehouse_ids))
+        product = self.product_ids.setdefault(product_id, len(self.product_ids))
+        return warehouse << 32 | product
@@ -1,6 +1,8 @@
+from app.api.export import ExportApi
 from app.api.movements import MovementsApi
 from app.api.warehouses import WarehousesApi
 
 # Создаем экземпляры API
 movements_api = MovementsApi()
 warehouses_api = WarehousesApi()
+export_api = ExportApi()
@@ -0,0 +1,120 @@
+import contextlib
+import time
+import zlib
+from collections.abc import AsyncIterator, Callable
+
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import StreamingResponse
+
+from app.api.base import ApiBase
+from app.metrics import API_REQUESTS, API_RESPONSE_TIME
+from app.service import WarehouseMonitoringService
+
+# Строки копятся до этого размера и отправляются одним куском
+CHUNK_SIZE = 64 * 1024
+
+
+async def ndjson_chunks(lines: AsyncIterator[str], compress: bool) -> AsyncIterator[bytes]:
+    """Собирает строки JSON в куски NDJSON, при compress - сжатые gzip."""
+    compressor = zlib.compressobj(wbits=31) if compress else None
+    buffer = []
+    buffered = 0
+
+    def flush() -> bytes:
+        nonlocal buffered
+        chunk = ''.join(buffer).encode('utf-8')
+        buffer.clear()
+        buffered = 0
+        return compressor.compress(chunk) if compressor else chunk
+
+    async with contextlib.aclosing(lines):
+        async for line in lines:
+            buffer.append(line)
+            buffer.append('\n')
+            buffered += len(line) + 1
+            if buffered >= CHUNK_SIZE:
+                chunk = flush()
+                if chunk:
+                    yield chunk
+
+    chunk = flush()
+    if compressor:
+        chunk += compressor.flush()
+    if chunk:
+        yield chunk
+
+
+class ExportApi(ApiBase):
+    """API для полной выгрузки остатков и перемещений."""
+
+    def _create_router(self) -> None:
+        self.router = APIRouter(prefix='/api/export', tags=['export'])
+
+    def _setup_routes(self) -> None:
+        self.router.add_api_route(
+            '/warehouse-products',
+            self.export_warehouse_products,
+            methods=['GET'],
+            summary='Выгрузка всех остатков в NDJSON',
+        )
+        self.router.add_api_route(
+            '/movements',
+            self.export_movements,
+            methods=['GET'],
+            summary='Выгрузка всех перемещений в NDJSON',
+        )
+
+    def initialize(self, service: WarehouseMonitoringService) -> None:
+        self.service = service
+
+    async def export_warehouse_products(self, request: Request, gzip: bool = False):
+        """
+        Потоковая выгрузка таблицы остатков, по одной записи JSON в строке.
+
+        - **gzip**: Сжать ответ (Content-Encoding: gzip)
+        """
+        return self._stream(
+            '/api/export/warehouse-products',
+            request,
+            lambda: self.service.export_warehouse_products(),
+            gzip,
+        )
+
+    async def export_movements(self, request: Request, gzip: bool = False):
+        """
+        Потоковая выгрузка таблицы перемещений, по одной записи JSON в строке.
+
+        - **gzip**: Сжать ответ (Content-Encoding: gzip)
+        """
+        return self._stream(
+            '/api/export/movements', request, lambda: self.service.export_movements(), gzip
+        )
+
+    def _stream(
+        self,
+        endpoint: str,
+        request: Request,
+        source: Callable[[], AsyncIterator[str]],
+        compress: bool,
+    ) -> StreamingResponse:
+        method = request.method
+        if self.service is None:
+            API_REQUESTS.labels(endpoint=endpoint, method=method, status_code=500).inc()
+            raise HTTPException(status_code=500, detail='Service not initialized')
+
+        async def body() -> AsyncIterator[bytes]:
+            # Ответ отдается по мере чтения клиентом: следующая порция строк
+            # запрашивается из БД, только когда предыдущая отправлена
+            start_time = time.time()
+            status_code = 500
+            try:
+                async for chunk in ndjson_chunks(source(), compress):
+                    yield chunk
+                status_code = 200
+            finally:
+                API_REQUESTS.labels(endpoint=endpoint, method=method, status_code=status_code).inc()
+                duration = time.time() - start_time
+                API_RESPONSE_TIME.labels(endpoint=endpoint, method=method).observe(duration)
+
+        headers = {'Content-Encoding': 'gzip'} if compress else None
+        return StreamingResponse(body(), media_type='application/x-ndjson', headers=headers)
@@ -1,10 +1,13 @@
 import time
+from datetime import datetime
+from typing import Annotated, Optional
 
-from fastapi import APIRouter, HTTPException, Request
+from fastapi import APIRouter, HTTPException, Query, Request
 
 from app.api.base import ApiBase
+from app.api.pagination import decode_cursor, encode_cursor
 from app.metrics import API_REQUESTS, API_RESPONSE_TIME
-from app.models import MovementInfo
+from app.models import MovementInfo, MovementsPage
 from app.service import WarehouseMonitoringService
 
 
@@ -15,6 +18,13 @@ class MovementsApi(ApiBase):
         self.router = APIRouter(prefix='/api/movements', tags=['movements'])
 
     def _setup_routes(self) -> None:
+        self.router.add_api_route(
+            '',
+            self.search_movements,
+            methods=['GET'],
+            response_model=MovementsPage,
+            summary='Поиск перемещений',
+        )
         self.router.add_api_route(
             '/{movement_id}',
             self.get_movement,
@@ -62,3 +72,64 @@ class MovementsApi(ApiBase):
         finally:
             duration = time.time() - start_time
             API_RESPONSE_TIME.labels(endpoint=endpoint, method=method).observe(duration)
+
+    async def search_movements(
+        self,
+        request: Request,
+        warehouse_id: Optional[str] = None,
+        product_id: Optional[str] = None,
+        time_from: Annotated[Optional[datetime], Query(alias='from')] = None,
+        time_to: Annotated[Optional[datetime], Query(alias='to')] = None,
+        cursor: Optional[str] = None,
+        limit: int = Query(100, ge=1, le=1000),
+    ):
+        """
+        Поиск перемещений с постраничной выдачей.
+
+        - **warehouse_id**: Склад-отправитель или склад-получатель
+        - **product_id**: Идентификатор товара
+        - **from**, **to**: Интервал времени перемещения [from, to)
+        - **cursor**: Курсор следующей страницы из next_cursor предыдущего ответа
+        - **limit**: Размер страницы
+
+        Возвращает перемещения, упорядоченные по времени, и курсор следующей страницы.
+        """
+        start_time = time.time()
+        endpoint = '/api/movements'
+        method = request.method
+
+        try:
+            if self.service is None:
+                raise HTTPException(status_code=500, detail='Service not initialized')
+
+            after = None
+            if cursor is not None:
+                try:
+                    moved_at, movement_id = decode_cursor(cursor, 2)
+                    after = (datetime.fromisoformat(moved_at), movement_id)
+                except (TypeError, ValueError) as e:
+                    API_REQUESTS.labels(endpoint=endpoint, method=method, status_code=400).inc()
+                    raise HTTPException(status_code=400, detail=str(e))  # noqa: B904
+
+            items, next_key = await self.service.search_movements(
+                warehouse_id, product_id, time_from, time_to, after, limit
+            )
+
+            API_REQUESTS.labels(endpoint=endpoint, method=method, status_code=200).inc()
+            return MovementsPage(
+                items=items,
+                next_cursor=(
+                    encode_cursor(next_key[0].isoformat(), next_key[1])
+                    if next_key is not None
+                    else None
+                ),
+            )
+
+        except HTTPException:
+            raise
+        except Exception as e:
+            API_REQUESTS.labels(endpoint=endpoint, method=method, status_code=500).inc()
+            raise HTTPException(status_code=500, detail=f'Internal server error: {str(e)}')  # noqa: B904
+        finally:
+            duration = time.time() - start_time
+            API_RESPONSE_TIME.labels(endpoint=endpoint, method=method).observe(duration)
@@ -0,0 +1,22 @@
+import base64
+import json
+from typing import Any
+
+
+def encode_cursor(*values: Any) -> str:
+    """Кодирует значения ключа последней записи страницы в непрозрачный курсор."""
+    payload = json.dumps(values, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(payload).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor: str, size: int) -> list[Any]:
+    """Разбирает курсор из encode_cursor; при неверном формате поднимает ValueError."""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+    except (ValueError, UnicodeError) as e:
+        raise ValueError(f'Invalid cursor: {cursor}') from e
+
+    if not isinstance(values, list) or len(values) != size:
+        raise ValueError(f'Invalid cursor: {cursor}')
+    return values
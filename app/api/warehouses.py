@@ -1,10 +1,18 @@
 import time
+from typing import Optional
 
-from fastapi import APIRouter, HTTPException, Request
+from fastapi import APIRouter, HTTPException, Query, Request
 
 from app.api.base import ApiBase
+from app.api.pagination import decode_cursor, encode_cursor
 from app.metrics import API_REQUESTS, API_RESPONSE_TIME
-from app.models import WarehouseProductInfo
+from app.models import (
+    StockProjectionStatus,
+    WarehouseProductInfo,
+    WarehouseProductsBatchRequest,
+    WarehouseProductsBatchResponse,
+    WarehouseProductsPage,
+)
 from app.service import WarehouseMonitoringService
 
 
@@ -15,6 +23,27 @@ class WarehousesApi(ApiBase):
         self.router = APIRouter(prefix='/api/warehouses', tags=['warehouses'])
 
     def _setup_routes(self) -> None:
+        self.router.add_api_route(
+            '/products:batchGet',
+            self.batch_get_warehouse_products,
+            methods=['POST'],
+            response_model=WarehouseProductsBatchResponse,
+            summary='Получение информации о товарах на складах по списку пар',
+        )
+        self.router.add_api_route(
+            '/stock-projection',
+            self.get_stock_projection_status,
+            methods=['GET'],
+            response_model=StockProjectionStatus,
+            summary='Состояние проекции остатков в памяти',
+        )
+        self.router.add_api_route(
+            '/{warehouse_id}/products',
+            self.list_warehouse_products,
+            methods=['GET'],
+            response_model=WarehouseProductsPage,
+            summary='Список товаров на складе',
+        )
         self.router.add_api_route(
             '/{warehouse_id}/products/{product_id}',
             self.get_warehouse_product,
@@ -54,3 +83,118 @@ class WarehousesApi(ApiBase):
         finally:
             duration = time.time() - start_time
             API_RESPONSE_TIME.labels(endpoint=endpoint, method=method).observe(duration)
+
+    async def get_stock_projection_status(self, request: Request):
+        """
+        Состояние проекции остатков, из которой отвечают запросы товара на складе.
+
+        Возвращает готовность, число записей, смещения партиций Kafka, до которых
+        события применены этой репликой, время последнего изменения и то, доходят ли
+        изменения других реплик: пока они не доходят, проекция приостановлена.
+        """
+        start_time = time.time()
+        endpoint = '/api/warehouses/stock-projection'
+        method = request.method
+
+        try:
+            if self.service is None:
+                raise HTTPException(status_code=500, detail='Service not initialized')
+
+            result = self.service.get_stock_projection_status()
+
+            API_REQUESTS.labels(endpoint=endpoint, method=method, status_code=200).inc()
+            return result
+
+        except Exception as e:
+            API_REQUESTS.labels(endpoint=endpoint, method=method, status_code=500).inc()
+            raise HTTPException(status_code=500, detail=f'Internal server error: {str(e)}')  # noqa: B904
+        finally:
+            duration = time.time() - start_time
+            API_RESPONSE_TIME.labels(endpoint=endpoint, method=method).observe(duration)
+
+    async def batch_get_warehouse_products(
+        self, body: WarehouseProductsBatchRequest, request: Request
+    ):
+        """
+        Получение текущего количества товаров на складах по списку пар.
+
+        - **items**: Список пар warehouse_id и product_id
+
+        Возвращает остатки в порядке запроса; для отсутствующих пар количество равно 0.
+        """
+        start_time = time.time()
+        endpoint = '/api/warehouses/products:batchGet'
+        method = request.method
+
+        try:
+            if self.service is None:
+                raise HTTPException(status_code=500, detail='Service not initialized')
+
+            result = await self.service.get_warehouse_products_info(
+                [(item.warehouse_id, item.product_id) for item in body.items]
+            )
+
+            API_REQUESTS.labels(endpoint=endpoint, method=method, status_code=200).inc()
+            return WarehouseProductsBatchResponse(items=result)
+
+        except Exception as e:
+            API_REQUESTS.labels(endpoint=endpoint, method=method, status_code=500).inc()
+            raise HTTPException(status_code=500, detail=f'Internal server error: {str(e)}')  # noqa: B904
+        finally:
+            duration = time.time() - start_time
+            API_RESPONSE_TIME.labels(endpoint=endpoint, method=method).observe(duration)
+
+    async def list_warehouse_products(
+        self,
+        warehouse_id: str,
+        request: Request,
+        cursor: Optional[str] = None,
+        limit: int = Query(100, ge=1, le=1000),
+        in_stock: bool = False,
+    ):
+        """
+        Получение всех товаров склада постранично.
+
+        - **warehouse_id**: Идентификатор склада
+        - **cursor**: Курсор следующей страницы из next_cursor предыдущего ответа
+        - **limit**: Размер страницы
+        - **in_stock**: Только товары с ненулевым количеством
+
+        Возвращает товары, упорядоченные по product_id, и курсор следующей страницы.
+        """
+        start_time = time.time()
+        endpoint = f'/api/warehouses/{{{warehouse_id}}}/products'
+        method = request.method
+
+        try:
+            if self.service is None:
+                raise HTTPException(status_code=500, detail='Service not initialized')
+
+            after_product_id = None
+            if cursor is not None:
+                try:
+                    (after_product_id,) = decode_cursor(cursor, 1)
+                except ValueError as e:
+                    API_REQUESTS.labels(endpoint=endpoint, method=method, status_code=400).inc()
+                    raise HTTPException(status_code=400, detail=str(e))  # noqa: B904
+
+            items, next_product_id = await self.service.list_warehouse_products(
+                warehouse_id, after_product_id, limit, in_stock
+            )
+
+            API_REQUESTS.labels(endpoint=endpoint, method=method, status_code=200).inc()
+            return WarehouseProductsPage(
+                items=items,
+                next_cursor=(
+                    encode_cursor(next_product_id) if next_product_id is not None else None
+                ),
+            )
+
+        except HTTPException:
+            raise
+        except Exception as e:
+            API_REQUESTS.labels(endpoint=endpoint, method=method, status_code=500).inc()
+            raise HTTPException(status_code=500, detail=f'Internal server error: {str(e)}')  # noqa: B904
+        finally:
+            duration = time.time() - start_time
+            API_RESPONSE_TIME.labels(endpoint=endpoint, method=method).observe(duration)
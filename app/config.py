@@ -0,0 +1,67 @@
+"""Конфигурация сервиса; отдельно от app.main, чтобы ее читали и утилиты."""
+
+config = {
+    'db_host': 'db',
+    'db_port': 5432,
+    'db_user': 'postgres',
+    'db_password': 'postgres',
+    'db_name': 'warehouse',
+    'kafka_bootstrap_servers': 'kafka:29092',
+    'kafka_topic': 'warehouse_movements',
+    'kafka_group_id': 'warehouse_monitoring_service',
+    # Топик для событий, которые нельзя записать в БД при любой попытке
+    'kafka_dead_letter_topic': 'warehouse_movements_dead_letter',
+    'kafka_batch_enabled': True,
+    'kafka_batch_max_size': 500,
+    'kafka_batch_linger_ms': 50,
+    'kafka_workers': 1,
+    'kafka_worker_key': 'stock',
+    'kafka_commit_interval_ms': 1000,
+    'kafka_lag_interval': 15,
+    # Суммарное отставание реплики, при котором /health/ready отвечает degraded
+    'kafka_lag_degraded_threshold': 10_000,
+    'processed_events_retention_days': 7,
+    'cache_ttl': 3600,
+    'cache_cleanup_interval': 60,
+    'cache_max_entries': 100_000,
+    'cache_max_bytes': 256 * 1024 * 1024,
+    'cache_stale_ttl': 30,
+    'cache_negative_ttl': 5,
+    'cache_write_through': True,
+    'cache_invalidation_enabled': True,
+    'cache_invalidation_topic': 'warehouse_cache_invalidation',
+    'cache_invalidation_retry_backoff': 5,
+    'cache_invalidation_max_pending': 100_000,
+    'stock_projection_enabled': True,
+    # Сверка проекции остатков с warehouse_products, секунды; 0 - выключена
+    'stock_projection_reconcile_interval': 900,
+    'snapshot_enabled': True,
+    'snapshot_path': '/var/lib/warehouse/snapshot.bin',
+    'snapshot_interval': 300,
+    'snapshot_max_age': 3600,
+    'snapshot_max_replay': 1_000_000,
+    # Ряды warehouse_product_quantity: по умолчанию выключены, включаются лимитом
+    # и, при необходимости, списком отслеживаемых товаров
+    'metrics_stock_max_series': 0,
+    'metrics_stock_tracked_products': [],
+    'db_min_connections': 5,
+    'db_max_connections': 20,
+    'db_known_warehouses_limit': 10_000,
+    'db_known_products_limit': 1_000_000,
+    'db_export_prefetch': 1000,
+    'db_statement_cache_size': 256,
+    'db_statement_cache_lifetime': 3600,
+    # Подключение через PgBouncer с pool_mode=transaction: без подготовленных выражений
+    'db_pgbouncer': False,
+    # Миграции применяет отдельная задача: python -m app.migrations
+    'db_migrate_on_startup': False,
+    'db_id_type': 'uuid',
+    'db_movements_partitioned': True,
+    'db_movements_partitions_ahead': 3,
+    # Архивация удаляет строки из БД: включать только с долговременным
+    # db_movements_archive_dir (том или сетевое хранилище)
+    'db_movements_retention_months': 0,
+    'db_movements_archive_dir': '/var/lib/warehouse/archive',
+    # Ожидание блокировки movements при отсоединении секции без CONCURRENTLY, мс
+    'db_movements_detach_lock_timeout_ms': 1000,
+}
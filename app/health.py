@@ -1,4 +1,5 @@
-from typing import Any
+from collections.abc import Callable
+from typing import Any, Optional
 
 import asyncpg
 from aiokafka import AIOKafkaConsumer
@@ -17,6 +18,9 @@ class HealthCheck:
         self._setup_routes()
         self.db_pool = None
         self.kafka_consumer = None
+        self.get_kafka_lag: Optional[Callable[[], Optional[int]]] = None
+        self.kafka_lag_threshold = 0
+        self.get_invalidation_in_sync: Optional[Callable[[], bool]] = None
         self.is_ready = False
 
     def _setup_routes(self):
@@ -33,6 +37,15 @@ class HealthCheck:
     def set_kafka_consumer(self, consumer: AIOKafkaConsumer):
         self.kafka_consumer = consumer
 
+    def set_kafka_lag(self, get_lag: Callable[[], Optional[int]], threshold: int):
+        """Источник суммарного отставания потребителя и порог для состояния degraded."""
+        self.get_kafka_lag = get_lag
+        self.kafka_lag_threshold = threshold
+
+    def set_cache_invalidation(self, in_sync: Callable[[], bool]):
+        """Источник состояния рассылки изменений кеша между репликами."""
+        self.get_invalidation_in_sync = in_sync
+
     def set_ready(self, is_ready: bool):
         self.is_ready = is_ready
 
@@ -83,6 +96,36 @@ class HealthCheck:
             checks['kafka'] = {'status': 'down', 'reason': str(e)}
             overall_status = 'down'
 
+        # Отставание потребителя: сервис работает, но данные устаревают. Реплика
+        # остается в балансировке, а degraded служит сигналом для масштабирования
+        if self.get_kafka_lag is not None:
+            lag = self.get_kafka_lag()
+            if lag is None:
+                checks['kafka_lag'] = {'status': 'unknown', 'reason': 'Lag not measured yet'}
+            elif self.kafka_lag_threshold and lag > self.kafka_lag_threshold:
+                checks['kafka_lag'] = {
+                    'status': 'degraded',
+                    'lag': lag,
+                    'threshold': self.kafka_lag_threshold,
+                }
+                if overall_status == 'up':
+                    overall_status = 'degraded'
+            else:
+                checks['kafka_lag'] = {'status': 'up', 'lag': lag}
+
+        # Изменения других реплик не доходят: проекция остатков приостановлена и чтение
+        # идет через БД, поэтому реплика остается в балансировке
+        if self.get_invalidation_in_sync is not None:
+            if self.get_invalidation_in_sync():
+                checks['cache_invalidation'] = {'status': 'up'}
+            else:
+                checks['cache_invalidation'] = {
+                    'status': 'degraded',
+                    'reason': 'Invalidation consumer is not running',
+                }
+                if overall_status == 'up':
+                    overall_status = 'degraded'
+
         # Проверка готовности сервиса
         if not self.is_ready:
             checks['service_ready'] = {
@@ -4,8 +4,10 @@ from fastapi import FastAPI
 from prometheus_client import make_asgi_app
 from prometheus_fastapi_instrumentator import Instrumentator
 
-from app.api import movements_api, warehouses_api
+from app.api import export_api, movements_api, warehouses_api
+from app.config import config
 from app.health import health_check
+from app.metrics import WAREHOUSE_PRODUCT_QUANTITY
 from app.service import WarehouseMonitoringService
 
 logging.basicConfig(
@@ -13,20 +15,6 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-config = {
-    'db_host': 'db',
-    'db_port': 5432,
-    'db_user': 'postgres',
-    'db_password': 'postgres',
-    'db_name': 'warehouse',
-    'kafka_bootstrap_servers': 'kafka:29092',
-    'kafka_topic': 'warehouse_movements',
-    'kafka_group_id': 'warehouse_monitoring_service',
-    'cache_ttl': 300,
-    'cache_cleanup_interval': 60,
-    'db_min_connections': 5,
-    'db_max_connections': 20,
-}
 
 # Создание экземпляра сервиса
 service = WarehouseMonitoringService(config)
@@ -52,16 +40,27 @@ async def startup_event():
     metrics_app = make_asgi_app()
     app.mount('/metrics', metrics_app)
 
+    # Ряды остатков по парам (склад, товар), которые экспортируются в метрики
+    WAREHOUSE_PRODUCT_QUANTITY.configure(
+        config.get('metrics_stock_max_series', 0),
+        config.get('metrics_stock_tracked_products', ()),
+    )
+
     # Инициализация сервиса
     resources = await service.initialize()
 
     # Инициализация API компонентов
     movements_api.initialize(service)
     warehouses_api.initialize(service)
+    export_api.initialize(service)
 
     # Настройка health check
     health_check.set_db_pool(resources['db_pool'])
     health_check.set_kafka_consumer(resources['kafka_consumer'])
+    health_check.set_kafka_lag(
+        service.kafka_agent.total_lag, config.get('kafka_lag_degraded_threshold', 0)
+    )
+    health_check.set_cache_invalidation(lambda: service.invalidation_agent.in_sync)
 
     # Отмечаем сервис как готовый к работе
     health_check.set_ready(True)
@@ -81,4 +80,5 @@ async def shutdown_event():
 # Подключение API маршрутов
 app.include_router(movements_api.get_router())
 app.include_router(warehouses_api.get_router())
+app.include_router(export_api.get_router())
 app.include_router(health_check.router)
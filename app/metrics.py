@@ -1,6 +1,10 @@
 import time
+from collections.abc import Iterable, Iterator
+from typing import Any
 
-from prometheus_client import Counter, Gauge, Histogram
+from prometheus_client import REGISTRY, Counter, Gauge, Histogram
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.registry import Collector
 
 # Счетчики для сообщений Kafka
 KAFKA_MESSAGES_RECEIVED = Counter(
@@ -21,6 +25,23 @@ KAFKA_MESSAGES_FAILED = Counter(
     ['message_type', 'error_type'],
 )
 
+KAFKA_MESSAGES_RETRIED = Counter(
+    'warehouse_kafka_messages_retried_total',
+    'Total number of Kafka message handling attempts retried after a transient error',
+    ['message_type', 'error_type'],
+)
+
+KAFKA_MESSAGES_DEAD_LETTERED = Counter(
+    'warehouse_kafka_messages_dead_lettered_total',
+    'Total number of Kafka messages moved to the dead letter topic',
+    ['message_type', 'error_type'],
+)
+
+KAFKA_MESSAGES_DUPLICATE = Counter(
+    'warehouse_kafka_messages_duplicate_total',
+    'Total number of redelivered Kafka messages skipped by the processed events ledger',
+)
+
 # Метрики для API запросов
 API_REQUESTS = Counter(
     'warehouse_api_requests_total',
@@ -76,8 +97,176 @@ KAFKA_PROCESSING_TIME = Histogram(
     ],
 )
 
+# Размер пачек сообщений Kafka в пакетном режиме
+KAFKA_BATCH_SIZE = Histogram(
+    'warehouse_kafka_batch_size',
+    'Number of Kafka messages handled in one batch',
+    buckets=[1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000],
+)
+
+# Гистограмма для времени обработки пачки сообщений Kafka
+KAFKA_BATCH_PROCESSING_TIME = Histogram(
+    'warehouse_kafka_batch_processing_time_seconds',
+    'Kafka batch processing time in seconds',
+    buckets=[
+        0.005,
+        0.01,
+        0.025,
+        0.05,
+        0.1,
+        0.25,
+        0.5,
+        1.0,
+        2.5,
+        5.0,
+        10.0,
+        30.0,
+    ],
+)
+
+# Время этапов обработки сообщения Kafka
+KAFKA_STAGE_TIME = Histogram(
+    'warehouse_kafka_stage_time_seconds',
+    'Time spent in a stage of Kafka message processing',
+    ['stage'],
+    buckets=[
+        0.00001,
+        0.00005,
+        0.0001,
+        0.0005,
+        0.001,
+        0.005,
+        0.01,
+        0.025,
+        0.05,
+        0.1,
+        0.25,
+        0.5,
+        1.0,
+    ],
+)
+
+# Ряды этапов создаются заранее, чтобы не искать их по меткам на каждое сообщение
+KAFKA_STAGE_PARSE = KAFKA_STAGE_TIME.labels(stage='parse')
+KAFKA_STAGE_VALIDATE = KAFKA_STAGE_TIME.labels(stage='validate')
+KAFKA_STAGE_DB = KAFKA_STAGE_TIME.labels(stage='db')
+KAFKA_STAGE_CACHE = KAFKA_STAGE_TIME.labels(stage='cache')
+
+
+# Отставание потребителя: последнее смещение партиции минус закоммиченное
+KAFKA_CONSUMER_LAG = Gauge(
+    'warehouse_kafka_consumer_lag',
+    'Number of messages in a partition not yet committed by the consumer group',
+    ['topic', 'partition'],
+)
+
+# Задержка от времени события до коммита его смещения
+KAFKA_EVENT_COMMIT_LATENCY = Histogram(
+    'warehouse_kafka_event_to_commit_seconds',
+    'Time from an event timestamp until the offset of its message is committed',
+    ['clock'],
+    buckets=[
+        0.05,
+        0.1,
+        0.25,
+        0.5,
+        1.0,
+        2.5,
+        5.0,
+        10.0,
+        30.0,
+        60.0,
+        120.0,
+        300.0,
+        600.0,
+        1800.0,
+        3600.0,
+    ],
+)
+
+# event - время сообщения KafkaMessage.time, movement - MovementData.timestamp
+KAFKA_EVENT_COMMIT_LATENCY_EVENT = KAFKA_EVENT_COMMIT_LATENCY.labels(clock='event')
+KAFKA_EVENT_COMMIT_LATENCY_MOVEMENT = KAFKA_EVENT_COMMIT_LATENCY.labels(clock='movement')
+
+
 # Метрики для отслеживания состояния базы данных
-DB_CONNECTIONS = Gauge('warehouse_db_connections', 'Number of active database connections')
+class DBPoolCollector(Collector):
+    """Состояние пула соединений asyncpg, считываемое в момент сбора метрик."""
+
+    def __init__(self):
+        self.pool: Any = None
+
+    def set_pool(self, pool: Any) -> None:
+        self.pool = pool
+
+    def collect(self) -> Iterator[GaugeMetricFamily]:
+        connections = GaugeMetricFamily(
+            'warehouse_db_connections',
+            'Number of open database connections in the pool',
+            labels=['state'],
+        )
+        max_connections = GaugeMetricFamily(
+            'warehouse_db_pool_max_connections', 'Maximum size of the database connection pool'
+        )
+        if self.pool is not None:
+            size = self.pool.get_size()
+            idle = self.pool.get_idle_size()
+            connections.add_metric(['idle'], idle)
+            connections.add_metric(['busy'], size - idle)
+            max_connections.add_metric([], self.pool.get_max_size())
+        yield connections
+        yield max_connections
+
+
+DB_CONNECTIONS = DBPoolCollector()
+REGISTRY.register(DB_CONNECTIONS)
+
+DB_POOL_WAIT_TIME = Histogram(
+    'warehouse_db_pool_wait_time_seconds',
+    'Time spent waiting for a free connection from the database pool',
+    buckets=[
+        0.0001,
+        0.0005,
+        0.001,
+        0.005,
+        0.01,
+        0.025,
+        0.05,
+        0.1,
+        0.25,
+        0.5,
+        1.0,
+        2.5,
+        5.0,
+    ],
+)
+
+DB_QUERY_TIME = Histogram(
+    'warehouse_db_query_time_seconds',
+    'Database query execution time in seconds',
+    ['query'],
+    buckets=[
+        0.0001,
+        0.0005,
+        0.001,
+        0.0025,
+        0.005,
+        0.01,
+        0.025,
+        0.05,
+        0.1,
+        0.25,
+        0.5,
+        1.0,
+        2.5,
+    ],
+)
+
+DB_KNOWN_ENTITIES = Counter(
+    'warehouse_db_known_entities_lookups_total',
+    'Lookups in the in-process registry of known warehouses and products',
+    ['entity', 'result'],
+)
 
 # Метрики для кеша
 CACHE_SIZE = Gauge('warehouse_cache_size', 'Number of items in the cache')
@@ -86,25 +275,129 @@ CACHE_HITS = Counter('warehouse_cache_hits_total', 'Total number of cache hits')
 
 CACHE_MISSES = Counter('warehouse_cache_misses_total', 'Total number of cache misses')
 
+CACHE_NEGATIVE_HITS = Counter(
+    'warehouse_cache_negative_hits_total',
+    'Total number of cache hits for cached not-found results',
+)
+
+CACHE_COALESCED = Counter(
+    'warehouse_cache_coalesced_total',
+    'Total number of cache misses served by an already running load of the same key',
+)
+
+CACHE_STALE_HITS = Counter(
+    'warehouse_cache_stale_hits_total',
+    'Total number of expired values served while a background refresh runs',
+)
+
+CACHE_BYTES = Gauge('warehouse_cache_bytes', 'Estimated memory used by cached items in bytes')
+
+CACHE_EVICTIONS = Counter(
+    'warehouse_cache_evictions_total',
+    'Total number of items removed from the cache',
+    ['reason'],
+)
+
+CACHE_INVALIDATIONS_PUBLISHED = Counter(
+    'warehouse_cache_invalidations_published_total',
+    'Total number of cache changes broadcast to other replicas',
+)
+
+CACHE_INVALIDATIONS_RECEIVED = Counter(
+    'warehouse_cache_invalidations_received_total',
+    'Total number of cache changes received from other replicas',
+    ['action'],
+)
+
+# Метрики проекции остатков в памяти
+STOCK_PROJECTION_ENTRIES = Gauge(
+    'warehouse_stock_projection_entries', 'Number of stock entries in the in-memory projection'
+)
+
+STOCK_PROJECTION_READS = Counter(
+    'warehouse_stock_projection_reads_total',
+    'Total number of stock reads from the in-memory projection',
+    ['result'],
+)
+
+METRIC_SERIES_DROPPED = Counter(
+    'warehouse_metric_series_dropped_total',
+    'Total number of updates dropped because the metric reached its series limit',
+    ['metric'],
+)
+
+
+class BoundedStockGauge(Collector):
+    """
+    Остаток товара на складе с ограниченным числом временных рядов.
+
+    По умолчанию выключен (max_series = 0): ряд на каждую пару (склад, товар)
+    делает /metrics неподъемным. Включается списком отслеживаемых товаров и/или
+    лимитом рядов; пары сверх лимита не регистрируются, а отброшенные обновления
+    считаются в METRIC_SERIES_DROPPED. Уже зарегистрированные ряды не вытесняются,
+    чтобы не рвать графики. Полные остатки доступны через экспорт и постраничный
+    список товаров склада.
+    """
+
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self.max_series = 0
+        self.tracked_products: frozenset[str] = frozenset()
+        self.values: dict[tuple[str, str], int] = {}
+
+    def configure(self, max_series: int, tracked_products: Iterable[str] = ()) -> None:
+        self.max_series = max_series
+        self.tracked_products = frozenset(tracked_products)
+        self.values.clear()
+
+    def set(self, warehouse_id: str, product_id: str, quantity: int) -> None:
+        if self.max_series <= 0:
+            return
+        if self.tracked_products and product_id not in self.tracked_products:
+            return
+
+        key = (warehouse_id, product_id)
+        if key not in self.values and len(self.values) >= self.max_series:
+            METRIC_SERIES_DROPPED.labels(metric=self.name).inc()
+            return
+
+        self.values[key] = quantity
+
+    def collect(self) -> Iterator[GaugeMetricFamily]:
+        family = GaugeMetricFamily(
+            self.name, self.documentation, labels=['warehouse_id', 'product_id']
+        )
+        for (warehouse_id, product_id), quantity in list(self.values.items()):
+            family.add_metric([warehouse_id, product_id], quantity)
+        yield family
+
+
 # Метрики для складов и товаров
-WAREHOUSE_PRODUCT_QUANTITY = Gauge(
-    'warehouse_product_quantity',
-    'Current quantity of a product in a warehouse',
-    ['warehouse_id', 'product_id'],
+WAREHOUSE_PRODUCT_QUANTITY = BoundedStockGauge(
+    'warehouse_product_quantity', 'Current quantity of a product in a warehouse'
 )
+REGISTRY.register(WAREHOUSE_PRODUCT_QUANTITY)
 
 
 class Timer:
+    """
+    Замер длительности блока монотонными часами perf_counter_ns: time.time() может
+    прыгать при коррекции системного времени и грубее на коротких интервалах.
+    """
+
+    __slots__ = ('metric', 'labels', 'start_time')
+
     def __init__(self, metric, labels=None):
         self.metric = metric
-        self.labels = labels or {}
-        self.start_time = None
+        self.labels = labels
+        self.start_time = 0
 
     def __enter__(self):
-        self.start_time = time.time()
+        self.start_time = time.perf_counter_ns()
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        if self.start_time is not None:
-            duration = time.time() - self.start_time
-            self.metric.labels(**self.labels).observe(duration)
+        duration = (time.perf_counter_ns() - self.start_time) / 1e9
+        metric = self.metric.labels(**self.labels) if self.labels else self.metric
+        metric.observe(duration)
@@ -0,0 +1,350 @@
+"""
+Версионированные миграции схемы БД.
+
+Примененные версии записываются в таблицу schema_version. Миграции выполняет один
+процесс, взявший pg_try_advisory_lock; остальные не ждут блокировку в запросе, а
+периодически перечитывают schema_version, пока схема не обновится. Запуск отдельной
+задачей до старта сервиса:
+
+    python -m app.migrations            # применить недостающие миграции
+    python -m app.migrations --status   # показать текущую и последнюю версии
+
+Миграции, выполняемые вне транзакции (transactional=False), могут строить индексы
+через CREATE INDEX CONCURRENTLY, не блокируя запись в таблицу. Такое построение ждет
+завершения всех транзакций, открытых в базе на момент его начала; ожидающие процессы
+транзакций не держат, поэтому миграции можно применять и при старте сервиса
+(db_migrate_on_startup), но на больших таблицах старт заметно затянется.
+"""
+
+import argparse
+import asyncio
+import logging
+from collections.abc import Awaitable, Callable
+from typing import Any, NamedTuple
+
+import asyncpg
+
+from app.agents import movement_partitions as partitions
+
+logger = logging.getLogger(__name__)
+
+# Ключ pg_advisory_lock для миграций, общий для всех реплик
+MIGRATIONS_LOCK = 0x6D6967  # 'mig'
+
+# Время перемещения для поиска и сортировки: отправление, а для перемещений,
+# о которых известно только прибытие, - прибытие
+MOVEMENT_TIME = 'COALESCE(departure_time, arrival_time)'
+
+# Типы колонок идентификаторов в режимах db_id_type
+ID_COLUMN_TYPES = {'text': 'VARCHAR(255)', 'uuid': 'UUID'}
+
+# Колонки идентификаторов складов, товаров и перемещений по таблицам
+ID_COLUMNS = {
+    'warehouses': ('id',),
+    'products': ('id',),
+    'warehouse_products': ('warehouse_id', 'product_id'),
+    'movements': ('id', 'source_warehouse_id', 'destination_warehouse_id', 'product_id'),
+    'movement_routes': ('id',),
+}
+
+
+class Migration(NamedTuple):
+    version: int
+    description: str
+    apply: Callable[[asyncpg.Connection, dict[str, Any]], Awaitable[None]]
+    transactional: bool = True
+
+
+async def create_base_tables(conn: asyncpg.Connection, config: dict[str, Any]) -> None:
+    """Таблицы сервиса; тип идентификаторов и секционирование movements - из конфигурации."""
+    id_type = ID_COLUMN_TYPES[config.get('db_id_type', 'text')]
+
+    await conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS warehouses (
+            id {id_type} PRIMARY KEY
+        )
+    """)
+
+    await conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS products (
+            id {id_type} PRIMARY KEY
+        )
+    """)
+
+    await conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS warehouse_products (
+            warehouse_id {id_type} REFERENCES warehouses(id),
+            product_id {id_type} REFERENCES products(id),
+            quantity INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (warehouse_id, product_id),
+            CONSTRAINT warehouse_products_quantity_non_negative CHECK (quantity >= 0)
+        )
+    """)
+
+    # Существующую обычную таблицу movements секционированной не делаем - нужен перенос данных
+    exists = await conn.fetchval("SELECT to_regclass('movements') IS NOT NULL")
+    if config.get('db_movements_partitioned', False) and not exists:
+        await conn.execute(partitions.PARTITIONED_MOVEMENTS_SQL.format(id_type=id_type))
+        await conn.execute(partitions.MOVEMENT_ROUTES_SQL.format(id_type=id_type))
+        await conn.execute(partitions.DEFAULT_PARTITION_SQL)
+        await conn.execute(
+            'CREATE INDEX IF NOT EXISTS movement_routes_moved_at_idx ON movement_routes (moved_at)'
+        )
+    else:
+        await conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS movements (
+                id {id_type} PRIMARY KEY,
+                source_warehouse_id {id_type} NULL REFERENCES warehouses(id),
+                destination_warehouse_id {id_type} NULL REFERENCES warehouses(id),
+                departure_time TIMESTAMPTZ NULL,
+                arrival_time TIMESTAMPTZ NULL,
+                product_id {id_type} NOT NULL REFERENCES products(id),
+                departure_quantity INTEGER NULL,
+                arrival_quantity INTEGER NULL
+            )
+        """)
+
+    # Журнал обработанных событий (CloudEvents id) для идемпотентной обработки
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS processed_events (
+            id VARCHAR(255) PRIMARY KEY,
+            processed_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+    """)
+
+
+async def add_quantity_constraint(conn: asyncpg.Connection, config: dict[str, Any]) -> None:
+    """Для таблиц, созданных до появления ограничения; NOT VALID не сканирует таблицу."""
+    await conn.execute("""
+        DO $$
+        BEGIN
+            IF NOT EXISTS (
+                SELECT 1 FROM pg_constraint
+                WHERE conname = 'warehouse_products_quantity_non_negative'
+            ) THEN
+                ALTER TABLE warehouse_products
+                ADD CONSTRAINT warehouse_products_quantity_non_negative
+                CHECK (quantity >= 0) NOT VALID;
+            END IF;
+        END
+        $$
+    """)
+
+
+async def convert_ids_to_uuid(conn: asyncpg.Connection, config: dict[str, Any]) -> None:
+    """
+    При db_id_type = 'uuid' переводит колонки идентификаторов существующих таблиц
+    с VARCHAR на uuid. Внешние ключи на время смены типа снимаются и создаются заново.
+    Если среди идентификаторов есть не-UUID, изменения откатываются и схема остается
+    текстовой.
+    """
+    if config.get('db_id_type', 'text') != 'uuid':
+        return
+
+    columns = await conn.fetch(
+        """
+        SELECT table_name, column_name FROM information_schema.columns
+        WHERE table_schema = current_schema() AND data_type <> 'uuid'
+          AND table_name = ANY($1::text[])
+    """,
+        list(ID_COLUMNS),
+    )
+    to_convert: dict[str, list[str]] = {}
+    for row in columns:
+        if row['column_name'] in ID_COLUMNS[row['table_name']]:
+            to_convert.setdefault(row['table_name'], []).append(row['column_name'])
+
+    if not to_convert:
+        return
+
+    try:
+        # Вложенная транзакция (savepoint): откат не затрагивает запись версии
+        async with conn.transaction():
+            # Ограничения секций (conparentid <> 0) удаляются и создаются вместе с родительским
+            foreign_keys = await conn.fetch("""
+                SELECT conrelid::regclass::text AS table_name, conname,
+                       pg_get_constraintdef(oid) AS definition
+                FROM pg_constraint
+                WHERE contype = 'f' AND conparentid = 0
+                  AND confrelid IN (to_regclass('warehouses'), to_regclass('products'))
+            """)
+            for fk in foreign_keys:
+                await conn.execute(
+                    f'ALTER TABLE {fk["table_name"]} DROP CONSTRAINT {fk["conname"]}'
+                )
+
+            for table, table_columns in to_convert.items():
+                alterations = ', '.join(
+                    f'ALTER COLUMN {column} TYPE uuid USING {column}::uuid'
+                    for column in table_columns
+                )
+                await conn.execute(f'ALTER TABLE {table} {alterations}')
+
+            for fk in foreign_keys:
+                await conn.execute(
+                    f'ALTER TABLE {fk["table_name"]} '
+                    f'ADD CONSTRAINT {fk["conname"]} {fk["definition"]}'
+                )
+    except asyncpg.InvalidTextRepresentationError as e:
+        logger.warning(f'Identifiers are not all UUIDs, keeping text storage: {e}')
+        return
+
+    logger.info(f'Identifiers migrated to uuid in tables: {", ".join(to_convert)}')
+
+
+async def create_movement_search_indexes(conn: asyncpg.Connection, config: dict[str, Any]) -> None:
+    """
+    Индексы для поиска перемещений: по складу или товару с сортировкой по времени
+    перемещения и id (ключ курсора), а для поиска только по интервалу времени -
+    компактный BRIN, так как перемещения пишутся примерно в порядке времени.
+    """
+    # Для секционированной таблицы CONCURRENTLY не поддерживается
+    relkind = await conn.fetchval(
+        "SELECT relkind::text FROM pg_class WHERE oid = to_regclass('movements')"
+    )
+    concurrently = '' if relkind == 'p' else 'CONCURRENTLY'
+
+    indexes = [
+        (name, f'({column}, ({MOVEMENT_TIME}), id)')
+        for name, column in (
+            ('movements_source_time_idx', 'source_warehouse_id'),
+            ('movements_destination_time_idx', 'destination_warehouse_id'),
+            ('movements_product_time_idx', 'product_id'),
+        )
+    ]
+    indexes.append(('movements_time_brin_idx', f'USING BRIN (({MOVEMENT_TIME}))'))
+
+    for name, definition in indexes:
+        # Прерванное построение CONCURRENTLY оставляет невалидный индекс - строим заново
+        invalid = await conn.fetchval(
+            """
+            SELECT NOT indisvalid FROM pg_index WHERE indexrelid = to_regclass($1)
+        """,
+            name,
+        )
+        if invalid:
+            await conn.execute(f'DROP INDEX {concurrently} {name}')
+
+        await conn.execute(
+            f'CREATE INDEX {concurrently} IF NOT EXISTS {name} ON movements {definition}'
+        )
+
+
+async def add_row_versions(conn: asyncpg.Connection, config: dict[str, Any]) -> None:
+    """
+    Версии строк остатков и перемещений: счетчик, который каждое изменение строки
+    увеличивает под ее блокировкой. По нему реплики отбрасывают изменения, пришедшие
+    позже более новых. Колонка с константным значением по умолчанию добавляется без
+    перезаписи таблицы.
+    """
+    for table in ('warehouse_products', 'movements'):
+        await conn.execute(
+            f'ALTER TABLE {table} ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT 0'
+        )
+
+
+MIGRATIONS = [
+    Migration(1, 'create base tables', create_base_tables),
+    Migration(2, 'non-negative warehouse product quantity', add_quantity_constraint),
+    Migration(3, 'uuid identifiers', convert_ids_to_uuid),
+    Migration(4, 'movement search indexes', create_movement_search_indexes, transactional=False),
+    Migration(5, 'row versions', add_row_versions),
+]
+
+LATEST_VERSION = MIGRATIONS[-1].version
+
+
+async def current_version(conn: asyncpg.Connection) -> int:
+    """Последняя примененная версия схемы; 0 для пустой базы."""
+    if not await conn.fetchval("SELECT to_regclass('schema_version') IS NOT NULL"):
+        return 0
+    return await conn.fetchval('SELECT COALESCE(max(version), 0) FROM schema_version')
+
+
+async def migrate(conn: asyncpg.Connection, config: dict[str, Any]) -> list[int]:
+    """Применяет недостающие миграции и возвращает их версии."""
+    poll_interval = config.get('db_migrate_poll_interval', 2)
+    while True:
+        # Схема уже актуальна - обходимся без блокировки
+        if await current_version(conn) >= LATEST_VERSION:
+            return []
+
+        if await conn.fetchval('SELECT pg_try_advisory_lock($1)', MIGRATIONS_LOCK):
+            break
+
+        # Миграции выполняет другой процесс. Ожидание в pg_advisory_lock держало бы
+        # снимок, которого ждет CREATE INDEX CONCURRENTLY у владельца блокировки, -
+        # поэтому ждем вне запросов и транзакций
+        logger.info('Migrations are being applied by another process, waiting')
+        await asyncio.sleep(poll_interval)
+
+    try:
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                description TEXT NOT NULL,
+                applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+            )
+        """)
+
+        # Пока проверяли версию, миграции мог выполнить другой процесс
+        version = await current_version(conn)
+        applied = []
+        for migration in MIGRATIONS:
+            if migration.version <= version:
+                continue
+
+            logger.info(f'Applying migration {migration.version}: {migration.description}')
+            if migration.transactional:
+                async with conn.transaction():
+                    await migration.apply(conn, config)
+                    await _record(conn, migration)
+            else:
+                await migration.apply(conn, config)
+                await _record(conn, migration)
+            applied.append(migration.version)
+
+        return applied
+    finally:
+        await conn.execute('SELECT pg_advisory_unlock($1)', MIGRATIONS_LOCK)
+
+
+async def _record(conn: asyncpg.Connection, migration: Migration) -> None:
+    await conn.execute(
+        'INSERT INTO schema_version (version, description) VALUES ($1, $2)',
+        migration.version,
+        migration.description,
+    )
+
+
+async def run(config: dict[str, Any], status: bool = False) -> None:
+    conn = await asyncpg.connect(
+        user=config.get('db_user', 'postgres'),
+        password=config.get('db_password', 'postgres'),
+        database=config.get('db_name', 'warehouse'),
+        host=config.get('db_host', 'localhost'),
+        port=config.get('db_port', 5432),
+    )
+    try:
+        if status:
+            print(f'Schema version: {await current_version(conn)}, latest: {LATEST_VERSION}')
+            return
+
+        applied = await migrate(conn, config)
+        print(f'Applied migrations: {applied}' if applied else 'Schema is up to date')
+    finally:
+        await conn.close()
+
+
+def cli() -> None:
+    parser = argparse.ArgumentParser(description='Миграции схемы БД сервиса мониторинга складов')
+    parser.add_argument('--status', action='store_true', help='показать версию схемы')
+    args = parser.parse_args()
+
+    from app.config import config
+
+    asyncio.run(run(config, status=args.status))
+
+
+if __name__ == '__main__':
+    cli()
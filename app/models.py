@@ -1,7 +1,7 @@
 from datetime import datetime
 from typing import Literal, Optional
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
 
 class MovementData(BaseModel):
@@ -36,9 +36,47 @@ class MovementInfo(BaseModel):
     product_id: str
     quantity: int
     quantity_difference: int = 0
+    # Версия строки в БД для отбрасывания устаревших изменений; в ответы API не попадает
+    version: int = Field(default=0, exclude=True)
 
 
 class WarehouseProductInfo(BaseModel):
     warehouse_id: str
     product_id: str
     quantity: int
+    # Версия строки в БД для отбрасывания устаревших изменений; в ответы API не попадает
+    version: int = Field(default=0, exclude=True)
+
+
+class WarehouseProductKey(BaseModel):
+    warehouse_id: str
+    product_id: str
+
+
+class WarehouseProductsBatchRequest(BaseModel):
+    items: list[WarehouseProductKey] = Field(min_length=1, max_length=100_000)
+
+
+class WarehouseProductsBatchResponse(BaseModel):
+    items: list[WarehouseProductInfo]
+
+
+class WarehouseProductsPage(BaseModel):
+    items: list[WarehouseProductInfo]
+    next_cursor: Optional[str] = None
+
+
+class MovementsPage(BaseModel):
+    items: list[MovementInfo]
+    next_cursor: Optional[str] = None
+
+
+class StockProjectionStatus(BaseModel):
+    enabled: bool
+    ready: bool
+    suspended: bool = False
+    # Изменения других реплик доходят до этой
+    invalidation_in_sync: bool = True
+    entries: int
+    offsets: dict[str, int]
+    last_applied_at: Optional[datetime] = None
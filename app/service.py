@@ -1,17 +1,45 @@
 import asyncio
 import logging
+from collections.abc import AsyncIterator
+from datetime import datetime
 from typing import Any, Optional
 
+from pydantic import BaseModel
+
 from app.agents.cache_agent import CacheAgent
-from app.agents.db_agent import DBAgent
+from app.agents.db_agent import (
+    EVENT_DATA_ERRORS,
+    DBAgent,
+    MovementEvent,
+    SavedMovements,
+    normalize_id,
+)
+from app.agents.invalidation_agent import InvalidationAgent
 from app.agents.kafka_agent import KafkaAgent
+from app.agents.snapshot_agent import SnapshotAgent
+from app.agents.stock_projection_agent import StockProjectionAgent
 from app.metrics import (
+    KAFKA_BATCH_PROCESSING_TIME,
     KAFKA_MESSAGES_FAILED,
     KAFKA_MESSAGES_PROCESSED,
     KAFKA_PROCESSING_TIME,
+    KAFKA_STAGE_CACHE,
+    KAFKA_STAGE_DB,
     Timer,
 )
-from app.models import KafkaMessage, MovementInfo, WarehouseProductInfo
+from app.models import (
+    KafkaMessage,
+    MovementData,
+    MovementInfo,
+    StockProjectionStatus,
+    WarehouseProductInfo,
+)
+
+# Модели значений кеша по префиксу ключа, для изменений от других реплик
+CACHE_MODELS: dict[str, type[BaseModel]] = {
+    'movement': MovementInfo,
+    'warehouse_product': WarehouseProductInfo,
+}
 
 
 class WarehouseMonitoringService:
@@ -25,10 +53,16 @@ class WarehouseMonitoringService:
         self.db_agent = DBAgent()
         self.kafka_agent = KafkaAgent()
         self.cache_agent = CacheAgent()
+        self.invalidation_agent = InvalidationAgent(self.kafka_agent)
+        self.stock_projection = StockProjectionAgent(self.db_agent, self.kafka_agent)
+        self.snapshot_agent = SnapshotAgent(
+            self.cache_agent, self.stock_projection, self.kafka_agent, self.db_agent, CACHE_MODELS
+        )
 
         self.running = False
         self.db_pool = None
         self.kafka_consumer = None
+        self.cache_write_through = True
 
     async def initialize(self) -> None:
         self.logger.info('Initializing WarehouseMonitoringService')
@@ -37,9 +71,30 @@ class WarehouseMonitoringService:
         self.db_pool = await self.db_agent.initialize(self.config)
         self.kafka_consumer = await self.kafka_agent.initialize(self.config)
         await self.cache_agent.initialize(self.config)
+        self.cache_write_through = self.config.get('cache_write_through', True)
+        await self.stock_projection.initialize(self.config)
+
+        # Изменения кеша от других реплик
+        await self.invalidation_agent.initialize(self.config)
+        self.invalidation_agent.start(self.apply_remote_cache_change, self.on_invalidation_sync)
+
+        # Кеш и проекция восстанавливаются из снимка, если он есть, иначе проекция
+        # загружается из БД
+        await self.snapshot_agent.initialize(self.config)
+        await self.snapshot_agent.restore()
+        self.stock_projection.start()
+        self.snapshot_agent.start()
 
         # Запуск обработки сообщений Kafka
-        asyncio.create_task(self.kafka_agent.start_consuming(self.handle_kafka_message))
+        if self.config.get('kafka_workers', 1) > 1:
+            asyncio.create_task(
+                self.kafka_agent.start_consuming_concurrent(self.handle_kafka_message)
+            )
+        elif self.config.get('kafka_batch_enabled', False):
+            asyncio.create_task(self.kafka_agent.start_consuming_batch(self.handle_kafka_batch))
+        else:
+            asyncio.create_task(self.kafka_agent.start_consuming(self.handle_kafka_message))
+        self.kafka_agent.start_lag_monitor()
 
         self.running = True
         self.logger.info('WarehouseMonitoringService initialized successfully')
@@ -50,7 +105,10 @@ class WarehouseMonitoringService:
         self.logger.info('Shutting down WarehouseMonitoringService')
         self.running = False
 
-        # Завершение работы агентов
+        # Завершение работы агентов; снимок пишется, пока Kafka и кеш еще доступны
+        await self.snapshot_agent.shutdown()
+        await self.invalidation_agent.shutdown()
+        await self.stock_projection.shutdown()
         await self.kafka_agent.shutdown()
         await self.cache_agent.shutdown()
         await self.db_agent.shutdown()
@@ -58,30 +116,48 @@ class WarehouseMonitoringService:
         self.logger.info('WarehouseMonitoringService shutdown complete')
 
     async def handle_kafka_message(self, message: KafkaMessage) -> None:
+        """
+        Обработка одного сообщения. Ошибки данных события учитываются и событие
+        пропускается; остальные ошибки пробрасываются, чтобы потребитель не коммитил
+        смещение и повторил сообщение.
+        """
         message_type = message.subject.split(':')[-1].lower()
 
         with Timer(KAFKA_PROCESSING_TIME, {'message_type': message_type}):
             try:
                 self.logger.debug(f'Processing Kafka message: {message.subject}')
 
-                movement_data = message.data
+                try:
+                    movement_data = self._normalize_movement(message.data)
+                except ValueError as e:
+                    # В режиме uuid идентификатор не в формате UUID в БД не записать ни
+                    # при какой попытке: событие откладывается, а не теряется. Сбой
+                    # отправки пробрасывается, и потребитель повторит сообщение
+                    self.logger.error(f'Moving event {message.id} to dead letter topic: {e}')
+                    await self.kafka_agent.send_dead_letter(message, e)
+                    KAFKA_MESSAGES_FAILED.labels(
+                        message_type=message_type, error_type=type(e).__name__
+                    ).inc()
+                    return
                 event_type = movement_data.event.lower()
 
-                await self.db_agent.save_movement_event(
-                    movement_id=movement_data.movement_id,
-                    warehouse_id=movement_data.warehouse_id,
-                    event_type=event_type,
-                    timestamp=movement_data.timestamp,
-                    product_id=movement_data.product_id,
-                    quantity=movement_data.quantity,
-                )
+                with Timer(KAFKA_STAGE_DB):
+                    saved = await self.db_agent.save_movement_event(
+                        movement_id=movement_data.movement_id,
+                        warehouse_id=movement_data.warehouse_id,
+                        event_type=event_type,
+                        timestamp=movement_data.timestamp,
+                        product_id=movement_data.product_id,
+                        quantity=movement_data.quantity,
+                        event_id=message.id,
+                    )
+
+                if saved is None:
+                    self.logger.info(f'Skipping already processed event {message.id}')
+                    return
 
-                cache_keys = [
-                    f'movement:{movement_data.movement_id}',
-                    f'warehouse_product:{movement_data.warehouse_id}:{movement_data.product_id}',
-                ]
-                for key in cache_keys:
-                    self.cache_agent.delete(key)
+                with Timer(KAFKA_STAGE_CACHE):
+                    await self._update_cache([movement_data], saved)
 
                 self.logger.info(
                     f'Successfully processed {event_type} event for movement {movement_data.movement_id}'  # noqa: E501
@@ -89,25 +165,318 @@ class WarehouseMonitoringService:
 
                 KAFKA_MESSAGES_PROCESSED.labels(message_type=message_type).inc()
 
-            except Exception as e:
+            except EVENT_DATA_ERRORS as e:
                 self.logger.error(f'Error handling Kafka message: {e}', exc_info=True)
 
                 error_type = type(e).__name__
                 KAFKA_MESSAGES_FAILED.labels(message_type=message_type, error_type=error_type).inc()
 
+    async def handle_kafka_batch(self, messages: list[KafkaMessage]) -> None:
+        """Обработка пачки сообщений Kafka, полученных в пакетном режиме."""
+        with Timer(KAFKA_BATCH_PROCESSING_TIME):
+            batch: list[tuple[KafkaMessage, MovementData]] = []
+            for message in messages:
+                try:
+                    batch.append((message, self._normalize_movement(message.data)))
+                except ValueError:
+                    # Событие с некорректными идентификаторами уходит в топик недоставленных
+                    await self.handle_kafka_message(message)
+            if not batch:
+                return
+
+            messages = [message for message, _ in batch]
+            movements = [movement_data for _, movement_data in batch]
+            events = [
+                MovementEvent(
+                    movement_id=movement_data.movement_id,
+                    warehouse_id=movement_data.warehouse_id,
+                    event_type=movement_data.event.lower(),
+                    timestamp=movement_data.timestamp,
+                    product_id=movement_data.product_id,
+                    quantity=movement_data.quantity,
+                    event_id=message.id,
+                )
+                for message, movement_data in batch
+            ]
+
+            try:
+                with Timer(KAFKA_STAGE_DB):
+                    saved = await self.db_agent.save_movement_events_batch(events)
+            except EVENT_DATA_ERRORS as e:
+                # Пачка откатилась целиком из-за данных одного из событий - обрабатываем
+                # сообщения по одному, чтобы ошибочное событие не блокировало остальные.
+                # Прочие ошибки пробрасываются: потребитель перечитает пачку
+                self.logger.warning(
+                    f'Batch of {len(messages)} messages failed, falling back to single mode: {e}'
+                )
+                for message in messages:
+                    await self.handle_kafka_message(message)
+                return
+
+            with Timer(KAFKA_STAGE_CACHE):
+                await self._update_cache(movements, saved)
+
+            # Повторы уже учтены в KAFKA_MESSAGES_DUPLICATE, как и в одиночном режиме
+            written = set(saved.event_ids)
+            for message in messages:
+                if message.id not in written:
+                    continue
+                written.discard(message.id)
+                message_type = message.subject.split(':')[-1].lower()
+                KAFKA_MESSAGES_PROCESSED.labels(message_type=message_type).inc()
+
+            self.logger.info(f'Successfully processed batch of {len(messages)} messages')
+
+    async def _update_cache(self, movements: list[MovementData], saved: SavedMovements) -> None:
+        """
+        Обновляет кеш по результату записи событий и рассылает изменения остальным
+        репликам. В режиме write-through в кеш кладется состояние, возвращенное базой,
+        и следующее чтение не идет в БД; иначе затронутые ключи сбрасываются.
+        """
+        updates: dict[str, Optional[BaseModel]] = {}
+        if self.cache_write_through:
+            for movement in saved.movements:
+                updates[f'movement:{movement.movement_id}'] = movement
+            for stock in saved.stock:
+                updates[f'warehouse_product:{stock.warehouse_id}:{stock.product_id}'] = stock
+
+        # Ключи, для которых база не вернула состояние, сбрасываем,
+        # чтобы не оставить устаревшее значение
+        for movement_data in movements:
+            for key in self._cache_keys(movement_data):
+                updates.setdefault(key, None)
+
+        for key, value in updates.items():
+            if value is None:
+                self.cache_agent.delete(key)
+            else:
+                # Более новое значение могло уже прийти от другой реплики
+                self.cache_agent.set_if_newer(key, value)
+
+        # Проекция получает значения из базы независимо от режима кеша
+        self.stock_projection.apply(saved.stock)
+
+        await self.invalidation_agent.publish(updates)
+
+    async def apply_remote_cache_change(
+        self, key: str, value: Optional[dict[str, Any]], version: Optional[int] = None
+    ) -> None:
+        """
+        Применяет изменение кеша, полученное от другой реплики. Значение старее уже
+        известного (сообщения разных реплик переупорядочиваются) отбрасывается; значение
+        без версии нельзя сравнить, поэтому ключ только сбрасывается.
+        """
+        prefix = key.split(':', 1)[0]
+        model = CACHE_MODELS.get(prefix)
+        parsed = None
+        if value is not None and model is not None and version is not None:
+            parsed = model.model_validate({**value, 'version': version})
+
+        if prefix == 'warehouse_product':
+            _, warehouse_id, product_id = key.split(':', 2)
+            if parsed is None:
+                self.stock_projection.forget(warehouse_id, product_id)
+            else:
+                self.stock_projection.apply([parsed])
+
+        # Новое значение кладем только поверх имеющейся записи: ключи, которые
+        # эта реплика не читала, не должны вытеснять ее рабочий набор. delete при этом
+        # отменяет запись результата загрузки, начатой до изменения
+        if parsed is not None and key in self.cache_agent.cache:
+            self.cache_agent.set_if_newer(key, parsed)
+        else:
+            self.cache_agent.delete(key)
+
+    def on_invalidation_sync(self, resync: bool) -> None:
+        """
+        Реагирует на сбой рассылки изменений между репликами. Пока изменения не доходят,
+        проекция не отвечает; когда часть изменений могла быть пропущена, кеш
+        сбрасывается, а проекция перечитывается из БД.
+        """
+        if resync:
+            self.logger.warning('Cache changes from other replicas were lost, resyncing')
+            self.cache_agent.clear()
+            self.stock_projection.resync()
+        else:
+            self.stock_projection.suspend()
+
+    def _normalize_id(self, value: str) -> str:
+        """
+        Идентификатор в записи, которую возвращает БД. Ключи кеша и проекции строятся
+        по ней, поэтому разные записи одного UUID попадают в одну запись кеша.
+        """
+        return normalize_id(value, self.db_agent.id_type)
+
+    def _normalize_pair(self, warehouse_id: str, product_id: str) -> Optional[tuple[str, str]]:
+        """Нормализованная пара (склад, товар) или None, если такой пары в БД быть не может."""
+        try:
+            return self._normalize_id(warehouse_id), self._normalize_id(product_id)
+        except ValueError:
+            return None
+
+    def _normalize_movement(self, movement_data: MovementData) -> MovementData:
+        if self.db_agent.id_type != 'uuid':
+            return movement_data
+        return movement_data.model_copy(
+            update={
+                'movement_id': self._normalize_id(movement_data.movement_id),
+                'warehouse_id': self._normalize_id(movement_data.warehouse_id),
+                'product_id': self._normalize_id(movement_data.product_id),
+            }
+        )
+
+    @staticmethod
+    def _cache_keys(movement_data: MovementData) -> list[str]:
+        return [
+            f'movement:{movement_data.movement_id}',
+            f'warehouse_product:{movement_data.warehouse_id}:{movement_data.product_id}',
+        ]
+
     async def get_movement_info(self, movement_id: str) -> Optional[MovementInfo]:
+        try:
+            movement_id = self._normalize_id(movement_id)
+        except ValueError:
+            return None
+
         cache_key = f'movement:{movement_id}'
 
+        # Ненайденные перемещения кешируются на короткий negative_ttl; запись заменяется
+        # при обработке события этого перемещения в handle_kafka_message
         return await self.cache_agent.get_or_set(
-            cache_key, lambda: self.db_agent.get_movement_info(movement_id)
+            cache_key,
+            lambda: self.db_agent.get_movement_info(movement_id),
+            negative_ttl=self.cache_agent.negative_ttl,
         )
 
     async def get_warehouse_product_info(
         self, warehouse_id: str, product_id: str
     ) -> WarehouseProductInfo:
+        pair = self._normalize_pair(warehouse_id, product_id)
+        if pair is None:
+            return WarehouseProductInfo(
+                warehouse_id=warehouse_id, product_id=product_id, quantity=0
+            )
+        warehouse_id, product_id = pair
+
+        quantity = self.stock_projection.get(warehouse_id, product_id)
+        if quantity is not None:
+            return WarehouseProductInfo(
+                warehouse_id=warehouse_id, product_id=product_id, quantity=quantity
+            )
+
         cache_key = f'warehouse_product:{warehouse_id}:{product_id}'
 
         return await self.cache_agent.get_or_set(
             cache_key,
             lambda: self.db_agent.get_warehouse_product_info(warehouse_id, product_id),
         )
+
+    async def get_warehouse_products_info(
+        self, pairs: list[tuple[str, str]]
+    ) -> list[WarehouseProductInfo]:
+        """
+        Остатки по списку пар (склад, товар): из проекции, затем из кеша,
+        промахи - одним запросом к БД.
+        """
+        normalized = [self._normalize_pair(*pair) for pair in pairs]
+
+        projected = {}
+        keys = {}
+        for pair in normalized:
+            if pair is None:
+                continue
+            warehouse_id, product_id = pair
+            key = f'warehouse_product:{warehouse_id}:{product_id}'
+            quantity = self.stock_projection.get(warehouse_id, product_id)
+            if quantity is None:
+                keys[key] = pair
+            else:
+                projected[key] = WarehouseProductInfo(
+                    warehouse_id=warehouse_id, product_id=product_id, quantity=quantity
+                )
+
+        async def load(missing: list[str]) -> dict[str, WarehouseProductInfo]:
+            infos = await self.db_agent.get_warehouse_products_info([keys[key] for key in missing])
+            return dict(zip(missing, infos, strict=True))
+
+        values = await self.cache_agent.get_many_or_set(list(keys), load) if keys else {}
+        values.update(projected)
+        return [
+            values[f'warehouse_product:{pair[0]}:{pair[1]}']
+            if pair is not None
+            else WarehouseProductInfo(warehouse_id=w, product_id=p, quantity=0)
+            for (w, p), pair in zip(pairs, normalized, strict=True)
+        ]
+
+    def get_stock_projection_status(self) -> StockProjectionStatus:
+        return StockProjectionStatus(
+            **self.stock_projection.watermark(),
+            invalidation_in_sync=self.invalidation_agent.in_sync,
+        )
+
+    async def list_warehouse_products(
+        self,
+        warehouse_id: str,
+        after_product_id: Optional[str] = None,
+        limit: int = 100,
+        in_stock: bool = False,
+    ) -> tuple[list[WarehouseProductInfo], Optional[str]]:
+        """
+        Страница остатков склада. Возвращает записи и product_id, после которого
+        начинается следующая страница, либо None, если страница последняя.
+        """
+        try:
+            warehouse_id = self._normalize_id(warehouse_id)
+            if after_product_id is not None:
+                after_product_id = self._normalize_id(after_product_id)
+        except ValueError:
+            return [], None
+
+        # Запрашиваем на одну запись больше, чтобы узнать, есть ли следующая страница
+        items = await self.db_agent.list_warehouse_products(
+            warehouse_id, after_product_id, limit + 1, in_stock
+        )
+        if len(items) <= limit:
+            return items, None
+
+        items = items[:limit]
+        return items, items[-1].product_id
+
+    async def search_movements(
+        self,
+        warehouse_id: Optional[str] = None,
+        product_id: Optional[str] = None,
+        time_from: Optional[datetime] = None,
+        time_to: Optional[datetime] = None,
+        after: Optional[tuple[datetime, str]] = None,
+        limit: int = 100,
+    ) -> tuple[list[MovementInfo], Optional[tuple[datetime, str]]]:
+        """
+        Страница найденных перемещений и ключ (время, id), после которого начинается
+        следующая страница, либо None, если страница последняя.
+        """
+        try:
+            if warehouse_id is not None:
+                warehouse_id = self._normalize_id(warehouse_id)
+            if product_id is not None:
+                product_id = self._normalize_id(product_id)
+            if after is not None:
+                after = (after[0], self._normalize_id(after[1]))
+        except ValueError:
+            return [], None
+
+        items = await self.db_agent.search_movements(
+            warehouse_id, product_id, time_from, time_to, after, limit + 1
+        )
+        if len(items) <= limit:
+            return items, None
+
+        items = items[:limit]
+        last = items[-1]
+        return items, (last.departure_time or last.arrival_time, last.movement_id)
+
+    def export_warehouse_products(self) -> AsyncIterator[str]:
+        return self.db_agent.export_warehouse_products()
+
+    def export_movements(self) -> AsyncIterator[str]:
+        return self.db_agent.export_movements()
@@ -0,0 +1,129 @@
+"""
+Бинарный снимок состояния реплики для быстрого старта.
+
+Формат файла:
+
+    заголовок   8 байт сигнатуры и длина JSON-метаданных (uint32)
+    метаданные  JSON: время создания, смещения Kafka, полнота и таблицы
+                идентификаторов складов и товаров проекции остатков, число записей
+                в секциях
+    остатки     записи (номер склада uint32, номер товара uint32, количество int64)
+    кеш         записи (срок истечения float64, длина uint32, JSON ключа и значения)
+
+Остатки хранятся номерами из таблиц идентификаторов, поэтому секция имеет
+фиксированный размер записи и разбирается без копирования прямо из отображенного
+в память файла.
+"""
+
+import json
+import mmap
+import os
+import struct
+from collections.abc import Callable, Iterable
+from typing import Any, NamedTuple, Optional
+
+MAGIC = b'WHSNAP01'
+HEADER = struct.Struct('<8sI')
+STOCK_RECORD = struct.Struct('<IIq')
+CACHE_RECORD = struct.Struct('<dI')
+
+
+class Snapshot(NamedTuple):
+    created_at: float
+    # Смещения по партициям (topic, partition); None - коммита еще не было
+    offsets: dict[tuple[str, int], Optional[int]]
+    # Проекция остатков была загружена полностью; иначе секция остатков не используется
+    stock_complete: bool
+    warehouse_ids: list[str]
+    product_ids: list[str]
+    # (номер склада, номер товара, количество)
+    stock: list[tuple[int, int, int]]
+    # (ключ, значение в JSON-представлении, срок истечения)
+    cache: list[tuple[str, Any, float]]
+
+
+def write_snapshot(path: str, snapshot: Snapshot) -> None:
+    """Записывает снимок; файл появляется под итоговым именем целиком."""
+    meta = json.dumps(
+        {
+            'created_at': snapshot.created_at,
+            'offsets': [
+                [topic, partition, offset]
+                for (topic, partition), offset in snapshot.offsets.items()
+            ],
+            'stock_complete': snapshot.stock_complete,
+            'warehouse_ids': snapshot.warehouse_ids,
+            'product_ids': snapshot.product_ids,
+            'stock': len(snapshot.stock),
+            'cache': len(snapshot.cache),
+        }
+    ).encode('utf-8')
+
+    partial = f'{path}.partial'
+    with open(partial, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(meta)))
+        f.write(meta)
+        f.write(b''.join(STOCK_RECORD.pack(*entry) for entry in snapshot.stock))
+        for key, value, expires_at in snapshot.cache:
+            data = json.dumps([key, value]).encode('utf-8')
+            f.write(CACHE_RECORD.pack(expires_at, len(data)))
+            f.write(data)
+    os.replace(partial, path)
+
+
+def read_snapshot(path: str) -> Snapshot:
+    """Читает снимок; ValueError, если файл поврежден или в другом формате."""
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        try:
+            magic, meta_size = HEADER.unpack_from(mm, 0)
+            if magic != MAGIC:
+                raise ValueError(f'Unknown snapshot format in {path}')
+
+            position = HEADER.size
+            meta = json.loads(mm[position : position + meta_size])
+            position += meta_size
+
+            stock_size = meta['stock'] * STOCK_RECORD.size
+            with memoryview(mm) as view:
+                stock = list(STOCK_RECORD.iter_unpack(view[position : position + stock_size]))
+            position += stock_size
+
+            cache = []
+            for _ in range(meta['cache']):
+                expires_at, size = CACHE_RECORD.unpack_from(mm, position)
+                position += CACHE_RECORD.size
+                key, value = json.loads(mm[position : position + size])
+                position += size
+                cache.append((key, value, expires_at))
+        except (struct.error, KeyError, json.JSONDecodeError) as e:
+            raise ValueError(f'Corrupted snapshot {path}: {e}') from e
+
+    return Snapshot(
+        created_at=meta['created_at'],
+        offsets={(topic, partition): offset for topic, partition, offset in meta['offsets']},
+        stock_complete=meta['stock_complete'],
+        warehouse_ids=meta['warehouse_ids'],
+        product_ids=meta['product_ids'],
+        stock=stock,
+        cache=cache,
+    )
+
+
+def touched_keys(
+    records: Iterable[Any], normalize: Callable[[str], str] = str
+) -> tuple[set[tuple[str, str]], set[str]]:
+    """
+    Пары (склад, товар) и перемещения, затронутые сообщениями хвоста Kafka.
+    normalize приводит идентификаторы к записи, по которой строятся ключи кеша.
+    """
+    stock: set[tuple[str, str]] = set()
+    movements: set[str] = set()
+    for record in records:
+        data = record.value.get('data') if isinstance(record.value, dict) else None
+        if not isinstance(data, dict):
+            continue
+        if 'warehouse_id' in data and 'product_id' in data:
+            stock.add((normalize(data['warehouse_id']), normalize(data['product_id'])))
+        if 'movement_id' in data:
+            movements.add(normalize(data['movement_id']))
+    return stock, movements
@@ -1,10 +1,16 @@
+import datetime
 from unittest.mock import AsyncMock, MagicMock
 
 import pytest
-from fastapi import APIRouter
+from fastapi import APIRouter, FastAPI
+from fastapi.testclient import TestClient
 
 from app.api import movements_api, warehouses_api
 from app.api.base import ApiBase
+from app.api.export import ExportApi
+from app.api.movements import MovementsApi
+from app.api.warehouses import WarehousesApi
+from app.models import MovementInfo, WarehouseProductInfo
 from app.service import WarehouseMonitoringService
 
 
@@ -40,3 +46,103 @@ def test_api_initialization(mock_service):
     # Проверка, что сервис был установлен
     assert movements_api.service is mock_service
     assert warehouses_api.service is mock_service
+
+
+def test_batch_get_warehouse_products(mock_service):
+    """Тест пакетного получения остатков по списку пар."""
+    mock_service.get_warehouse_products_info = AsyncMock(
+        return_value=[
+            WarehouseProductInfo(warehouse_id='warehouse-1', product_id='product-1', quantity=5)
+        ]
+    )
+    api = WarehousesApi()
+    api.initialize(mock_service)
+    app = FastAPI()
+    app.include_router(api.get_router())
+
+    response = TestClient(app).post(
+        '/api/warehouses/products:batchGet',
+        json={'items': [{'warehouse_id': 'warehouse-1', 'product_id': 'product-1'}]},
+    )
+
+    assert response.status_code == 200
+    assert response.json() == {
+        'items': [{'warehouse_id': 'warehouse-1', 'product_id': 'product-1', 'quantity': 5}]
+    }
+    mock_service.get_warehouse_products_info.assert_called_once_with([('warehouse-1', 'product-1')])
+
+
+def test_list_warehouse_products_pagination(mock_service):
+    """Тест выдачи курсора следующей страницы и его разбора в следующем запросе."""
+    mock_service.list_warehouse_products = AsyncMock(
+        return_value=(
+            [WarehouseProductInfo(warehouse_id='warehouse-1', product_id='product-1', quantity=5)],
+            'product-1',
+        )
+    )
+    api = WarehousesApi()
+    api.initialize(mock_service)
+    app = FastAPI()
+    app.include_router(api.get_router())
+    client = TestClient(app)
+
+    response = client.get('/api/warehouses/warehouse-1/products', params={'limit': 1})
+    assert response.status_code == 200
+    next_cursor = response.json()['next_cursor']
+
+    client.get(
+        '/api/warehouses/warehouse-1/products',
+        params={'cursor': next_cursor, 'in_stock': True},
+    )
+    mock_service.list_warehouse_products.assert_called_with('warehouse-1', 'product-1', 100, True)
+
+    response = client.get('/api/warehouses/warehouse-1/products', params={'cursor': 'broken'})
+    assert response.status_code == 400
+
+
+def test_export_movements_streams_ndjson(mock_service):
+    """Тест потоковой выгрузки перемещений в NDJSON со сжатием gzip."""
+
+    async def rows():
+        yield '{"id":"movement-1"}'
+        yield '{"id":"movement-2"}'
+
+    mock_service.export_movements = MagicMock(side_effect=rows)
+    api = ExportApi()
+    api.initialize(mock_service)
+    app = FastAPI()
+    app.include_router(api.get_router())
+    client = TestClient(app)
+
+    response = client.get('/api/export/movements')
+    assert response.headers['content-type'] == 'application/x-ndjson'
+    assert response.text == '{"id":"movement-1"}\n{"id":"movement-2"}\n'
+
+    response = client.get('/api/export/movements', params={'gzip': True})
+    assert response.headers['content-encoding'] == 'gzip'
+    assert response.text == '{"id":"movement-1"}\n{"id":"movement-2"}\n'
+
+
+def test_search_movements(mock_service):
+    """Тест поиска перемещений с фильтрами и курсором следующей страницы."""
+    timestamp = datetime.datetime(2025, 2, 18, 12, 0, tzinfo=datetime.UTC)
+    movement = MovementInfo(
+        movement_id='movement-1', departure_time=timestamp, product_id='product-1', quantity=5
+    )
+    mock_service.search_movements = AsyncMock(return_value=([movement], (timestamp, 'movement-1')))
+    api = MovementsApi()
+    api.initialize(mock_service)
+    app = FastAPI()
+    app.include_router(api.get_router())
+    client = TestClient(app)
+
+    response = client.get(
+        '/api/movements', params={'warehouse_id': 'warehouse-1', 'from': timestamp.isoformat()}
+    )
+    assert response.status_code == 200
+    mock_service.search_movements.assert_called_with(
+        'warehouse-1', None, timestamp, None, None, 100
+    )
+
+    client.get('/api/movements', params={'cursor': response.json()['next_cursor']})
+    assert mock_service.search_movements.call_args[0][4] == (timestamp, 'movement-1')
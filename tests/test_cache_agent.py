@@ -4,7 +4,7 @@ from unittest.mock import AsyncMock, patch
 
 import pytest
 
-from app.agents.cache_agent import CacheAgent, CacheEntry
+from app.agents.cache_agent import NOT_FOUND, CacheAgent, CacheEntry, estimate_size
 
 
 @pytest.mark.asyncio
@@ -54,3 +54,169 @@ def test_get_set():
     assert isinstance(agent.cache['key1'], CacheEntry)
     assert agent.cache['key1'].value == 'value1'
     assert agent.cache['key1'].expires_at > time.time()
+
+
+def test_lru_eviction_by_entries():
+    """Тест вытеснения давно не использованных записей при превышении лимита."""
+    agent = CacheAgent()
+    agent.max_entries = 2
+
+    agent.set('key1', 'value1')
+    agent.set('key2', 'value2')
+    agent.get('key1')
+    agent.set('key3', 'value3')
+
+    assert list(agent.cache) == ['key1', 'key3']
+
+
+def test_eviction_by_bytes():
+    """Тест ограничения кеша по объему."""
+    agent = CacheAgent()
+    agent.max_bytes = 3 * estimate_size('key1', 'x' * 100)
+
+    for i in range(5):
+        agent.set(f'key{i}', 'x' * 100)
+
+    assert len(agent.cache) == 3
+    assert agent.total_bytes <= agent.max_bytes
+
+    agent.delete('key4')
+    assert agent.total_bytes == sum(entry.size for entry in agent.cache.values())
+
+
+def test_cleanup_expired_in_batches():
+    """Тест порционного удаления истекших записей по куче сроков."""
+    agent = CacheAgent()
+    agent.cleanup_batch_size = 2
+
+    for i in range(3):
+        agent.set(f'expired{i}', i, ttl=-1)
+    agent.set('alive', 'value')
+
+    assert agent._cleanup_expired() is True
+    assert agent._cleanup_expired() is False
+    assert list(agent.cache) == ['alive']
+
+
+@pytest.mark.asyncio
+async def test_get_or_set_coalesces_concurrent_misses():
+    """Тест объединения одновременных промахов по одному ключу в один вызов getter."""
+    agent = CacheAgent()
+    getter = AsyncMock(return_value='value')
+
+    async def slow_getter():
+        await asyncio.sleep(0.01)
+        return await getter()
+
+    results = await asyncio.gather(*(agent.get_or_set('key', slow_getter) for _ in range(10)))
+
+    assert results == ['value'] * 10
+    getter.assert_called_once()
+    assert agent.get('key') == 'value'
+    assert agent.inflight == {}
+
+
+@pytest.mark.asyncio
+async def test_get_or_set_serves_stale_while_revalidating():
+    """Тест выдачи устаревшего значения с фоновым обновлением."""
+    agent = CacheAgent()
+    agent.stale_ttl = 60
+    agent.set('key', 'old', ttl=-1)
+
+    getter = AsyncMock(return_value='new')
+
+    assert await agent.get_or_set('key', getter) == 'old'
+    assert await agent.get_or_set('key', getter) == 'old'
+
+    await asyncio.sleep(0)
+    getter.assert_called_once()
+    assert agent.get('key') == 'new'
+
+
+@pytest.mark.asyncio
+async def test_get_or_set_caches_not_found():
+    """Тест кеширования отсутствующего значения на negative_ttl."""
+    agent = CacheAgent()
+    getter = AsyncMock(return_value=None)
+
+    assert await agent.get_or_set('movement:1', getter, negative_ttl=5) is None
+    assert await agent.get_or_set('movement:1', getter, negative_ttl=5) is None
+
+    getter.assert_called_once()
+    assert agent.cache['movement:1'].value is NOT_FOUND
+    assert agent.get('movement:1') is None
+
+    # Запись перемещения сбрасывает закешированное отсутствие
+    agent.delete('movement:1')
+    getter.return_value = 'movement'
+    assert await agent.get_or_set('movement:1', getter, negative_ttl=5) == 'movement'
+
+
+@pytest.mark.asyncio
+async def test_get_or_set_without_negative_ttl_does_not_cache_none():
+    """Тест: без negative_ttl отсутствие значения не кешируется."""
+    agent = CacheAgent()
+    getter = AsyncMock(return_value=None)
+
+    await agent.get_or_set('key', getter)
+    await agent.get_or_set('key', getter)
+
+    assert getter.call_count == 2
+    assert 'key' not in agent.cache
+
+
+@pytest.mark.asyncio
+async def test_set_supersedes_inflight_load():
+    """Тест: значение, записанное во время загрузки, не перетирается ее результатом."""
+    agent = CacheAgent()
+
+    async def slow_getter():
+        await asyncio.sleep(0.01)
+        return 'loaded'
+
+    load = asyncio.create_task(agent.get_or_set('key', slow_getter))
+    await asyncio.sleep(0)
+    agent.set('key', 'written')
+
+    assert await load == 'loaded'
+    assert agent.get('key') == 'written'
+
+
+@pytest.mark.asyncio
+async def test_get_many_or_set_loads_misses_in_one_call():
+    """Тест загрузки всех промахов одним вызовом getter."""
+    agent = CacheAgent()
+    agent.set('a', 'cached-a')
+    getter = AsyncMock(return_value={'b': 'loaded-b', 'c': 'loaded-c'})
+
+    result = await agent.get_many_or_set(['a', 'b', 'c', 'b'], getter)
+
+    assert result == {'a': 'cached-a', 'b': 'loaded-b', 'c': 'loaded-c'}
+    getter.assert_called_once_with(['b', 'c'])
+    assert agent.get('c') == 'loaded-c'
+    assert agent.inflight == {}
+
+
+@pytest.mark.asyncio
+async def test_get_or_set_during_batch_load_gets_single_value():
+    """Тест: get_or_set во время пакетной загрузки получает значение своего ключа."""
+    agent = CacheAgent()
+    released = asyncio.Event()
+
+    async def batch_getter(keys):
+        await released.wait()
+        return {'a': 'loaded-a', 'b': 'loaded-b'}
+
+    single_getter = AsyncMock(return_value='single-a')
+
+    batch = asyncio.create_task(agent.get_many_or_set(['a', 'b'], batch_getter))
+    await asyncio.sleep(0)
+    single = asyncio.create_task(agent.get_or_set('a', single_getter))
+    await asyncio.sleep(0)
+    released.set()
+
+    assert await single == 'loaded-a'
+    assert await batch == {'a': 'loaded-a', 'b': 'loaded-b'}
+    single_getter.assert_not_called()
+    assert agent.get('a') == 'loaded-a'
+    assert agent.inflight == {}
@@ -3,11 +3,16 @@
 асинхронным контекстным менеджером, поэтому немного пришлось повозиться
 """
 
+import datetime
+import gzip
 from unittest.mock import AsyncMock, MagicMock, patch
 
+import asyncpg
 import pytest
 
-from app.agents.db_agent import DBAgent
+from app import migrations
+from app.agents.db_agent import DBAgent, KnownIdRegistry, MovementEvent, normalize_id
+from app.agents.db_queries import build_queries
 
 
 # Пришлось создавать отдельный класс для мока акм
@@ -35,15 +40,26 @@ def setup_db_mock():
     pool = MagicMock()
     pool.acquire = MagicMock(return_value=AsyncContextManagerMock(connection))
 
-    # Мокируем размер очереди для метрики DB_CONNECTIONS
-    pool._queue = MagicMock()
-    pool._queue.qsize = MagicMock(return_value=10)
-
     agent.pool = pool
 
     return agent, connection
 
 
+def make_movement_row(movement_id, **fields):
+    row = {
+        'id': movement_id,
+        'source_warehouse_id': None,
+        'destination_warehouse_id': None,
+        'departure_time': None,
+        'arrival_time': None,
+        'product_id': 'product-1',
+        'departure_quantity': None,
+        'arrival_quantity': None,
+    }
+    row.update(fields)
+    return row
+
+
 @pytest.mark.asyncio
 async def test_get_warehouse_product_quantity():
     """Тест получения количества товара на складе."""
@@ -51,23 +67,17 @@ async def test_get_warehouse_product_quantity():
     agent, connection = setup_db_mock()
 
     # Настраиваем мок для возврата данных
-    connection.fetchrow.return_value = {'quantity': 100}
+    connection.fetchrow.return_value = {'quantity': 100, 'version': 1}
 
     # Патчим метрику, чтобы избежать ошибок
-    with patch('app.agents.db_agent.DB_CONNECTIONS.set'):
-        with patch('app.agents.db_agent.WAREHOUSE_PRODUCT_QUANTITY.labels') as mock_labels:
-            # Настраиваем вложенный мок
-            mock_metric = MagicMock()
-            mock_labels.return_value.set = mock_metric
-
-            # Вызываем тестируемый метод
-            quantity = await agent.get_warehouse_product_quantity('warehouse-1', 'product-1')
+    # Вызываем тестируемый метод
+    quantity = await agent.get_warehouse_product_quantity('warehouse-1', 'product-1')
 
     assert quantity == 100
 
     connection.fetchrow.assert_called_once()
     call_args = connection.fetchrow.call_args[0]
-    assert 'SELECT quantity FROM warehouse_products' in call_args[0]
+    assert 'SELECT quantity, version FROM warehouse_products' in call_args[0]
     assert call_args[1] == 'warehouse-1'
     assert call_args[2] == 'product-1'
 
@@ -81,23 +91,17 @@ async def test_get_warehouse_product_quantity_not_found():
     # Настраиваем мок для возврата None (товар не найден)
     connection.fetchrow.return_value = None
 
-    with patch('app.agents.db_agent.DB_CONNECTIONS.set'):
-        with patch('app.agents.db_agent.WAREHOUSE_PRODUCT_QUANTITY.labels') as mock_labels:
-            mock_metric = MagicMock()
-            mock_labels.return_value.set = mock_metric
-
-            quantity = await agent.get_warehouse_product_quantity('warehouse-1', 'product-1')
+    quantity = await agent.get_warehouse_product_quantity('warehouse-1', 'product-1')
 
     assert quantity == 0
 
 
 @pytest.mark.asyncio
 async def test_update_warehouse_product_quantity():
-    """Тест обновления количества товара на складе."""
+    """Тест атомарного обновления количества товара на складе одним запросом."""
 
     agent, connection = setup_db_mock()
 
-    # Создаем моки для методов, которые нужно патчить
     ensure_warehouse_mock = AsyncMock()
     ensure_product_mock = AsyncMock()
     get_quantity_mock = AsyncMock(return_value=50)
@@ -113,27 +117,28 @@ async def test_update_warehouse_product_quantity():
         agent.ensure_product_exists = ensure_product_mock
         agent.get_warehouse_product_quantity = get_quantity_mock
 
-        with patch('app.agents.db_agent.DB_CONNECTIONS.set'):
-            with patch('app.agents.db_agent.WAREHOUSE_PRODUCT_QUANTITY.labels') as mock_labels:
-                mock_metric = MagicMock()
-                mock_labels.return_value.set = mock_metric
+        connection.fetchrow.return_value = {'quantity': 70, 'version': 3}
 
-                new_quantity = await agent.update_warehouse_product_quantity(
-                    'warehouse-1', 'product-1', 20
-                )
+        with patch('app.agents.db_agent.WAREHOUSE_PRODUCT_QUANTITY.set'):
+            new_quantity = await agent.update_warehouse_product_quantity(
+                'warehouse-1', 'product-1', 20
+            )
 
         assert new_quantity == 70
 
-        ensure_warehouse_mock.assert_called_once_with('warehouse-1')
-        ensure_product_mock.assert_called_once_with('product-1')
-        get_quantity_mock.assert_called_once_with('warehouse-1', 'product-1')
+        # Проверки выполняются на том же соединении, что и обновление
+        ensure_warehouse_mock.assert_called_once_with('warehouse-1', connection)
+        ensure_product_mock.assert_called_once_with('product-1', connection)
+        # Текущее значение больше не читается отдельным запросом
+        get_quantity_mock.assert_not_called()
 
-        connection.execute.assert_called_once()
-        call_args = connection.execute.call_args[0]
+        connection.fetchrow.assert_called_once()
+        call_args = connection.fetchrow.call_args[0]
         assert 'INSERT INTO warehouse_products' in call_args[0]
+        assert 'warehouse_products.quantity + EXCLUDED.quantity' in call_args[0]
         assert call_args[1] == 'warehouse-1'
         assert call_args[2] == 'product-1'
-        assert call_args[3] == 70
+        assert call_args[3] == 20
 
     finally:
         agent.ensure_warehouse_exists = original_ensure_warehouse
@@ -145,20 +150,20 @@ async def test_update_warehouse_product_quantity():
 async def test_update_warehouse_product_quantity_negative():
     """Тест на предотвращение отрицательного количества товара на складе."""
 
-    agent, _ = setup_db_mock()
+    agent, connection = setup_db_mock()
 
     ensure_warehouse_mock = AsyncMock()
     ensure_product_mock = AsyncMock()
-    get_quantity_mock = AsyncMock(return_value=10)
 
     original_ensure_warehouse = agent.ensure_warehouse_exists
     original_ensure_product = agent.ensure_product_exists
-    original_get_quantity = agent.get_warehouse_product_quantity
 
     try:
         agent.ensure_warehouse_exists = ensure_warehouse_mock
         agent.ensure_product_exists = ensure_product_mock
-        agent.get_warehouse_product_quantity = get_quantity_mock
+
+        # Условный UPDATE не затронул строк - остатка недостаточно
+        connection.fetchrow.return_value = None
 
         # Пытаемся уменьшить количество больше, чем есть на складе
         with pytest.raises(ValueError) as excinfo:
@@ -166,11 +171,629 @@ async def test_update_warehouse_product_quantity_negative():
 
         assert 'Cannot have negative quantity' in str(excinfo.value)
 
-        ensure_warehouse_mock.assert_called_once_with('warehouse-1')
-        ensure_product_mock.assert_called_once_with('product-1')
-        get_quantity_mock.assert_called_once_with('warehouse-1', 'product-1')
+        # Проверки выполняются на том же соединении, что и обновление
+        ensure_warehouse_mock.assert_called_once_with('warehouse-1', connection)
+        ensure_product_mock.assert_called_once_with('product-1', connection)
+
+        call_args = connection.fetchrow.call_args[0]
+        assert 'UPDATE warehouse_products' in call_args[0]
+        assert 'quantity + $3 >= 0' in call_args[0]
+        assert call_args[3] == -20
 
     finally:
         agent.ensure_warehouse_exists = original_ensure_warehouse
         agent.ensure_product_exists = original_ensure_product
-        agent.get_warehouse_product_quantity = original_get_quantity
+
+
+@pytest.mark.asyncio
+async def test_save_movement_events_batch():
+    """Тест пакетного сохранения событий с агрегацией изменений остатков."""
+
+    agent, connection = setup_db_mock()
+    timestamp = datetime.datetime(2025, 2, 18, 12, 0, tzinfo=datetime.UTC)
+
+    connection.fetch.side_effect = [
+        [
+            make_movement_row(
+                'movement-1',
+                source_warehouse_id='warehouse-1',
+                destination_warehouse_id='warehouse-2',
+                departure_time=timestamp,
+                arrival_time=timestamp,
+                departure_quantity=20,
+                arrival_quantity=20,
+            ),
+            make_movement_row(
+                'movement-2',
+                destination_warehouse_id='warehouse-1',
+                arrival_time=timestamp,
+                arrival_quantity=5,
+            ),
+        ],
+        [
+            {
+                'warehouse_id': 'warehouse-1',
+                'product_id': 'product-1',
+                'quantity': 80,
+                'version': 1,
+            },
+            {
+                'warehouse_id': 'warehouse-2',
+                'product_id': 'product-1',
+                'quantity': 20,
+                'version': 1,
+            },
+        ],
+    ]
+
+    events = [
+        MovementEvent('movement-1', 'warehouse-1', 'departure', timestamp, 'product-1', 20),
+        MovementEvent('movement-1', 'warehouse-2', 'arrival', timestamp, 'product-1', 20),
+        MovementEvent('movement-2', 'warehouse-1', 'arrival', timestamp, 'product-1', 5),
+    ]
+
+    with patch('app.agents.db_agent.WAREHOUSE_PRODUCT_QUANTITY.set'):
+        saved = await agent.save_movement_events_batch(events)
+
+    assert [(info.warehouse_id, info.quantity) for info in saved.stock] == [
+        ('warehouse-1', 80),
+        ('warehouse-2', 20),
+    ]
+    assert [info.movement_id for info in saved.movements] == ['movement-1', 'movement-2']
+    assert saved.movements[0].transit_time_seconds == 0
+    assert saved.movements[1].quantity == 5
+
+    # склады, товары и перемещения - по одному запросу на пачку
+    assert connection.execute.call_count == 2
+    movements_args = connection.fetch.call_args_list[0][0]
+    assert 'INSERT INTO movements' in movements_args[0]
+    assert movements_args[1] == ['movement-1', 'movement-2']
+    assert movements_args[2] == ['warehouse-1', None]
+    assert movements_args[3] == ['warehouse-2', 'warehouse-1']
+
+    stock_args = connection.fetch.call_args[0]
+    assert stock_args[1] == ['warehouse-1', 'warehouse-2']
+    assert stock_args[3] == [-15, 20]
+
+
+@pytest.mark.asyncio
+async def test_save_movement_events_batch_negative():
+    """Тест отката пачки при отрицательном остатке."""
+
+    agent, connection = setup_db_mock()
+    timestamp = datetime.datetime(2025, 2, 18, 12, 0, tzinfo=datetime.UTC)
+
+    connection.fetch.side_effect = [
+        [make_movement_row('movement-1', departure_quantity=5)],
+        [{'warehouse_id': 'warehouse-1', 'product_id': 'product-1', 'quantity': -5, 'version': 1}],
+    ]
+
+    events = [MovementEvent('movement-1', 'warehouse-1', 'departure', timestamp, 'product-1', 5)]
+
+    with pytest.raises(ValueError) as excinfo:
+        await agent.save_movement_events_batch(events)
+
+    assert 'Cannot have negative quantity' in str(excinfo.value)
+
+
+@pytest.mark.asyncio
+async def test_save_movement_events_batch_checks_balance_in_event_order():
+    """Тест: отправление раньше прибытия при нулевом остатке отклоняется, как поштучно."""
+
+    agent, connection = setup_db_mock()
+    timestamp = datetime.datetime(2025, 2, 18, 12, 0, tzinfo=datetime.UTC)
+
+    connection.fetch.side_effect = [
+        [make_movement_row('movement-1', departure_quantity=5)],
+        [{'warehouse_id': 'warehouse-1', 'product_id': 'product-1', 'quantity': 0, 'version': 2}],
+    ]
+
+    events = [
+        MovementEvent('movement-1', 'warehouse-1', 'departure', timestamp, 'product-1', 5),
+        MovementEvent('movement-2', 'warehouse-1', 'arrival', timestamp, 'product-1', 5),
+    ]
+
+    with pytest.raises(ValueError) as excinfo:
+        await agent.save_movement_events_batch(events)
+
+    assert 'Cannot have negative quantity' in str(excinfo.value)
+
+
+@pytest.mark.asyncio
+async def test_save_movement_events_batch_skips_processed_events():
+    """Тест пропуска событий, уже записанных в журнал processed_events."""
+
+    agent, connection = setup_db_mock()
+    timestamp = datetime.datetime(2025, 2, 18, 12, 0, tzinfo=datetime.UTC)
+
+    connection.fetch.side_effect = [
+        [{'id': 'event-2'}],
+        [make_movement_row('movement-2', arrival_quantity=5)],
+        [{'warehouse_id': 'warehouse-1', 'product_id': 'product-1', 'quantity': 15, 'version': 1}],
+    ]
+
+    events = [
+        MovementEvent(
+            'movement-1', 'warehouse-1', 'arrival', timestamp, 'product-1', 10, 'event-1'
+        ),
+        MovementEvent('movement-2', 'warehouse-1', 'arrival', timestamp, 'product-1', 5, 'event-2'),
+        MovementEvent('movement-2', 'warehouse-1', 'arrival', timestamp, 'product-1', 5, 'event-2'),
+    ]
+
+    with patch('app.agents.db_agent.WAREHOUSE_PRODUCT_QUANTITY.set'):
+        await agent.save_movement_events_batch(events)
+
+    ledger_args = connection.fetch.call_args_list[0][0]
+    assert 'INSERT INTO processed_events' in ledger_args[0]
+    assert ledger_args[1] == ['event-1', 'event-2']
+
+    # event-1 уже обработано, повтор event-2 внутри пачки отброшен
+    stock_args = connection.fetch.call_args_list[2][0]
+    assert stock_args[3] == [5]
+
+
+@pytest.mark.asyncio
+async def test_save_movement_event_uses_single_connection():
+    """Тест обработки события на одном соединении из пула."""
+
+    agent, connection = setup_db_mock()
+    timestamp = datetime.datetime(2025, 2, 18, 12, 0, tzinfo=datetime.UTC)
+    connection.fetch.side_effect = [
+        [{'id': 'event-1'}],
+        [
+            make_movement_row(
+                'movement-1',
+                destination_warehouse_id='warehouse-1',
+                arrival_time=timestamp,
+                arrival_quantity=100,
+            )
+        ],
+    ]
+    connection.fetchrow.return_value = {'quantity': 100, 'version': 4}
+
+    with patch('app.agents.db_agent.WAREHOUSE_PRODUCT_QUANTITY.set'):
+        saved = await agent.save_movement_event(
+            movement_id='movement-1',
+            warehouse_id='warehouse-1',
+            event_type='arrival',
+            timestamp=timestamp,
+            product_id='product-1',
+            quantity=100,
+            event_id='event-1',
+        )
+
+    assert saved.movements[0].movement_id == 'movement-1'
+    assert saved.movements[0].quantity == 100
+    assert saved.stock[0].quantity == 100
+    assert saved.stock[0].version == 4
+    agent.pool.acquire.assert_called_once()
+    assert 'warehouse-1' in agent.known_warehouses
+    assert 'product-1' in agent.known_products
+
+    statements = [call[0][0] for call in connection.execute.call_args_list]
+    assert 'INSERT INTO warehouses' in statements[0]
+    assert 'INSERT INTO products' in statements[1]
+    assert 'INSERT INTO movements' in connection.fetch.call_args_list[1][0][0]
+
+
+def test_known_id_registry_evicts_least_recently_used():
+    """Тест вытеснения давно не использованных идентификаторов из реестра."""
+    registry = KnownIdRegistry('warehouse', 2)
+    registry.update(['warehouse-1', 'warehouse-2'])
+
+    assert 'warehouse-1' in registry
+    registry.add('warehouse-3')
+
+    assert 'warehouse-2' not in registry
+    assert registry.missing(['warehouse-3', 'warehouse-2', 'warehouse-1']) == ['warehouse-2']
+
+
+@pytest.mark.asyncio
+async def test_ensure_exists_skips_known_entities():
+    """Тест пропуска INSERT для известных складов и товаров."""
+
+    agent, connection = setup_db_mock()
+
+    await agent.ensure_warehouse_exists('warehouse-1')
+    await agent.ensure_warehouse_exists('warehouse-1')
+    await agent.ensure_product_exists('product-1', connection)
+
+    # Товар создан в транзакции вызывающего - регистрирует его вызывающий
+    assert connection.execute.call_count == 2
+    assert 'warehouse-1' in agent.known_warehouses
+    assert 'product-1' not in agent.known_products
+
+
+@pytest.mark.asyncio
+async def test_get_warehouse_products_info():
+    """Тест получения остатков по списку пар одним запросом."""
+    agent, connection = setup_db_mock()
+    connection.fetch.return_value = [
+        {'warehouse_id': 'warehouse-2', 'product_id': 'product-1', 'quantity': 7, 'version': 1},
+    ]
+
+    result = await agent.get_warehouse_products_info(
+        [('warehouse-1', 'product-1'), ('warehouse-2', 'product-1')]
+    )
+
+    assert [(info.warehouse_id, info.quantity) for info in result] == [
+        ('warehouse-1', 0),
+        ('warehouse-2', 7),
+    ]
+    connection.fetch.assert_called_once()
+    args = connection.fetch.call_args[0]
+    assert args[1] == ['warehouse-1', 'warehouse-2']
+    assert args[2] == ['product-1', 'product-1']
+
+
+@pytest.mark.asyncio
+async def test_list_warehouse_products_uses_keyset():
+    """Тест постраничного чтения остатков склада по ключу product_id."""
+    agent, connection = setup_db_mock()
+    connection.fetch.return_value = [{'product_id': 'product-2', 'quantity': 3}]
+
+    result = await agent.list_warehouse_products(
+        'warehouse-1', after_product_id='product-1', limit=10, in_stock=True
+    )
+
+    assert result[0].product_id == 'product-2'
+    query, *args = connection.fetch.call_args[0]
+    assert 'product_id > $2' in query
+    assert 'quantity > 0' in query
+    assert 'OFFSET' not in query
+    assert args == ['warehouse-1', 'product-1', 10]
+
+
+@pytest.mark.asyncio
+async def test_export_movements_uses_server_side_cursor():
+    """Тест выгрузки перемещений серверным курсором внутри транзакции."""
+    agent, connection = setup_db_mock()
+    agent.export_prefetch = 2
+
+    async def cursor_rows():
+        for movement_id in ('movement-1', 'movement-2'):
+            yield [f'{{"id":"{movement_id}"}}']
+
+    connection.cursor = MagicMock(return_value=cursor_rows())
+
+    lines = [line async for line in agent.export_movements()]
+
+    assert lines == ['{"id":"movement-1"}', '{"id":"movement-2"}']
+    query = connection.cursor.call_args[0][0]
+    assert 'row_to_json' in query
+    assert connection.cursor.call_args.kwargs['prefetch'] == 2
+    connection.transaction.assert_called_once_with(isolation='repeatable_read', readonly=True)
+
+
+@pytest.mark.asyncio
+async def test_search_movements_by_warehouse_reads_both_sides():
+    """Тест поиска перемещений склада по отправителю и получателю с ключом курсора."""
+    agent, connection = setup_db_mock()
+    timestamp = datetime.datetime(2025, 2, 18, 12, 0, tzinfo=datetime.UTC)
+    connection.fetch.return_value = [
+        make_movement_row(
+            'movement-2',
+            source_warehouse_id='warehouse-1',
+            departure_time=timestamp,
+            departure_quantity=3,
+        )
+    ]
+
+    result = await agent.search_movements(
+        warehouse_id='warehouse-1', after=(timestamp, 'movement-1'), limit=10
+    )
+
+    assert result[0].movement_id == 'movement-2'
+    query, *args = connection.fetch.call_args[0]
+    assert 'source_warehouse_id = $4' in query
+    assert 'destination_warehouse_id = $4' in query
+    assert 'UNION' in query
+    # Внутренние выборки и внешняя используют один и тот же параметр лимита
+    assert query.count('LIMIT $3') == 3
+    assert query.rstrip().endswith('LIMIT $3')
+    assert args == [timestamp, 'movement-1', 10, 'warehouse-1']
+
+
+@pytest.mark.asyncio
+async def test_partitioned_upsert_routes_movements():
+    """Тест записи перемещения через таблицу маршрутов в секционированном режиме."""
+    agent, connection = setup_db_mock()
+    agent.movements_partitioned = True
+    agent.queries = build_queries('text', True)
+    connection.fetch.return_value = [make_movement_row('movement-1', departure_quantity=5)]
+
+    movement = agent._movement_fields('product-1')
+    movement['departure_quantity'] = 5
+    await agent._upsert_movements(connection, {'movement-1': movement})
+
+    query = connection.fetch.call_args[0][0]
+    assert 'INSERT INTO movement_routes' in query
+    assert 'ON CONFLICT (id, moved_at)' in query
+
+
+@pytest.mark.asyncio
+async def test_search_movements_partitioned_prunes_by_moved_at():
+    """Тест: в секционированном режиме нижние границы времени повторяются для moved_at."""
+    agent, connection = setup_db_mock()
+    agent.movements_partitioned = True
+    timestamp = datetime.datetime(2025, 2, 18, 12, 0, tzinfo=datetime.UTC)
+    connection.fetch.return_value = []
+
+    await agent.search_movements(time_from=timestamp, after=(timestamp, 'movement-1'))
+
+    query, *args = connection.fetch.call_args[0]
+    assert 'moved_at >= $1' in query
+    assert 'moved_at >= $2' in query
+    assert args == [timestamp, timestamp, 'movement-1', 100]
+
+
+@pytest.mark.asyncio
+async def test_ensure_movement_partitions_moves_rows_from_default():
+    """Тест: строки месяца из секции по умолчанию переносятся в создаваемую секцию."""
+    agent, connection = setup_db_mock()
+    agent.movements_partitions_ahead = 1
+    # секция по умолчанию есть; строки есть только для следующего месяца
+    connection.fetchval.side_effect = [True, False, True]
+    connection.execute.return_value = 'INSERT 0 2'
+
+    with patch('app.agents.db_agent.datetime') as clock:
+        clock.now.return_value = datetime.datetime(2025, 3, 10, tzinfo=datetime.UTC)
+        await agent.ensure_movement_partitions()
+
+    statements = [call[0][0] for call in connection.execute.call_args_list]
+    assert any('movements_p202503 PARTITION OF movements' in q for q in statements)
+    assert not any('movements_p202504 PARTITION OF movements' in q for q in statements)
+    assert 'LOCK TABLE movements_default IN EXCLUSIVE MODE' in statements
+    move = next(call[0] for call in connection.execute.call_args_list if 'DELETE' in call[0][0])
+    assert 'INSERT INTO movements_p202504' in move[0]
+    assert move[1:] == (
+        datetime.datetime(2025, 4, 1, tzinfo=datetime.UTC),
+        datetime.datetime(2025, 5, 1, tzinfo=datetime.UTC),
+    )
+    assert any(
+        q.startswith('ALTER TABLE movements ATTACH PARTITION movements_p202504') for q in statements
+    )
+    assert statements.index('LOCK TABLE movements_default IN EXCLUSIVE MODE') < statements.index(
+        move[0]
+    )
+
+
+@pytest.mark.asyncio
+async def test_archive_movement_partitions(tmp_path):
+    """Тест отсоединения с CONCURRENTLY, выгрузки в gzip CSV и удаления старой секции."""
+    agent, connection = setup_db_mock()
+    agent.movements_retention_months = 12
+    agent.movements_archive_dir = str(tmp_path)
+    # блокировка взята, CONCURRENTLY доступен, секции по умолчанию нет
+    connection.fetchval.side_effect = [True, True, False]
+    connection.fetch.return_value = [
+        {'relname': 'movements_p200001', 'attached': True, 'detach_pending': False},
+        {'relname': 'movements_p200002', 'attached': True, 'detach_pending': True},
+        {'relname': f'movements_p{datetime.date.today():%Y%m}', 'attached': True},
+    ]
+
+    async def copy_from_table(table, output, **kwargs):
+        with open(output, 'w') as f:
+            f.write('id\nmovement-1\n')
+
+    connection.copy_from_table = AsyncMock(side_effect=copy_from_table)
+
+    await agent.archive_movement_partitions()
+
+    statements = [call[0][0] for call in connection.execute.call_args_list]
+    assert 'ALTER TABLE movements DETACH PARTITION movements_p200001 CONCURRENTLY' in statements
+    # Прерванное отсоединение дорабатывается
+    assert 'ALTER TABLE movements DETACH PARTITION movements_p200002 FINALIZE' in statements
+    assert 'DROP TABLE movements_p200001' in statements
+    assert connection.copy_from_table.call_count == 2
+    connection.transaction.assert_called()
+
+    with gzip.open(tmp_path / 'movements_p200001.csv.gz', 'rt') as f:
+        assert f.read() == 'id\nmovement-1\n'
+    assert not (tmp_path / 'movements_p200001.csv').exists()
+
+
+@pytest.mark.asyncio
+async def test_archive_movement_partitions_with_default_partition(tmp_path):
+    """
+    Тест: при секции по умолчанию секция отсоединяется с lock_timeout, а при занятой
+    таблице откладывается; устаревшие строки секции по умолчанию выгружаются.
+    """
+    agent, connection = setup_db_mock()
+    agent.movements_retention_months = 12
+    agent.movements_archive_dir = str(tmp_path)
+    # блокировка взята, CONCURRENTLY недоступен, секция по умолчанию есть
+    connection.fetchval.side_effect = [True, False, True]
+    connection.fetch.return_value = [
+        {'relname': 'movements_p200001', 'attached': True, 'detach_pending': False},
+        {'relname': 'movements_default', 'attached': True, 'detach_pending': False},
+    ]
+
+    async def execute(statement, *args):
+        if 'DETACH PARTITION' in statement:
+            raise asyncpg.LockNotAvailableError('canceling statement due to lock timeout')
+
+    connection.execute.side_effect = execute
+
+    async def copy_from_query(query, *args, output, **kwargs):
+        with open(output, 'w') as f:
+            f.write('id\nmovement-1\n')
+        return 'COPY 1'
+
+    connection.copy_from_query = AsyncMock(side_effect=copy_from_query)
+
+    await agent.archive_movement_partitions()
+
+    statements = [call[0][0] for call in connection.execute.call_args_list]
+    assert 'SET LOCAL lock_timeout = 1000' in statements
+    assert 'ALTER TABLE movements DETACH PARTITION movements_p200001' in statements
+    assert not any('DROP TABLE' in s for s in statements)
+    assert not any('DETACH PARTITION movements_default' in s for s in statements)
+    connection.copy_from_table.assert_not_called()
+
+    query = connection.copy_from_query.call_args.args[0]
+    assert query == 'DELETE FROM movements_default WHERE moved_at < $1 RETURNING *'
+    archives = list(tmp_path.glob('movements_default_*.csv.gz'))
+    assert len(archives) == 1
+    with gzip.open(archives[0], 'rt') as f:
+        assert f.read() == 'id\nmovement-1\n'
+
+
+@pytest.mark.asyncio
+async def test_uuid_mode_skips_lookup_of_non_uuid_ids():
+    """Тест: в режиме uuid заведомо несуществующий не-UUID не отправляется в БД."""
+    agent, connection = setup_db_mock()
+    agent.id_type = 'uuid'
+
+    assert await agent.get_movement_info('not-a-uuid') is None
+    connection.fetchrow.assert_not_called()
+
+
+def test_normalize_id_accepts_postgres_uuid_forms_only():
+    """Тест: принимаются те же записи UUID, что и в PostgreSQL, результат - канонический."""
+    canonical = 'a0eebc99-9c0b-4ef8-bb6d-6bb9bd380a11'
+    for value in (
+        'A0EEBC99-9C0B-4EF8-BB6D-6BB9BD380A11',
+        '{a0eebc99-9c0b-4ef8-bb6d-6bb9bd380a11}',
+        'a0eebc999c0b4ef8bb6d6bb9bd380a11',
+        'a0ee-bc99-9c0b-4ef8-bb6d-6bb9-bd38-0a11',
+    ):
+        assert normalize_id(value, 'uuid') == canonical
+
+    for value in (
+        'urn:uuid:a0eebc99-9c0b-4ef8-bb6d-6bb9bd380a11',
+        '{a0eebc99-9c0b-4ef8-bb6d-6bb9bd380a11',
+        'a0eebc99-9c0b-4ef8-bb6d-6bb9bd380a11-',
+        'not-a-uuid',
+    ):
+        with pytest.raises(ValueError):
+            normalize_id(value, 'uuid')
+
+    assert normalize_id('WH-1', 'text') == 'WH-1'
+
+
+@pytest.mark.asyncio
+async def test_get_warehouse_products_info_matches_canonical_ids():
+    """Тест: строки из БД в канонической записи находятся по любой записи UUID запроса."""
+    agent, connection = setup_db_mock()
+    agent.id_type = 'uuid'
+    warehouse_id = 'a0eebc99-9c0b-4ef8-bb6d-6bb9bd380a11'
+    product_id = 'b0eebc99-9c0b-4ef8-bb6d-6bb9bd380a12'
+    connection.fetch.return_value = [
+        {'warehouse_id': warehouse_id, 'product_id': product_id, 'quantity': 4, 'version': 1}
+    ]
+
+    infos = await agent.get_warehouse_products_info(
+        [(warehouse_id.upper(), product_id), ('urn:uuid:' + warehouse_id, product_id)]
+    )
+
+    assert [info.quantity for info in infos] == [4, 0]
+    assert connection.fetch.call_args.args[1:] == ([warehouse_id], [product_id])
+
+
+@pytest.mark.asyncio
+async def test_init_connection_prepares_hot_queries():
+    """Тест: горячие запросы выполняются на новом соединении с NULL и откатом."""
+    agent = DBAgent()
+    agent.prepared_queries = ['get_quantity', 'register_events', 'insert_warehouse']
+    connection = AsyncMock()
+    transaction = MagicMock()
+    transaction.start = AsyncMock()
+    transaction.rollback = AsyncMock()
+    savepoint = AsyncContextManagerMock(return_value=None)
+    connection.transaction = MagicMock(side_effect=[transaction, savepoint, savepoint, savepoint])
+    connection.fetch.side_effect = [
+        [],
+        [],
+        asyncpg.NotNullViolationError('null value in column "id"'),
+    ]
+
+    await agent._init_connection(connection)
+
+    connection.set_type_codec.assert_called_once()
+    assert [call.args for call in connection.fetch.call_args_list] == [
+        (agent.queries['get_quantity'].sql, None, None),
+        (agent.queries['register_events'].sql, None),
+        (agent.queries['insert_warehouse'].sql, None),
+    ]
+    transaction.rollback.assert_called_once()
+    connection._prepare.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_pgbouncer_mode_disables_prepared_statements():
+    """Тест: в режиме PgBouncer кеш выражений отключен и запросы не подготавливаются."""
+    agent = DBAgent()
+    pool = MagicMock()
+    pool.acquire = MagicMock(return_value=AsyncContextManagerMock(AsyncMock()))
+    pool.expire_connections = AsyncMock()
+
+    with (
+        patch('app.agents.db_agent.asyncpg.create_pool', AsyncMock(return_value=pool)) as create,
+        patch(
+            'app.agents.db_agent.migrations.current_version',
+            AsyncMock(return_value=migrations.LATEST_VERSION),
+        ),
+        patch.object(agent, '_detect_schema', AsyncMock()),
+        patch.object(agent, 'warm_known_entities', AsyncMock()),
+        patch.object(agent, '_maintenance_loop', AsyncMock()),
+    ):
+        await agent.initialize(
+            {
+                'db_pgbouncer': True,
+                'db_movements_partitioned': False,
+            }
+        )
+        await agent.maintenance_task
+
+    assert create.call_args.kwargs['statement_cache_size'] == 0
+    assert agent.prepared_queries == []
+    pool.expire_connections.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_migrate_on_startup_brings_fresh_database_to_latest():
+    """Тест: при db_migrate_on_startup пустая база доводится до последней версии."""
+    agent = DBAgent()
+    state = {'table': False, 'version': 0}
+    connection = AsyncMock()
+    connection.transaction = MagicMock(return_value=AsyncContextManagerMock(None))
+
+    async def fetchval(query, *args):
+        if 'to_regclass' in query:
+            return state['table']
+        if 'max(version)' in query:
+            return state['version']
+        return 'pg_try_advisory_lock' in query
+
+    async def execute(query, *args):
+        if 'CREATE TABLE IF NOT EXISTS schema_version' in query:
+            state['table'] = True
+        elif 'INSERT INTO schema_version' in query:
+            state['version'] = args[0]
+
+    connection.fetchval.side_effect = fetchval
+    connection.execute.side_effect = execute
+    pool = MagicMock()
+    pool.acquire = MagicMock(return_value=AsyncContextManagerMock(connection))
+    pool.expire_connections = AsyncMock()
+
+    async def apply(conn, config):
+        pass
+
+    pending = [
+        migrations.Migration(version, f'migration {version}', apply)
+        for version in range(1, migrations.LATEST_VERSION + 1)
+    ]
+    pending[-2] = pending[-2]._replace(transactional=False)
+    with (
+        patch('app.agents.db_agent.asyncpg.create_pool', AsyncMock(return_value=pool)),
+        patch.object(migrations, 'MIGRATIONS', pending),
+        patch.object(agent, '_detect_schema', AsyncMock()),
+        patch.object(agent, 'warm_known_entities', AsyncMock()),
+        patch.object(agent, '_maintenance_loop', AsyncMock()),
+    ):
+        await agent.initialize({'db_movements_partitioned': False, 'db_migrate_on_startup': True})
+        await agent.maintenance_task
+
+    assert state['version'] == migrations.LATEST_VERSION
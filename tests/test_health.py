@@ -0,0 +1,70 @@
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+
+from app.health import HealthCheck
+
+
+class AsyncContextManagerMock:
+    def __init__(self, return_value):
+        self.return_value = return_value
+
+    async def __aenter__(self):
+        return self.return_value
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+@pytest.fixture
+def health_check():
+    health_check = HealthCheck()
+    pool = MagicMock()
+    pool.acquire = MagicMock(return_value=AsyncContextManagerMock(AsyncMock()))
+    health_check.set_db_pool(pool)
+    consumer = MagicMock()
+    consumer._client.cluster.brokers.return_value = {'broker-1'}
+    health_check.set_kafka_consumer(consumer)
+    health_check.set_ready(True)
+    return health_check
+
+
+@pytest.mark.asyncio
+async def test_readiness_degraded_on_kafka_lag(health_check):
+    """Тест: отставание выше порога переводит готовность в degraded."""
+    lag = 500
+    health_check.set_kafka_lag(lambda: lag, 1000)
+
+    status = await health_check.readiness_check()
+    assert status.status == 'up'
+    assert status.checks['kafka_lag'] == {'status': 'up', 'lag': 500}
+
+    lag = 1500
+    status = await health_check.readiness_check()
+    assert status.status == 'degraded'
+    assert status.checks['kafka_lag']['status'] == 'degraded'
+
+
+@pytest.mark.asyncio
+async def test_readiness_down_takes_precedence_over_lag(health_check):
+    """Тест: неготовый сервис остается down даже при большом отставании."""
+    health_check.set_kafka_lag(lambda: 1500, 1000)
+    health_check.set_ready(False)
+
+    status = await health_check.readiness_check()
+    assert status.status == 'down'
+
+
+@pytest.mark.asyncio
+async def test_readiness_degraded_without_cache_invalidation(health_check):
+    """Тест: неработающая рассылка изменений кеша переводит готовность в degraded."""
+    in_sync = False
+    health_check.set_cache_invalidation(lambda: in_sync)
+
+    status = await health_check.readiness_check()
+    assert status.status == 'degraded'
+    assert status.checks['cache_invalidation']['status'] == 'degraded'
+
+    in_sync = True
+    status = await health_check.readiness_check()
+    assert status.status == 'up'
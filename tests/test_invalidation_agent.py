@@ -0,0 +1,194 @@
+import asyncio
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, MagicMock, call, patch
+
+import pytest
+from aiokafka import TopicPartition
+from aiokafka.errors import KafkaError
+
+from app.agents.invalidation_agent import InvalidationAgent
+from app.models import WarehouseProductInfo
+
+
+@pytest.mark.asyncio
+async def test_initialize_disabled():
+    """Тест: без cache_invalidation_enabled потребитель не создается."""
+    with patch('app.agents.invalidation_agent.AIOKafkaConsumer') as mock_consumer:
+        agent = InvalidationAgent(MagicMock())
+        await agent.initialize({})
+
+    mock_consumer.assert_not_called()
+    assert agent.consumer is None
+
+
+@pytest.mark.asyncio
+async def test_initialize_without_group():
+    """Тест: реплика читает топик без группы потребителей и без коммитов."""
+    with patch('app.agents.invalidation_agent.AIOKafkaConsumer') as mock_consumer:
+        mock_consumer.return_value = AsyncMock()
+        agent = InvalidationAgent(MagicMock())
+        await agent.initialize(
+            {
+                'cache_invalidation_enabled': True,
+                'kafka_group_id': 'warehouse',
+                'instance_id': 'replica-1',
+            }
+        )
+
+    kwargs = mock_consumer.call_args.kwargs
+    assert mock_consumer.call_args.args == ()
+    assert kwargs['group_id'] is None
+    assert kwargs['enable_auto_commit'] is False
+    mock_consumer.return_value.start.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_assign_reads_all_partitions_from_end():
+    """Тест ручного назначения всех партиций топика с чтением с конца."""
+    agent = InvalidationAgent(MagicMock())
+    agent.consumer = AsyncMock()
+    agent.consumer.assign = MagicMock()
+    agent.consumer.partitions_for_topic = MagicMock(return_value={1, 0})
+
+    await agent._assign()
+
+    partitions = [
+        TopicPartition('warehouse_cache_invalidation', 0),
+        TopicPartition('warehouse_cache_invalidation', 1),
+    ]
+    agent.consumer.assign.assert_called_once_with(partitions)
+    agent.consumer.seek_to_end.assert_called_once_with(*partitions)
+
+
+@pytest.mark.asyncio
+async def test_consume_loop_restarts_and_requests_resync():
+    """Тест: после сбоя чтение перезапускается, а состояние перечитывается."""
+    agent = InvalidationAgent(MagicMock())
+    agent.enabled = True
+    agent.retry_backoff = 0
+    agent._assign = AsyncMock()
+    calls = []
+
+    async def consume(handler):
+        calls.append(agent.in_sync)
+        if len(calls) == 1:
+            raise RuntimeError('broker went away')
+        raise asyncio.CancelledError
+
+    agent._consume = consume
+    sync_handler = MagicMock()
+    agent.sync_handler = sync_handler
+
+    with pytest.raises(asyncio.CancelledError):
+        await agent._consume_loop(AsyncMock())
+
+    assert calls == [True, True]
+    assert sync_handler.call_args_list == [call(False), call(True)]
+
+
+@pytest.mark.asyncio
+async def test_publish_failure_is_retried():
+    """Тест: неотправленные изменения отправляются повторно вместе со следующими."""
+    kafka_agent = MagicMock()
+    kafka_agent.producer.send = AsyncMock(side_effect=KafkaError('down'))
+    agent = InvalidationAgent(kafka_agent)
+    agent.enabled = True
+    agent.retry_backoff = 3600
+
+    await agent.publish({'movement:1': None})
+    assert agent.pending == {'movement:1': None}
+
+    sent = []
+    kafka_agent.producer.send = AsyncMock(
+        side_effect=lambda topic, message, key: sent.append(message['key']) or AsyncMock()()
+    )
+    await agent.publish({'movement:2': None})
+
+    assert sent == ['movement:1', 'movement:2']
+    assert agent.pending == {}
+    await agent.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_publish_overflow_requests_resync():
+    """Тест: при переполнении очереди неотправленных рассылается команда перечитать."""
+    kafka_agent = MagicMock()
+    kafka_agent.producer.send = AsyncMock(side_effect=KafkaError('down'))
+    agent = InvalidationAgent(kafka_agent)
+    agent.enabled = True
+    agent.retry_backoff = 3600
+    agent.max_pending = 1
+
+    await agent.publish({'movement:1': None, 'movement:2': None})
+    assert agent.pending == {}
+    assert agent.resync_pending is True
+
+    kafka_agent.producer.send = AsyncMock(return_value=AsyncMock()())
+    kafka_agent.producer.send_and_wait = AsyncMock()
+    await agent.publish({'movement:3': None})
+
+    kafka_agent.producer.send_and_wait.assert_called_once_with(
+        'warehouse_cache_invalidation', {'origin': agent.instance_id, 'resync': True}
+    )
+    assert agent.resync_pending is False
+    await agent.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_publish_keys_messages_by_cache_key():
+    """Тест публикации изменений с ключом сообщения, равным ключу кеша."""
+    kafka_agent = MagicMock()
+    kafka_agent.producer.send = AsyncMock(return_value=AsyncMock()())
+    agent = InvalidationAgent(kafka_agent)
+    agent.enabled = True
+    agent.instance_id = 'replica-1'
+
+    stock = WarehouseProductInfo(warehouse_id='wh-1', product_id='p-1', quantity=5, version=2)
+    await agent.publish({'warehouse_product:wh-1:p-1': stock})
+
+    args, kwargs = kafka_agent.producer.send.call_args
+    assert args[0] == 'warehouse_cache_invalidation'
+    assert args[1] == {
+        'origin': 'replica-1',
+        'key': 'warehouse_product:wh-1:p-1',
+        'value': {'warehouse_id': 'wh-1', 'product_id': 'p-1', 'quantity': 5},
+        'version': 2,
+    }
+    assert kwargs['key'] == b'warehouse_product:wh-1:p-1'
+
+
+@pytest.mark.asyncio
+async def test_consume_skips_own_messages():
+    """Тест: реплика не применяет собственные изменения повторно."""
+    agent = InvalidationAgent(MagicMock())
+    agent.instance_id = 'replica-1'
+
+    async def records():
+        yield SimpleNamespace(value={'origin': 'replica-1', 'key': 'movement:1', 'value': None})
+        yield SimpleNamespace(value={'origin': 'replica-2', 'key': 'movement:2', 'value': None})
+
+    agent.consumer = records()
+    handler = AsyncMock()
+
+    await agent._consume(handler)
+
+    handler.assert_called_once_with('movement:2', None, None)
+
+
+@pytest.mark.asyncio
+async def test_consume_resync_message():
+    """Тест: команда перечитать состояние от другой реплики передается sync_handler."""
+    agent = InvalidationAgent(MagicMock())
+    agent.instance_id = 'replica-1'
+    agent.sync_handler = MagicMock()
+
+    async def records():
+        yield SimpleNamespace(value={'origin': 'replica-2', 'resync': True})
+
+    agent.consumer = records()
+    handler = AsyncMock()
+
+    await agent._consume(handler)
+
+    agent.sync_handler.assert_called_once_with(True)
+    handler.assert_not_called()
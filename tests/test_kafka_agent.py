@@ -1,8 +1,14 @@
-from unittest.mock import AsyncMock, patch
+import asyncio
+import contextlib
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, MagicMock, patch
 
 import pytest
+from aiokafka import TopicPartition
+from aiokafka.errors import CommitFailedError
 
-from app.agents.kafka_agent import KafkaAgent
+from app.agents.kafka_agent import KafkaAgent, PartitionOffsetTracker
+from app.models import KafkaMessage
 
 
 @pytest.fixture
@@ -22,6 +28,7 @@ async def test_initialize(config):
         patch('app.agents.kafka_agent.AIOKafkaProducer') as mock_producer,
     ):
         mock_consumer_instance = AsyncMock()
+        mock_consumer_instance.subscribe = MagicMock()
         mock_producer_instance = AsyncMock()
         mock_consumer.return_value = mock_consumer_instance
         mock_producer.return_value = mock_producer_instance
@@ -35,6 +42,8 @@ async def test_initialize(config):
         mock_consumer_instance.start.assert_called_once()
         mock_producer_instance.start.assert_called_once()
 
+        assert mock_consumer_instance.subscribe.call_args[0][0] == ['warehouse_movements']
+
 
 @pytest.mark.asyncio
 async def test_send_message():
@@ -49,3 +58,332 @@ async def test_send_message():
     await agent.send_message(test_topic, test_message)
 
     agent.producer.send_and_wait.assert_called_once_with(test_topic, test_message)
+
+
+def make_record(movement_id='movement-1', event='arrival', offset=0, product_id='product-1'):
+    return SimpleNamespace(
+        topic='warehouse_movements',
+        partition=0,
+        offset=offset,
+        value={
+            'id': f'{movement_id}-{event}',
+            'source': 'WH-1234',
+            'specversion': '1.0',
+            'type': 'ru.retail.warehouses.movement',
+            'datacontenttype': 'application/json',
+            'dataschema': 'ru.retail.warehouses.movement.v1.0',
+            'time': 1737439421623,
+            'subject': f'WH-1234:{event.upper()}',
+            'destination': 'ru.retail.warehouses',
+            'data': {
+                'movement_id': movement_id,
+                'warehouse_id': 'warehouse-1',
+                'timestamp': '2025-02-18T14:34:56Z',
+                'event': event,
+                'product_id': product_id,
+                'quantity': 10,
+            },
+        },
+    )
+
+
+@pytest.mark.asyncio
+async def test_collect_batch_respects_max_size():
+    """Тест набора пачки сообщений не больше batch_max_size."""
+    agent = KafkaAgent()
+    agent.running = True
+    agent.batch_max_size = 3
+    agent.consumer = AsyncMock()
+    agent.consumer.getmany = AsyncMock(
+        side_effect=[
+            {'tp-0': [make_record('m1'), make_record('m2')]},
+            {'tp-1': [make_record('m3')]},
+        ]
+    )
+
+    batch = await agent._collect_batch()
+
+    assert [record.value['data']['movement_id'] for record in batch] == ['m1', 'm2', 'm3']
+    assert agent.consumer.getmany.call_args_list[1].kwargs['max_records'] == 1
+
+
+@pytest.mark.asyncio
+async def test_start_consuming_batch():
+    """Тест передачи пачки сообщений обработчику с пропуском невалидных записей."""
+    agent = KafkaAgent()
+    agent.consumer = AsyncMock()
+    agent.batch_linger_ms = 0
+
+    async def handler(messages):
+        handled.extend(messages)
+        agent.running = False
+
+    handled = []
+    invalid = SimpleNamespace(
+        topic='warehouse_movements', partition=0, offset=1, value={'subject': 'x'}
+    )
+    agent.consumer.getmany = AsyncMock(return_value={'tp-0': [make_record('m1'), invalid]})
+
+    await agent.start_consuming_batch(handler)
+
+    assert len(handled) == 1
+    assert handled[0].data.movement_id == 'm1'
+    agent.consumer.commit.assert_called_once_with({TopicPartition('warehouse_movements', 0): 2})
+
+
+@pytest.mark.asyncio
+async def test_start_consuming_batch_failure_rewinds():
+    """Тест повторного чтения пачки без коммита, если обработчик упал."""
+    agent = KafkaAgent()
+    agent.consumer = AsyncMock()
+    agent.consumer.seek = MagicMock()
+    agent.batch_linger_ms = 0
+    agent.retry_backoff_ms = 0
+
+    async def handler(messages):
+        agent.running = False
+        raise ConnectionError('db is down')
+
+    agent.consumer.getmany = AsyncMock(
+        return_value={'tp-0': [make_record('m1', offset=5), make_record('m2', offset=6)]}
+    )
+
+    await agent.start_consuming_batch(handler)
+
+    agent.consumer.seek.assert_called_once_with(TopicPartition('warehouse_movements', 0), 5)
+    agent.consumer.commit.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_start_consuming_batch_survives_commit_failure():
+    """Тест: сбой коммита во время ребалансировки не останавливает чтение."""
+    agent = KafkaAgent()
+    tp = TopicPartition('warehouse_movements', 0)
+    agent.consumer = AsyncMock()
+    agent.consumer.seek = MagicMock()
+    agent.consumer.assignment = MagicMock(return_value={tp})
+    agent.consumer.committed = AsyncMock(return_value=5)
+    agent.consumer.commit = AsyncMock(side_effect=[CommitFailedError('rebalance'), None])
+    agent.batch_linger_ms = 0
+
+    async def handler(messages):
+        handled.extend(message.data.movement_id for message in messages)
+        if len(handled) == 2:
+            agent.running = False
+
+    handled = []
+    agent.consumer.getmany = AsyncMock(
+        side_effect=[
+            {'tp-0': [make_record('m1', offset=5)]},
+            {'tp-0': [make_record('m1', offset=5)]},
+        ]
+    )
+
+    await agent.start_consuming_batch(handler)
+
+    assert handled == ['m1', 'm1']
+    agent.consumer.seek.assert_called_once_with(tp, 5)
+    assert agent.consumer.commit.call_count == 2
+    assert agent.offset_tracker.committed[tp] == 6
+
+
+@pytest.mark.asyncio
+async def test_worker_marks_offset_done_only_after_success():
+    """Тест: воркер повторяет сообщение после временной ошибки и только затем отмечает его."""
+    agent = KafkaAgent()
+    agent.running = True
+    agent.retry_backoff_ms = 0
+    tp = TopicPartition('warehouse_movements', 0)
+    agent.offset_tracker.track(tp, 0)
+    message = KafkaMessage(**make_record().value)
+
+    calls = []
+
+    async def handler(message):
+        calls.append(message)
+        if len(calls) == 1:
+            assert agent.offset_tracker.commit_offsets() == {}
+            raise ConnectionError('db is down')
+
+    agent.message_handler = handler
+    queue = asyncio.Queue()
+    await queue.put((tp, 0, message))
+    task = asyncio.create_task(agent._worker_loop(queue))
+    await queue.join()
+    task.cancel()
+
+    assert len(calls) == 2
+    assert agent.offset_tracker.commit_offsets() == {tp: 1}
+
+
+def test_partition_offset_tracker():
+    """Тест вычисления безопасного смещения для коммита."""
+    tracker = PartitionOffsetTracker()
+    tp = TopicPartition('warehouse_movements', 0)
+
+    for offset in range(5):
+        tracker.track(tp, offset)
+
+    tracker.done(tp, 0)
+    tracker.done(tp, 1)
+    tracker.done(tp, 3)
+
+    # Смещение 2 еще обрабатывается - коммитить можно только до него
+    assert tracker.commit_offsets() == {tp: 2}
+    tracker.mark_committed({tp: 2})
+    assert tracker.commit_offsets() == {}
+
+    tracker.done(tp, 2)
+    tracker.done(tp, 4)
+    assert tracker.commit_offsets() == {tp: 5}
+
+
+def test_partition_offset_tracker_event_times():
+    """Тест: коммит возвращает времена событий только покрытых им смещений."""
+    tracker = PartitionOffsetTracker()
+    tp = TopicPartition('warehouse_movements', 0)
+
+    for offset in range(3):
+        tracker.track(tp, offset)
+        tracker.record_event_time(tp, offset, 100.0 + offset, 50.0 + offset)
+
+    assert sorted(tracker.mark_committed({tp: 2})) == [(100.0, 50.0), (101.0, 51.0)]
+    assert tracker.mark_committed({tp: 2}) == []
+    assert tracker.mark_committed({tp: 3}) == [(102.0, 52.0)]
+
+
+@pytest.mark.asyncio
+async def test_update_lag():
+    """Тест расчета отставания от закоммиченных смещений и удаления отозванных партиций."""
+    agent = KafkaAgent()
+    tp0 = TopicPartition('warehouse_movements', 0)
+    tp1 = TopicPartition('warehouse_movements', 1)
+    agent.consumer = AsyncMock()
+    agent.consumer.assignment = MagicMock(return_value={tp0, tp1})
+    agent.consumer.end_offsets.return_value = {tp0: 100, tp1: 50}
+    agent.consumer.committed.return_value = 20
+    agent.offset_tracker.mark_committed({tp0: 90})
+
+    assert agent.total_lag() is None
+    with patch('app.agents.kafka_agent.KAFKA_CONSUMER_LAG') as lag_metric:
+        await agent.update_lag()
+
+        assert agent.lag == {tp0: 10, tp1: 30}
+        assert agent.total_lag() == 40
+        agent.consumer.committed.assert_called_once_with(tp1)
+
+        agent.consumer.assignment.return_value = {tp0}
+        agent.consumer.end_offsets.return_value = {tp0: 100}
+        await agent.update_lag()
+
+    assert agent.total_lag() == 10
+    lag_metric.remove.assert_called_once_with('warehouse_movements', '1')
+
+
+@pytest.mark.asyncio
+async def test_start_consuming_concurrent():
+    """Тест параллельной обработки с сохранением порядка по ключу и коммитом смещений."""
+    agent = KafkaAgent()
+    agent.consumer = AsyncMock()
+    agent.workers = 4
+    agent.batch_linger_ms = 0
+    agent.commit_interval_ms = 0
+
+    records = [
+        make_record(f'm{offset}', offset=offset, product_id=f'product-{offset % 2}')
+        for offset in range(10)
+    ]
+    batches = [{'tp-0': records}]
+
+    async def getmany(timeout_ms, max_records):
+        if batches:
+            return batches.pop()
+        await asyncio.sleep(0.01)
+        return {}
+
+    agent.consumer.getmany = getmany
+
+    handled = []
+
+    async def handler(message):
+        await asyncio.sleep(0)
+        handled.append(message.data)
+        if len(handled) == len(records):
+            agent.running = False
+
+    await agent.start_consuming_concurrent(handler)
+    await agent.shutdown()
+
+    for product_id in ('product-0', 'product-1'):
+        movement_ids = [data.movement_id for data in handled if data.product_id == product_id]
+        expected = [
+            record.value['data']['movement_id']
+            for record in records
+            if record.value['data']['product_id'] == product_id
+        ]
+        assert movement_ids == expected
+
+    committed = agent.consumer.commit.call_args[0][0]
+    assert committed == {TopicPartition('warehouse_movements', 0): 10}
+
+
+class IdleConsumer:
+    """Потребитель, который отдает записи и затем ждет новых без конца."""
+
+    def __init__(self, records):
+        self.records = list(records)
+        self.commit = AsyncMock()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.records:
+            return self.records.pop(0)
+        await asyncio.Event().wait()
+
+
+@pytest.mark.asyncio
+async def test_start_consuming_commits_when_idle():
+    """Тест: после последнего сообщения смещение коммитится по таймеру, без новых сообщений."""
+    agent = KafkaAgent()
+    agent.consumer = IdleConsumer([make_record(offset=0)])
+    agent.commit_interval_ms = 10
+
+    task = asyncio.create_task(agent.start_consuming(AsyncMock()))
+    await asyncio.sleep(0.1)
+    task.cancel()
+    with contextlib.suppress(asyncio.CancelledError):
+        await task
+
+    agent.consumer.commit.assert_called_once_with({TopicPartition('warehouse_movements', 0): 1})
+
+
+@pytest.mark.asyncio
+async def test_shutdown_commits_processed_offsets():
+    """Тест коммита обработанных смещений при остановке."""
+    agent = KafkaAgent()
+    agent.consumer = AsyncMock()
+    tp = TopicPartition('warehouse_movements', 0)
+    agent.offset_tracker.track(tp, 4)
+    agent.offset_tracker.done(tp, 4)
+
+    await agent.shutdown()
+
+    agent.consumer.commit.assert_called_once_with({tp: 5})
+    agent.consumer.stop.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_send_dead_letter_keeps_message_and_reason():
+    """Тест отправки события в топик недоставленных вместе с причиной."""
+    agent = KafkaAgent()
+    agent.producer = AsyncMock()
+    message = KafkaMessage(**make_record().value)
+
+    await agent.send_dead_letter(message, ValueError('Invalid UUID identifier'))
+
+    topic, payload = agent.producer.send_and_wait.call_args.args
+    assert topic == 'warehouse_movements_dead_letter'
+    assert payload['error_type'] == 'ValueError'
+    assert payload['message']['data']['movement_id'] == 'movement-1'
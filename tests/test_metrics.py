@@ -0,0 +1,58 @@
+from unittest.mock import MagicMock
+
+from app.metrics import METRIC_SERIES_DROPPED, BoundedStockGauge, DBPoolCollector
+
+
+def collected(gauge):
+    (family,) = gauge.collect()
+    return {
+        (sample.labels['warehouse_id'], sample.labels['product_id']): sample.value
+        for sample in family.samples
+    }
+
+
+def test_bounded_stock_gauge_disabled_by_default():
+    """Тест: без настройки ряды остатков не создаются."""
+    gauge = BoundedStockGauge('test_stock_disabled', 'Test')
+
+    gauge.set('warehouse-1', 'product-1', 10)
+
+    assert collected(gauge) == {}
+
+
+def test_bounded_stock_gauge_drops_series_over_limit():
+    """Тест: пары сверх лимита отбрасываются и учитываются, известные обновляются."""
+    gauge = BoundedStockGauge('test_stock_limited', 'Test')
+    gauge.configure(2, ['product-1', 'product-2', 'product-3'])
+    dropped = METRIC_SERIES_DROPPED.labels(metric='test_stock_limited')
+    before = dropped._value.get()
+
+    gauge.set('warehouse-1', 'product-1', 10)
+    gauge.set('warehouse-1', 'product-2', 5)
+    gauge.set('warehouse-1', 'product-3', 7)
+    gauge.set('warehouse-1', 'product-1', 8)
+    # Товары вне списка отслеживаемых не учитываются вовсе
+    gauge.set('warehouse-1', 'product-4', 1)
+
+    assert collected(gauge) == {('warehouse-1', 'product-1'): 8, ('warehouse-1', 'product-2'): 5}
+    assert dropped._value.get() - before == 1
+
+
+def test_db_pool_collector_reads_pool_at_scrape_time():
+    """Тест: состояние пула берется в момент сбора метрик, без пула рядов нет."""
+    collector = DBPoolCollector()
+    connections, max_connections = collector.collect()
+    assert connections.samples == [] and max_connections.samples == []
+
+    pool = MagicMock()
+    pool.get_size.return_value = 8
+    pool.get_idle_size.return_value = 3
+    pool.get_max_size.return_value = 20
+    collector.set_pool(pool)
+
+    connections, max_connections = collector.collect()
+    assert {sample.labels['state']: sample.value for sample in connections.samples} == {
+        'idle': 3,
+        'busy': 5,
+    }
+    assert max_connections.samples[0].value == 20
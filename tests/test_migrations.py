@@ -0,0 +1,118 @@
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import asyncpg
+import pytest
+
+from app import migrations
+
+
+class AsyncContextManagerMock:
+    async def __aenter__(self):
+        return None
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+def make_connection():
+    connection = AsyncMock()
+    connection.transaction = MagicMock(return_value=AsyncContextManagerMock())
+    return connection
+
+
+@pytest.mark.asyncio
+async def test_migrate_skips_lock_when_up_to_date():
+    """Тест: при актуальной схеме блокировка не берется и миграции не выполняются."""
+    connection = make_connection()
+    connection.fetchval.side_effect = [True, migrations.LATEST_VERSION]
+
+    assert await migrations.migrate(connection, {}) == []
+    connection.execute.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_migrate_applies_pending_under_lock():
+    """Тест применения недостающих миграций под advisory lock с записью версий."""
+    connection = make_connection()
+    # версия 2, блокировка взята, после ее получения - тоже 2
+    connection.fetchval.side_effect = [True, 2, True, True, 2]
+    applied = []
+
+    async def apply(conn, config):
+        applied.append(config)
+
+    pending = [
+        migrations.Migration(1, 'one', apply),
+        migrations.Migration(2, 'two', apply),
+        migrations.Migration(3, 'three', apply),
+        migrations.Migration(4, 'four', apply, transactional=False),
+    ]
+    with patch.object(migrations, 'MIGRATIONS', pending):
+        assert await migrations.migrate(connection, {'key': 'value'}) == [3, 4]
+
+    assert len(applied) == 2
+    connection.fetchval.assert_any_call(
+        'SELECT pg_try_advisory_lock($1)', migrations.MIGRATIONS_LOCK
+    )
+    statements = [call[0] for call in connection.execute.call_args_list]
+    assert statements[-1] == ('SELECT pg_advisory_unlock($1)', migrations.MIGRATIONS_LOCK)
+    recorded = [s for s in statements if 'INSERT INTO schema_version' in s[0]]
+    assert [s[1:] for s in recorded] == [(3, 'three'), (4, 'four')]
+
+
+@pytest.mark.asyncio
+async def test_migrate_polls_version_while_locked_elsewhere():
+    """Тест: без блокировки миграции не выполняются, а версия перечитывается до актуальной."""
+    connection = make_connection()
+    # версия 2, блокировка занята; затем версия уже последняя
+    connection.fetchval.side_effect = [True, 2, False, True, migrations.LATEST_VERSION]
+
+    with patch('app.migrations.asyncio.sleep', AsyncMock()) as sleep:
+        assert await migrations.migrate(connection, {'db_migrate_poll_interval': 7}) == []
+
+    sleep.assert_called_once_with(7)
+    connection.execute.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_convert_ids_to_uuid_recreates_foreign_keys():
+    """Тест перевода колонок идентификаторов на uuid со снятием и возвратом внешних ключей."""
+    connection = make_connection()
+    connection.fetch.side_effect = [
+        [
+            {'table_name': 'warehouses', 'column_name': 'id'},
+            {'table_name': 'warehouse_products', 'column_name': 'warehouse_id'},
+            {'table_name': 'warehouse_products', 'column_name': 'quantity'},
+        ],
+        [
+            {
+                'table_name': 'warehouse_products',
+                'conname': 'warehouse_products_warehouse_id_fkey',
+                'definition': 'FOREIGN KEY (warehouse_id) REFERENCES warehouses(id)',
+            }
+        ],
+    ]
+
+    await migrations.convert_ids_to_uuid(connection, {'db_id_type': 'uuid'})
+
+    statements = [call[0][0] for call in connection.execute.call_args_list]
+    assert statements == [
+        'ALTER TABLE warehouse_products DROP CONSTRAINT warehouse_products_warehouse_id_fkey',
+        'ALTER TABLE warehouses ALTER COLUMN id TYPE uuid USING id::uuid',
+        'ALTER TABLE warehouse_products '
+        'ALTER COLUMN warehouse_id TYPE uuid USING warehouse_id::uuid',
+        'ALTER TABLE warehouse_products ADD CONSTRAINT warehouse_products_warehouse_id_fkey '
+        'FOREIGN KEY (warehouse_id) REFERENCES warehouses(id)',
+    ]
+
+
+@pytest.mark.asyncio
+async def test_convert_ids_to_uuid_keeps_text_for_non_uuid_ids():
+    """Тест: при не-UUID идентификаторах в данных схема остается текстовой."""
+    connection = make_connection()
+    connection.fetch.side_effect = [[{'table_name': 'warehouses', 'column_name': 'id'}], []]
+    connection.execute.side_effect = asyncpg.InvalidTextRepresentationError('invalid uuid')
+
+    await migrations.convert_ids_to_uuid(connection, {'db_id_type': 'uuid'})
+
+    connection.execute.assert_called_once()
@@ -0,0 +1,29 @@
+from datetime import date
+
+from app.agents.movement_partitions import (
+    add_months,
+    create_partition_sql,
+    partition_month,
+    partition_name,
+)
+
+
+def test_add_months_crosses_year():
+    """Тест перехода через границу года при сдвиге месяцев."""
+    assert add_months(date(2025, 11, 1), 3) == date(2026, 2, 1)
+    assert add_months(date(2025, 1, 1), -1) == date(2024, 12, 1)
+
+
+def test_partition_name_roundtrip():
+    """Тест разбора месяца из имени секции."""
+    assert partition_name(date(2025, 2, 1)) == 'movements_p202502'
+    assert partition_month('movements_p202502') == date(2025, 2, 1)
+    assert partition_month('movements_default') is None
+
+
+def test_create_partition_sql_uses_utc_bounds():
+    """Тест границ секции в UTC."""
+    sql = create_partition_sql(date(2025, 12, 1))
+
+    assert 'movements_p202512 PARTITION OF movements' in sql
+    assert "FROM ('2025-12-01T00:00:00+00:00') TO ('2026-01-01T00:00:00+00:00')" in sql
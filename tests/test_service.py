@@ -1,10 +1,16 @@
 import datetime
-from unittest.mock import AsyncMock
+from unittest.mock import AsyncMock, MagicMock, patch
 
+import asyncpg
 import pytest
+from aiokafka import TopicPartition
 
-from app.models import KafkaMessage, MovementData
+from app.agents.cache_agent import CacheAgent
+from app.agents.db_agent import SavedMovements
+from app.agents.kafka_agent import KafkaAgent
+from app.models import KafkaMessage, MovementData, MovementInfo, WarehouseProductInfo
 from app.service import WarehouseMonitoringService
+from tests.test_kafka_agent import make_record
 
 
 @pytest.fixture
@@ -28,6 +34,7 @@ def service(config):
     service = WarehouseMonitoringService(config)
     service.db_agent = AsyncMock()
     service.kafka_agent = AsyncMock()
+    service.kafka_agent.start_lag_monitor = MagicMock()
     service.cache_agent = AsyncMock()
     return service
 
@@ -46,32 +53,37 @@ async def test_initialize(service):
     assert service.running is True
 
 
-@pytest.mark.asyncio
-async def test_handle_kafka_message(service):
-    """Тест обработки сообщения Kafka."""
-
+def make_message(movement_id='test-movement-id', event='arrival'):
     movement_data = MovementData(
-        movement_id='test-movement-id',
+        movement_id=movement_id,
         warehouse_id='test-warehouse-id',
         timestamp=datetime.datetime.now(datetime.UTC),
-        event='arrival',
+        event=event,
         product_id='test-product-id',
         quantity=100,
     )
 
-    kafka_message = KafkaMessage(
-        id='test-message-id',
+    return KafkaMessage(
+        id=f'{movement_id}-{event}',
         source='WH-1234',
         specversion='1.0',
         type='ru.retail.warehouses.movement',
         datacontenttype='application/json',
         dataschema='ru.retail.warehouses.movement.v1.0',
         time=1234567890,
-        subject='WH-1234:ARRIVAL',
+        subject=f'WH-1234:{event.upper()}',
         destination='ru.retail.warehouses',
         data=movement_data,
     )
 
+
+@pytest.mark.asyncio
+async def test_handle_kafka_message(service):
+    """Тест обработки сообщения Kafka."""
+
+    kafka_message = make_message()
+    movement_data = kafka_message.data
+
     await service.handle_kafka_message(kafka_message)
 
     service.db_agent.save_movement_event.assert_called_once_with(
@@ -81,4 +93,240 @@ async def test_handle_kafka_message(service):
         timestamp=movement_data.timestamp,
         product_id=movement_data.product_id,
         quantity=movement_data.quantity,
+        event_id=kafka_message.id,
     )
+
+
+@pytest.mark.asyncio
+async def test_initialize_batch_mode(service):
+    """Тест запуска пакетного чтения Kafka."""
+    service.config['kafka_batch_enabled'] = True
+
+    await service.initialize()
+
+    service.kafka_agent.start_consuming_batch.assert_called_once_with(service.handle_kafka_batch)
+    service.kafka_agent.start_consuming.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_handle_kafka_batch(service):
+    """Тест пакетной записи сообщений Kafka одним вызовом DBAgent."""
+    service.cache_agent = MagicMock()
+    messages = [make_message('movement-1'), make_message('movement-2', 'departure')]
+
+    await service.handle_kafka_batch(messages)
+
+    service.db_agent.save_movement_events_batch.assert_called_once()
+    events = service.db_agent.save_movement_events_batch.call_args[0][0]
+    assert [event.movement_id for event in events] == ['movement-1', 'movement-2']
+    assert [event.event_type for event in events] == ['arrival', 'departure']
+    service.db_agent.save_movement_event.assert_not_called()
+    service.cache_agent.delete.assert_any_call('movement:movement-2')
+
+
+@pytest.mark.asyncio
+async def test_handle_kafka_batch_fallback(service):
+    """Тест поштучной обработки при ошибке пакетной записи."""
+    service.db_agent.save_movement_events_batch.side_effect = ValueError('negative')
+    messages = [make_message('movement-1'), make_message('movement-2')]
+
+    await service.handle_kafka_batch(messages)
+
+    assert service.db_agent.save_movement_event.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_batch_db_outage_is_not_committed(service):
+    """Тест: при недоступности БД пачка не коммитится и перечитывается."""
+    agent = KafkaAgent()
+    agent.consumer = AsyncMock()
+    agent.consumer.seek = MagicMock()
+    agent.batch_linger_ms = 0
+    agent.retry_backoff_ms = 0
+
+    async def save_batch(events):
+        agent.running = False
+        raise asyncpg.ConnectionDoesNotExistError('connection was closed')
+
+    service.db_agent.save_movement_events_batch.side_effect = save_batch
+    agent.consumer.getmany = AsyncMock(
+        return_value={'tp-0': [make_record('m1', offset=5), make_record('m2', offset=6)]}
+    )
+
+    await agent.start_consuming_batch(service.handle_kafka_batch)
+
+    agent.consumer.seek.assert_called_once_with(TopicPartition('warehouse_movements', 0), 5)
+    agent.consumer.commit.assert_not_called()
+    service.db_agent.save_movement_event.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_handle_kafka_batch_fallback_propagates_outage(service):
+    """Тест: сбой БД при поштучной обработке пробрасывается, а не учитывается как ошибка."""
+    service.db_agent.save_movement_events_batch.side_effect = ValueError('negative')
+    service.db_agent.save_movement_event.side_effect = asyncpg.InterfaceError('pool is closing')
+
+    with pytest.raises(asyncpg.InterfaceError):
+        await service.handle_kafka_batch([make_message('movement-1'), make_message('movement-2')])
+
+    assert service.db_agent.save_movement_event.call_count == 1
+
+
+@pytest.mark.asyncio
+async def test_handle_kafka_batch_skips_duplicates_in_processed(service):
+    """Тест: повторы из пачки не учитываются как обработанные сообщения."""
+    service.cache_agent = MagicMock()
+    messages = [make_message('movement-1'), make_message('movement-2')]
+    service.db_agent.save_movement_events_batch.return_value = SavedMovements(
+        [], [], event_ids=frozenset([messages[0].id])
+    )
+
+    with patch('app.service.KAFKA_MESSAGES_PROCESSED') as processed:
+        await service.handle_kafka_batch(messages)
+
+    processed.labels.return_value.inc.assert_called_once_with()
+
+
+@pytest.mark.asyncio
+async def test_handle_kafka_message_writes_through_cache(service):
+    """Тест записи в кеш состояния, возвращенного базой при обработке события."""
+    service.cache_agent = MagicMock()
+    kafka_message = make_message()
+    movement = MovementInfo(
+        movement_id='test-movement-id',
+        destination_warehouse='test-warehouse-id',
+        arrival_time=kafka_message.data.timestamp,
+        product_id='test-product-id',
+        quantity=100,
+    )
+    stock = WarehouseProductInfo(
+        warehouse_id='test-warehouse-id', product_id='test-product-id', quantity=150
+    )
+    service.db_agent.save_movement_event.return_value = SavedMovements([movement], [stock])
+
+    await service.handle_kafka_message(kafka_message)
+
+    service.cache_agent.set_if_newer.assert_any_call('movement:test-movement-id', movement)
+    service.cache_agent.set_if_newer.assert_any_call(
+        'warehouse_product:test-warehouse-id:test-product-id', stock
+    )
+    service.cache_agent.delete.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_handle_kafka_message_invalidates_without_write_through(service):
+    """Тест сброса ключей кеша при выключенном write-through."""
+    service.cache_agent = MagicMock()
+    service.cache_write_through = False
+
+    await service.handle_kafka_message(make_message())
+
+    service.cache_agent.set.assert_not_called()
+    service.cache_agent.delete.assert_any_call('movement:test-movement-id')
+
+
+@pytest.mark.asyncio
+async def test_update_cache_publishes_changes(service):
+    """Тест рассылки изменений кеша остальным репликам."""
+    service.cache_agent = MagicMock()
+    service.invalidation_agent = AsyncMock()
+    service.cache_write_through = False
+
+    await service.handle_kafka_message(make_message())
+
+    service.invalidation_agent.publish.assert_called_once_with(
+        {
+            'movement:test-movement-id': None,
+            'warehouse_product:test-warehouse-id:test-product-id': None,
+        }
+    )
+
+
+@pytest.mark.asyncio
+async def test_apply_remote_cache_change(service):
+    """Тест применения изменений кеша, полученных от другой реплики."""
+    service.cache_agent = CacheAgent()
+    service.cache_agent.set('warehouse_product:wh-1:p-1', 'old')
+
+    stock = {'warehouse_id': 'wh-1', 'product_id': 'p-1', 'quantity': 7}
+    await service.apply_remote_cache_change('warehouse_product:wh-1:p-1', stock, 3)
+    await service.apply_remote_cache_change('warehouse_product:wh-2:p-1', stock, 3)
+    await service.apply_remote_cache_change('movement:movement-1', None)
+
+    assert service.cache_agent.get('warehouse_product:wh-1:p-1').quantity == 7
+    assert 'warehouse_product:wh-2:p-1' not in service.cache_agent.cache
+
+
+@pytest.mark.asyncio
+async def test_apply_remote_cache_change_drops_stale_versions(service):
+    """Тест: изменение, пришедшее позже более нового, не затирает его."""
+    service.cache_agent = CacheAgent()
+    key = 'warehouse_product:wh-1:p-1'
+    service.cache_agent.set(
+        key, WarehouseProductInfo(warehouse_id='wh-1', product_id='p-1', quantity=9, version=5)
+    )
+
+    stale = {'warehouse_id': 'wh-1', 'product_id': 'p-1', 'quantity': 7}
+    await service.apply_remote_cache_change(key, stale, 4)
+    assert service.cache_agent.get(key).quantity == 9
+
+    # Без версии значение сравнить нельзя - ключ только сбрасывается
+    await service.apply_remote_cache_change(key, stale)
+    assert key not in service.cache_agent.cache
+
+
+@pytest.mark.asyncio
+async def test_list_warehouse_products_next_page(service):
+    """Тест определения следующей страницы по лишней записи."""
+    service.db_agent.list_warehouse_products.return_value = [
+        WarehouseProductInfo(warehouse_id='wh-1', product_id=f'p-{i}', quantity=1) for i in range(3)
+    ]
+
+    items, next_product_id = await service.list_warehouse_products('wh-1', limit=2)
+
+    assert [item.product_id for item in items] == ['p-0', 'p-1']
+    assert next_product_id == 'p-1'
+    service.db_agent.list_warehouse_products.assert_called_once_with('wh-1', None, 3, False)
+
+
+@pytest.mark.asyncio
+async def test_get_warehouse_product_info_from_projection(service):
+    """Тест ответа из проекции остатков без обращения к кешу и БД."""
+    service.stock_projection.enabled = True
+    service.stock_projection.ready = True
+    service.stock_projection.apply(
+        [WarehouseProductInfo(warehouse_id='warehouse-1', product_id='product-1', quantity=42)]
+    )
+
+    info = await service.get_warehouse_product_info('warehouse-1', 'product-1')
+
+    assert info.quantity == 42
+    service.cache_agent.get_or_set.assert_not_called()
+    service.db_agent.get_warehouse_product_quantity.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_uuid_ids_are_normalized_for_cache_keys(service):
+    """Тест: в режиме uuid ключ кеша строится по канонической записи идентификатора."""
+    service.db_agent.id_type = 'uuid'
+    movement_id = 'a0eebc99-9c0b-4ef8-bb6d-6bb9bd380a11'
+
+    await service.get_movement_info('{' + movement_id.upper() + '}')
+    assert service.cache_agent.get_or_set.call_args.args[0] == f'movement:{movement_id}'
+
+    assert await service.get_movement_info('urn:uuid:' + movement_id) is None
+    service.cache_agent.get_or_set.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_non_uuid_event_goes_to_dead_letter_topic(service):
+    """Тест: в режиме uuid событие с идентификатором не-UUID откладывается, а не теряется."""
+    service.db_agent.id_type = 'uuid'
+    message = make_message(movement_id='legacy-movement')
+
+    await service.handle_kafka_batch([message])
+
+    service.kafka_agent.send_dead_letter.assert_called_once()
+    assert service.kafka_agent.send_dead_letter.call_args.args[0] is message
+    service.db_agent.save_movement_event.assert_not_called()
+    service.db_agent.save_movement_events_batch.assert_not_called()
@@ -0,0 +1,151 @@
+import time
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+
+from app.agents.cache_agent import CacheAgent
+from app.agents.snapshot_agent import SnapshotAgent
+from app.agents.stock_projection_agent import StockProjectionAgent
+from app.models import MovementInfo, WarehouseProductInfo
+from app.snapshot import Snapshot, read_snapshot, touched_keys, write_snapshot
+
+
+def make_snapshot(**fields):
+    snapshot = Snapshot(
+        created_at=time.time(),
+        offsets={('warehouse_movements', 0): 120, ('warehouse_movements', 1): None},
+        stock_complete=True,
+        warehouse_ids=['warehouse-1', 'warehouse-2'],
+        product_ids=['product-1'],
+        stock=[(0, 0, 10), (1, 0, 3)],
+        cache=[
+            (
+                'warehouse_product:warehouse-1:product-1',
+                {'warehouse_id': 'warehouse-1', 'product_id': 'product-1', 'quantity': 10},
+                time.time() + 60,
+            ),
+            (
+                'movement:movement-1',
+                {'movement_id': 'movement-1', 'product_id': 'product-1', 'quantity': 5},
+                time.time() + 60,
+            ),
+        ],
+    )
+    return snapshot._replace(**fields)
+
+
+def test_snapshot_roundtrip(tmp_path):
+    """Тест записи и чтения снимка."""
+    path = str(tmp_path / 'snapshot.bin')
+    snapshot = make_snapshot()
+
+    write_snapshot(path, snapshot)
+
+    assert read_snapshot(path) == snapshot
+
+
+def test_corrupted_snapshot_raises_value_error(tmp_path):
+    """Тест: обрезанный файл снимка отклоняется."""
+    path = tmp_path / 'snapshot.bin'
+    write_snapshot(str(path), make_snapshot())
+    path.write_bytes(path.read_bytes()[:-10])
+
+    with pytest.raises(ValueError):
+        read_snapshot(str(path))
+
+
+@pytest.mark.asyncio
+async def test_restore_refreshes_keys_from_kafka_tail(tmp_path):
+    """Тест: ключи, затронутые хвостом Kafka, берутся из БД, а не из снимка."""
+    path = str(tmp_path / 'snapshot.bin')
+    write_snapshot(path, make_snapshot())
+
+    cache_agent = CacheAgent()
+    projection = StockProjectionAgent(MagicMock(), MagicMock())
+    projection.enabled = True
+    db_agent = MagicMock()
+    db_agent.get_warehouse_products_info = AsyncMock(
+        return_value=[
+            WarehouseProductInfo(warehouse_id='warehouse-1', product_id='product-1', quantity=4)
+        ]
+    )
+    agent = SnapshotAgent(
+        cache_agent,
+        projection,
+        MagicMock(),
+        db_agent,
+        {'movement': MovementInfo, 'warehouse_product': WarehouseProductInfo},
+    )
+    await agent.initialize({'snapshot_enabled': True, 'snapshot_path': path})
+
+    tail = ({('warehouse-1', 'product-1')}, set())
+    with patch.object(agent, '_read_tail', AsyncMock(return_value=tail)):
+        assert await agent.restore() is True
+
+    db_agent.get_warehouse_products_info.assert_called_once_with([('warehouse-1', 'product-1')])
+    assert projection.get('warehouse-1', 'product-1') == 4
+    assert projection.get('warehouse-2', 'product-1') == 3
+    assert cache_agent.get('warehouse_product:warehouse-1:product-1') is None
+    assert cache_agent.get('movement:movement-1').quantity == 5
+
+
+@pytest.mark.asyncio
+async def test_save_writes_projection_and_cache(tmp_path):
+    """Тест записи снимка из копии проекции и кеша."""
+    path = str(tmp_path / 'snapshot.bin')
+    cache_agent = CacheAgent()
+    cache_agent.set(
+        'warehouse_product:warehouse-1:product-1',
+        WarehouseProductInfo(warehouse_id='warehouse-1', product_id='product-1', quantity=10),
+    )
+    cache_agent.set('other:key', 'value')
+    projection = StockProjectionAgent(MagicMock(), MagicMock())
+    projection.enabled = True
+    projection.load(['warehouse-1', 'warehouse-2'], ['product-1'], [(0, 0, 10), (1, 0, 3)])
+    kafka_agent = MagicMock()
+    kafka_agent.commit_processed = AsyncMock()
+    agent = SnapshotAgent(
+        cache_agent,
+        projection,
+        kafka_agent,
+        MagicMock(),
+        {'warehouse_product': WarehouseProductInfo},
+    )
+    await agent.initialize({'snapshot_enabled': True, 'snapshot_path': path})
+
+    with patch.object(agent, '_committed_offsets', AsyncMock(return_value={})):
+        await agent.save()
+
+    snapshot = read_snapshot(path)
+    assert snapshot.stock_complete is True
+    assert snapshot.warehouse_ids == ['warehouse-1', 'warehouse-2']
+    assert sorted(snapshot.stock) == [(0, 0, 10), (1, 0, 3)]
+    assert [key for key, _, _ in snapshot.cache] == ['warehouse_product:warehouse-1:product-1']
+
+
+def test_touched_keys_normalize_uuid_ids():
+    """Тест: ключи хвоста приводятся к записи UUID, по которой строятся ключи кеша."""
+    db_agent = MagicMock()
+    db_agent.id_type = 'uuid'
+    agent = SnapshotAgent(CacheAgent(), MagicMock(), MagicMock(), db_agent, {})
+    warehouse = '{6F9619FF-8B86-D011-B42D-00C04FC964FF}'
+    product = 'A0EEBC99-9C0B-4EF8-BB6D-6BB9BD380A11'
+    records = [
+        SimpleNamespace(
+            value={
+                'data': {
+                    'movement_id': 'not-a-uuid',
+                    'warehouse_id': warehouse,
+                    'product_id': product,
+                }
+            }
+        )
+    ]
+
+    stock, movements = touched_keys(records, agent._normalize_id)
+
+    assert stock == {
+        ('6f9619ff-8b86-d011-b42d-00c04fc964ff', 'a0eebc99-9c0b-4ef8-bb6d-6bb9bd380a11')
+    }
+    assert movements == {'not-a-uuid'}
@@ -0,0 +1,162 @@
+from unittest.mock import MagicMock
+
+import pytest
+from aiokafka import TopicPartition
+
+from app.agents.kafka_agent import PartitionOffsetTracker
+from app.agents.stock_projection_agent import StockProjectionAgent
+from app.models import WarehouseProductInfo
+
+
+def make_agent(rows):
+    async def iter_rows():
+        for row in rows:
+            yield row
+
+    db_agent = MagicMock()
+    db_agent.iter_warehouse_products = MagicMock(side_effect=iter_rows)
+    kafka_agent = MagicMock()
+    kafka_agent.offset_tracker = PartitionOffsetTracker()
+
+    agent = StockProjectionAgent(db_agent, kafka_agent)
+    agent.enabled = True
+    return agent
+
+
+@pytest.mark.asyncio
+async def test_bootstrap_keeps_updates_applied_during_load():
+    """Тест: значения, примененные во время загрузки, не затираются снимком."""
+    agent = make_agent(
+        [
+            {
+                'warehouse_id': 'warehouse-1',
+                'product_id': 'product-1',
+                'quantity': 10,
+                'version': 1,
+            },
+            {'warehouse_id': 'warehouse-1', 'product_id': 'product-2', 'quantity': 5, 'version': 1},
+        ]
+    )
+
+    assert agent.get('warehouse-1', 'product-1') is None
+
+    agent.apply(
+        [WarehouseProductInfo(warehouse_id='warehouse-1', product_id='product-1', quantity=7)]
+    )
+    await agent.bootstrap()
+
+    assert agent.ready is True
+    assert agent.get('warehouse-1', 'product-1') == 7
+    assert agent.get('warehouse-1', 'product-2') == 5
+    # Пар без записи в проекции она не знает - чтение идет через БД
+    assert agent.get('warehouse-1', 'product-3') is None
+    assert agent.get('warehouse-2', 'product-1') is None
+
+
+@pytest.mark.asyncio
+async def test_forgotten_stock_is_not_served_until_next_value():
+    """Тест: сброшенный другой репликой остаток не отдается до нового значения."""
+    agent = make_agent([])
+    await agent.bootstrap()
+
+    agent.forget('warehouse-1', 'product-1')
+    assert agent.get('warehouse-1', 'product-1') is None
+
+    agent.apply(
+        [WarehouseProductInfo(warehouse_id='warehouse-1', product_id='product-1', quantity=3)]
+    )
+    assert agent.get('warehouse-1', 'product-1') == 3
+
+
+@pytest.mark.asyncio
+async def test_stale_versions_are_ignored():
+    """Тест: значение с версией не новее известной не применяется, в том числе после сброса."""
+    agent = make_agent([])
+    await agent.bootstrap()
+
+    def info(quantity, version):
+        return WarehouseProductInfo(
+            warehouse_id='warehouse-1', product_id='product-1', quantity=quantity, version=version
+        )
+
+    agent.apply([info(8, 5)])
+    agent.apply([info(3, 4)])
+    assert agent.get('warehouse-1', 'product-1') == 8
+
+    agent.forget('warehouse-1', 'product-1')
+    agent.apply([info(3, 4)])
+    assert agent.get('warehouse-1', 'product-1') is None
+
+    agent.apply([info(9, 6)])
+    assert agent.get('warehouse-1', 'product-1') == 9
+
+
+def test_watermark_reports_processed_offsets():
+    """Тест: водяной знак - смещения, до которых все сообщения обработаны."""
+    agent = make_agent([])
+    tracker = agent.kafka_agent.offset_tracker
+    tp = TopicPartition('warehouse_movements', 0)
+    for offset in (10, 11, 12):
+        tracker.track(tp, offset)
+    tracker.done(tp, 10)
+    tracker.done(tp, 12)
+
+    watermark = agent.watermark()
+
+    assert watermark['offsets'] == {'warehouse_movements:0': 11}
+    assert watermark['ready'] is False
+
+
+@pytest.mark.asyncio
+async def test_suspend_and_resync():
+    """Тест: приостановленная проекция не отвечает до перечитывания из БД."""
+    agent = make_agent(
+        [{'warehouse_id': 'warehouse-1', 'product_id': 'product-1', 'quantity': 4, 'version': 3}]
+    )
+    await agent.bootstrap()
+    agent.forget('warehouse-1', 'product-1')
+
+    agent.suspend()
+    assert agent.get('warehouse-1', 'product-1') is None
+
+    agent.resync()
+    await agent.bootstrap_task
+
+    assert agent.ready is True
+    assert agent.get('warehouse-1', 'product-1') == 4
+
+
+@pytest.mark.asyncio
+async def test_reconcile_replaces_only_older_entries():
+    """Тест: сверка исправляет расхождения, но не откатывает более новые значения."""
+    agent = make_agent([])
+    await agent.bootstrap()
+    agent.apply(
+        [
+            WarehouseProductInfo(
+                warehouse_id='warehouse-1', product_id='product-1', quantity=1, version=1
+            ),
+            WarehouseProductInfo(
+                warehouse_id='warehouse-1', product_id='product-2', quantity=9, version=5
+            ),
+        ]
+    )
+    agent.forget('warehouse-1', 'product-3')
+
+    rows = [
+        {'warehouse_id': 'warehouse-1', 'product_id': 'product-1', 'quantity': 3, 'version': 2},
+        {'warehouse_id': 'warehouse-1', 'product_id': 'product-2', 'quantity': 8, 'version': 4},
+        {'warehouse_id': 'warehouse-1', 'product_id': 'product-3', 'quantity': 6, 'version': 1},
+    ]
+
+    async def iter_rows():
+        for row in rows:
+            yield row
+
+    agent.db_agent.iter_warehouse_products = MagicMock(side_effect=iter_rows)
+
+    assert await agent.reconcile() == 2
+    assert agent.ready is True
+    assert agent.get('warehouse-1', 'product-1') == 3
+    assert agent.get('warehouse-1', 'product-2') == 9
+    assert agent.get('warehouse-1', 'product-3') == 6